@@ -3,6 +3,7 @@
 use strict;
 use Carp;
 use List::Util 'shuffle';
+use Digest::MD5 qw(md5_hex);
 
 # Set up relative directories:
 use Cwd ();
@@ -44,6 +45,12 @@ my $NUM_HS = 2;
 my $parallel_status = "false";
 my $missing_denominator = 5;
 
+# Set PEDSIM_SEED to make runs repeatable. The pedigree, diagrams and genotypes are then seeded
+# from it and the simulation number, and the seeded diagrams and genotypes are cached in $cache_dir
+my $seed = $ENV{PEDSIM_SEED} // "";
+my $sim_seed = "";
+my $cache_dir = "$output_root/cache";
+
 my @PC_k0s;
 my @FS_k0s;
 my @HAG_k0s;
@@ -77,6 +84,12 @@ my %pairwise_rels;
 my $sim = shift; # Number (identifier of the simulation)
 my $type = shift; # e.g., uniform3 
 
+if($seed ne "")
+{
+	$sim_seed = "$seed:$sim";
+	srand(hex(substr(md5_hex($sim_seed), 0, 8)));
+}
+
 if($type eq "uniform3")
 {
 	$mean_children = 3;
@@ -753,53 +766,59 @@ sub add_genotypes {
 	#print "Generating ped and map files for $fam_file\n";
 	
 	## Diagram pedigree
-	run_system("python $simulation_dir/recomb_sim.py --fam=$fam_file --chr-lengths=$chr_lengths --out=$fam_file_root\_diag.txt");
+	my $seed_options = $sim_seed eq "" ? "" : " --seed=$sim_seed --cache=$cache_dir";
+	run_system("python $simulation_dir/recomb_sim.py --fam=$fam_file --chr-lengths=$chr_lengths --out=$fam_file_root\_diag.txt$seed_options");
 
 	## Get IBD from diagrams
 	run_system("python $simulation_dir/diagram_ibd.py --out=$fam_file_root\_diag.IBD --chrom_num=23 $fam_file_root\_diag.txt");
 	
-	# string to concatenate with all chromosomal commands to execute with parallel
-	my $command_str = '';
+	my $genetic_map_file = "$data_dir/map.gz";
 
-	for my $chr(1..22)
-	{
+	# Reference file for dropping in genotypes, {chr} is filled in per chromosome
+	## UPDATE 11/22/24
+	my $reference_sample_file = "$data_dir/reference/$ONEKG_pop/1KG.$ONEKG_pop.GRCH38.rsID.chr{chr}.vcf.gz";
+	## Populations without a panel of their own (e.g. CEU+TSI) take their founders from the combined panel in reference/ALL
+	my $population_option = "";
+	if (!-d "$data_dir/reference/$ONEKG_pop" && -d "$data_dir/reference/ALL") {
+		$reference_sample_file = "$data_dir/reference/ALL/1KG.ALL.GRCH38.rsID.chr{chr}.vcf.gz";
+		$population_option = " --population=$ONEKG_pop";
+	}
 
-		my $genetic_map_file = "$data_dir/map.gz";
+	# The scheduler runs as many chromosomes at once as fit in memory, largest first
+	# Its names files are kept with the diagrams, not removed with the other per-chromosome files, for genotype_lookup.py
+	my $schedule_command = "python3 $simulation_dir/schedule_genotypes.py --chr=1-22 --simulation=$fam_file_root\_diag.txt --map=$genetic_map_file --out=$fam_file_root.chr{chr}\_diag.vcf.gz --chunk=10000 --write-names=$fam_file_root\_diag.chr{chr}.names --bed=$fam_file_root.chr{chr}\_diag";
+	# Variants that would fail the QC in make_simulated_pedigree are filtered out before simulating
+	$schedule_command = $schedule_command . " --extract=$data_dir/extract_mega.bim --frq=$data_dir/all.frq --maf=0.05 --geno=0.1$seed_options$population_option";
 
-		# Set reference file for dropping in genotypes 
+	# Run genotype dropping commands in parallel if notated at runtime
 
-		## UPDATE 11/22/24
-		my $reference_sample_file = "$data_dir/reference/$ONEKG_pop/1KG.$ONEKG_pop.GRCH38.rsID.chr$chr.vcf.gz";   
+	if ($parallel_status ne "parallel") {
+		## One process reads the diagrams once and writes every chromosome straight into the genome-wide files
+		print "\nRunning add_genotypes with single thread\n";
+		run_system("python3 $simulation_dir/sim_to_genotypes.py --mode=IBD --chr=1-22 --simulation=$fam_file_root\_diag.txt --map=$genetic_map_file --out=$fam_file_root\_all_chr.vcf.gz --chunk=10000 --gzip --write-names=$fam_file_root\_diag.names --bed=$fam_file_root\_all_chr --extract=$data_dir/extract_mega.bim --frq=$data_dir/all.frq --maf=0.05 --geno=0.1$seed_options$population_option $reference_sample_file");
+		return;
+	}
 
-		## build command string for each chromosome
-		my $full_command = "python3 $simulation_dir/sim_to_genotypes.py --mode=IBD --chr=$chr --simulation=$fam_file_root\_diag.txt --map $genetic_map_file --out=$fam_file_root.chr$chr\_diag.vcf --chunk=10000 --write-names=$fam_file_root.chr$chr\_diag.names --gzip $reference_sample_file\n";
+	print "\nRunning add_genotypes commands in parallel\n";
+	run_system("$schedule_command $reference_sample_file");
 
-		## concatenate the 22-chr string to be read into parallel
-		$command_str = $command_str . $full_command;
+	my $concat_command = "python3 $simulation_dir/concat_vcf.py --out=$fam_file_root\_all_chr.vcf.gz";
+	for my $chr(1..22)
+	{
+		$concat_command = $concat_command . " $fam_file_root.chr$chr\_diag.vcf.gz";
 	}
 
-	# Run genotype dropping commands in parallel if notated at runtime
+	print "\nConcatenating output ...\n";
 
-	if ($parallel_status eq "parallel") {
-		print "\nRunning add_genotypes commands in parallel\n";
-		run_system("echo \"$command_str\" | parallel -j22");
-	}
-	else {
-		print "\nRunning add_genotypes commands with single thread\n";
-		run_system("$command_str");
-	}
+	run_system($concat_command);
 
-	my $bcftools_command = 'bcftools concat ';
+	## Join the per-chromosome PLINK binary files written alongside the VCFs
+	my $bed_command = "python3 $simulation_dir/plink_bed.py --out=$fam_file_root\_all_chr";
 	for my $chr(1..22)
 	{
-		$bcftools_command = $bcftools_command . "$fam_file_root.chr$chr\_diag.vcf ";
+		$bed_command = $bed_command . " $fam_file_root.chr$chr\_diag";
 	}
-	$bcftools_command = $bcftools_command . "-o $fam_file_root\_all_chr.vcf.gz -O z > /dev/null 2>&1";  
-	#print "\n\n$bcftools_command\n\n";
-
-	print "\nConcatenating output with bcftools ...\n";
-
-	run_system($bcftools_command);
+	run_system($bed_command);
 
 	run_system("rm $fam_file_root.chr*");
 
@@ -2951,13 +2970,11 @@ sub make_simulated_pedigree {
 	## run main command with dup exclusion list -- this builds ped and map 
 	run_system("$plink_binary --genome --vcf $sim_dir/${sim_name}_all_chr_qced.vcf.gz --out $sim_dir/$sim_name --biallelic-only --snps-only \"just-acgt\" --read-freq $freq_file --const-fid --exclude $sim_dir/${sim_name}_dupsnps.txt --set-missing-var-ids \@:\# > /dev/null 2>&1");
 
-	## Generate plink-binary files -- ADD FILTERING STEPS INTO HERE TOO 
-	run_system("$plink_binary --vcf $sim_dir/${sim_name}_all_chr_qced.vcf.gz --make-bed --out $sim_dir/${sim_name} > /dev/null 2>&1");
+	## Generate plink-binary files from the ones written with the genotypes, with the same filters as the QCed VCF
+	## Their .fam already has parental IDs and sex from the diagrams
+	run_system("$plink2_binary --bfile $sim_dir/${sim_name}_all_chr --geno 0.1 --maf 0.05 --mind 0.1 --extract ${mega_bim} --allow-extra-chr --set-missing-var-ids \@:\# --make-bed --out $sim_dir/${sim_name} > /dev/null 2>&1");
 	print "\nBuilt PLINK-binary output files\n";
 
-	# overwrite the new .fam file with the .diag.txt.fam file since it has parental IDs and sex in it 
-	run_system("cp $sim_dir/${sim_name}_diag.txt.fam $sim_dir/${sim_name}.fam");
-
 	## Generate ped and map files for good measure
 	run_system("$plink_binary --bfile $sim_dir/${sim_name} --recode --out $sim_dir/${sim_name} > /dev/null 2>&1"); 
 
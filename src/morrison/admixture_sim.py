@@ -11,12 +11,15 @@
 
 import sys
 import math
-from random import randint
-from random import uniform
-from random import expovariate
+import random
 
-def admix(alpha, lam, chr_length):
+from sim_cache import ResultCache, stream
+
+CACHE_VERSION = 1 #Bump when the diagrams for a seed change
+
+def admix(alpha, lam, chr_length, rng=random):
     #lam is generations since admixture
+    #rng: source of random numbers, the random module unless seeded
     #chr_length should be in centimorgans
     chr_length=float(chr_length)/100
     alpha = [0,]+[float(x) for x in alpha]
@@ -28,20 +31,20 @@ def admix(alpha, lam, chr_length):
     chr_diagram = []; #popid, stop, popid, stop....
    
     #Select starting population
-    pop = uniform(0, 1)
+    pop = rng.uniform(0, 1)
     A = alpha+[pop]; A.sort()
     pop=A.index(pop)
     #get resampling points
     #P[Resample ancestry in interval] = 1-exp(-lambda*length)
     pos=0; breaks=[]
     while pos < chr_length: #Get recombination break points
-        nb = pos + expovariate(lam)
+        nb = pos + rng.expovariate(lam)
         if nb < chr_length:
             breaks.append(nb*100)
         pos=nb
     chr_diagram=[pop]
     for b in breaks:
-        pop = uniform(0, 1)
+        pop = rng.uniform(0, 1)
         A = alpha+[pop]; A.sort()
         pop=A.index(pop)
         if pop==chr_diagram[-1]:
@@ -70,6 +73,8 @@ if __name__== '__main__':
             help="Number of admixed individuals to produce.", default=1)
     parser.add_option("--npop", type="int", dest="npop", help="Number of populations.", default=1)
     parser.add_option("--lambda", type="int", dest="lam", default=5, help="Number of generations since admixture.")
+    parser.add_option("--seed", default="", dest="seed", help="Seed for the simulation. Each chromosome gets its own random stream.")
+    parser.add_option("--cache", default="", dest="cache", help="Directory of cached results. With --seed, diagrams already simulated for the same inputs are copied from here.")
     (opts, args) = parser.parse_args()
     if len(args) != opts.npop-1:
         sys.exit("Please provide an admixture proportion for each population beyond the first.") 
@@ -89,6 +94,14 @@ if __name__== '__main__':
     cms = inp.readlines()
     cms= [float(cm)/opts.bp_cM for cm in cms]
     inp.close()
+    cache = None
+    if opts.cache and opts.seed:
+        cache = ResultCache(opts.cache)
+        key = cache.key("admixture_sim", CACHE_VERSION, [opts.chr_lengths], [opts.seed, alpha, opts.N, opts.npop, opts.lam, opts.bp_cM])
+        if cache.fetch(key, {"diagrams": opts.out}):
+            print("Diagrams copied from the cache: "+key)
+            sys.exit()
+    streams = [stream(opts.seed, "admixture_sim", c+1) if opts.seed else random for c in range(len(cms))]
 
     try:
         out = open(opts.out, "wt")
@@ -97,8 +110,8 @@ if __name__== '__main__':
         sys.exit("Failed to open "+opts.out)
     for i in range(1, opts.N+1):
         for c in range(len(cms)):
-            hap1 = admix(alpha, opts.lam, cms[c])
-            hap2 = admix(alpha, opts.lam, cms[c])
+            hap1 = admix(alpha, opts.lam, cms[c], streams[c])
+            hap2 = admix(alpha, opts.lam, cms[c], streams[c])
             if opts.bp_cM > 1:
                 for j in range(1, len(hap1), 2):
                     hap1[j] = str(int(round(opts.bp_cM * hap1[j])))
@@ -110,3 +123,5 @@ if __name__== '__main__':
         #outfam.write(" ".join([str(i), str(i), "0", "0", "1", "-9"])+"\n")
     out.close()
     #outfam.close()
+    if cache is not None:
+        cache.store(key, {"diagrams": opts.out})
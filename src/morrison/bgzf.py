@@ -0,0 +1,585 @@
+#!/usr/bin/env python
+#BGZF output and tabix indexing for simulated VCFs, and region queries on indexed reference VCFs
+#BGZF is gzip made of independent blocks of at most 64KB, so files can be indexed
+#and concatenated block by block (see the SAM/BAM specification, section 4.1)
+
+import gzip
+import os
+import struct
+import zlib
+
+import numpy as np
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+BLOCK_SIZE = 0xff00 #Uncompressed bytes per block, as in htslib
+EOF_BLOCK = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+HEADER = struct.Struct("<BBBBIBBHBBHH") #gzip header with the BC extra subfield
+HEADER_SIZE = HEADER.size #18
+
+def compress_block(data, level=6):
+    """Returns one BGZF block holding data (at most BLOCK_SIZE bytes)"""
+    c = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = c.compress(data) + c.flush()
+    bsize = HEADER_SIZE + len(cdata) + 8
+    return HEADER.pack(31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, bsize - 1) + cdata + \
+        struct.pack("<II", zlib.crc32(data), len(data))
+
+def iter_blocks(f):
+    """Yields the raw bytes of each BGZF block in an open binary file"""
+    while True:
+        header = f.read(HEADER_SIZE)
+        if not header:
+            return
+        if len(header) < HEADER_SIZE or header[:4] != b"\x1f\x8b\x08\x04" or header[12:14] != b"BC":
+            raise Exception("Not a BGZF file: "+getattr(f, "name", ""))
+        bsize = struct.unpack("<H", header[16:18])[0] + 1
+        yield header + f.read(bsize - HEADER_SIZE)
+
+def uncompressed_size(path):
+    """Total uncompressed size of a BGZF file from its block trailers, or None if it is not BGZF"""
+    total = 0
+    with open(path, "rb") as f:
+        while True:
+            header = f.read(HEADER_SIZE)
+            if not header:
+                return total
+            if len(header) < HEADER_SIZE or header[:4] != b"\x1f\x8b\x08\x04" or header[12:14] != b"BC":
+                return None
+            bsize = struct.unpack("<H", header[16:18])[0] + 1
+            f.seek(bsize - HEADER_SIZE - 4, 1)
+            total += struct.unpack("<I", f.read(4))[0]
+
+def block_data(block):
+    """Returns the uncompressed contents of a raw BGZF block"""
+    return zlib.decompress(block[HEADER_SIZE:-8], -15)
+
+def is_bgzf(path):
+    """True if path starts with a BGZF block header"""
+    with open(path, "rb") as f:
+        header = f.read(HEADER_SIZE)
+    return len(header) == HEADER_SIZE and header[:4] == b"\x1f\x8b\x08\x04" and header[12:14] == b"BC"
+
+class BgzfReader:
+    """Reads the lines of a BGZF file, decompressing blocks on a thread pool when threads > 1
+
+    Iterating gives the lines (bytes, newline included) in order, as iterating a
+    file opened with gzip.open(path, "rb") does. Blocks are independent and zlib
+    releases the GIL, so they decompress in parallel while the caller parses lines.
+    """
+    def __init__(self, path, threads=1):
+        self.f = open(path, "rb")
+        self.blocks = iter_blocks(self.f)
+        self.pool = ThreadPoolExecutor(threads) if threads > 1 else None
+        self.max_pending = 4 * threads
+        self.pending = deque()
+        self.lines = iter(())
+        self.partial = b"" #Start of a line continued in the next block
+
+    def _next_data(self):
+        """Uncompressed contents of the next block, None at the end of the file"""
+        if self.pool is None:
+            block = next(self.blocks, None)
+            return None if block is None else block_data(block)
+        while len(self.pending) < self.max_pending:
+            block = next(self.blocks, None)
+            if block is None:
+                break
+            self.pending.append(self.pool.submit(block_data, block))
+        return self.pending.popleft().result() if self.pending else None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = next(self.lines, None)
+        while line is None:
+            data = self._next_data()
+            if data is None:
+                if not self.partial:
+                    raise StopIteration
+                line, self.partial = self.partial, b""
+                return line
+            parts = (self.partial + data).split(b"\n")
+            self.partial = parts.pop()
+            self.lines = iter([l+b"\n" for l in parts])
+            line = next(self.lines, None)
+        return line
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def open_vcf(path, threads=1):
+    """Opens a .vcf.gz for reading lines: a BgzfReader if it is BGZF, otherwise gzip.open(path, "rb")"""
+    if is_bgzf(path):
+        return BgzfReader(path, threads)
+    return gzip.open(path, "rb")
+
+class BgzfWriter:
+    """Writes a BGZF file, compressing blocks on a thread pool when threads > 1
+
+    zlib releases the GIL, so blocks compress in parallel while the caller keeps
+    producing output. Blocks are written in order. Offsets handed out by tell() are
+    uncompressed offsets; after close() virtual_offsets() turns them into BGZF
+    virtual offsets for indexing.
+    """
+    def __init__(self, path, threads=1, level=6):
+        self.out = open(path, "wb")
+        self.level = level
+        self.buffer = bytearray()
+        self.uoffset = 0 #Uncompressed bytes written so far
+        self.coffset = 0 #Compressed bytes written so far
+        self.block_ustart = [] #Uncompressed offset of each block
+        self.block_cstart = [] #Compressed offset of each block
+        self.pool = ThreadPoolExecutor(threads) if threads > 1 else None
+        self.max_pending = 4 * threads
+        self.pending = deque()
+
+    def tell(self):
+        return self.uoffset
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        self.buffer += data
+        self.uoffset += len(data)
+        while len(self.buffer) >= BLOCK_SIZE:
+            self._submit(bytes(self.buffer[:BLOCK_SIZE]))
+            del self.buffer[:BLOCK_SIZE]
+
+    def flush(self):
+        """Ends the current block so that the next write starts a new one"""
+        if self.buffer:
+            self._submit(bytes(self.buffer))
+            self.buffer = bytearray()
+
+    def _submit(self, data):
+        self.block_ustart.append(self.uoffset - len(self.buffer))
+        if self.pool is None:
+            self._write_block(compress_block(data, self.level))
+            return
+        self.pending.append(self.pool.submit(compress_block, data, self.level))
+        while len(self.pending) > self.max_pending:
+            self._write_block(self.pending.popleft().result())
+
+    def _write_block(self, block):
+        self.block_cstart.append(self.coffset)
+        self.out.write(block)
+        self.coffset += len(block)
+
+    def close(self):
+        self.flush()
+        while self.pending:
+            self._write_block(self.pending.popleft().result())
+        if self.pool is not None:
+            self.pool.shutdown()
+        #The end of the data points at the EOF block
+        self.block_ustart.append(self.uoffset)
+        self.block_cstart.append(self.coffset)
+        self.out.write(EOF_BLOCK)
+        self.out.close()
+
+    def virtual_offsets(self, uoffsets):
+        """Converts uncompressed offsets from tell() to virtual offsets (call after close)"""
+        ustart = np.asarray(self.block_ustart, dtype=np.int64)
+        cstart = np.asarray(self.block_cstart, dtype=np.int64)
+        uoffsets = np.asarray(uoffsets, dtype=np.int64)
+        b = np.searchsorted(ustart, uoffsets, side="right") - 1
+        return (cstart[b] << 16) | (uoffsets - ustart[b])
+
+##Tabix index (.tbi)
+#Records are binned with the UCSC binning scheme and a linear index over 16 kb windows
+TBI_MAGIC = b"TBI\x01"
+CSI_MAGIC = b"CSI\x01"
+TBI_VCF = 2
+PSEUDO_BIN = 37450
+LINEAR_SHIFT = 14
+NO_OFFSET = np.iinfo(np.int64).max #Linear index window without records
+
+def reg2bin(beg, end):
+    """Smallest bin fully containing each 0-based, half open [beg, end) (vectorized)"""
+    beg = np.asarray(beg, dtype=np.int64)
+    end = np.asarray(end, dtype=np.int64) - 1
+    conditions = [beg >> s == end >> s for s in (14, 17, 20, 23, 26)]
+    choices = [offset + (beg >> s) for offset, s in ((4681, 14), (585, 17), (73, 20), (9, 23), (1, 26))]
+    return np.select(conditions, choices, 0)
+
+class TabixIndex:
+    """Builds a tabix index from record offsets while a BGZF VCF is written"""
+    def __init__(self):
+        self.names = [] #Sequence names in file order
+        self.refs = {} #name -> [bins, linear, n_records, first_offset, last_offset]
+        #Offsets are uncompressed until write() converts them; bins: bin -> [[start, end], ...]
+
+    def add(self, chrom, beg, end, ustart, uend):
+        """Adds a batch of records on one sequence: 0-based [beg, end) and uncompressed [ustart, uend)"""
+        if len(beg) == 0:
+            return
+        if chrom not in self.refs:
+            self.names.append(chrom)
+            self.refs[chrom] = [{}, np.zeros(0, dtype=np.int64), 0, int(ustart[0]), 0]
+        ref = self.refs[chrom]
+        bins, linear = ref[0], ref[1]
+        ustart = np.asarray(ustart, dtype=np.int64)
+        uend = np.asarray(uend, dtype=np.int64)
+        #Runs of consecutive records in the same bin are one chunk
+        rec_bins = reg2bin(beg, end)
+        run_start = np.flatnonzero(np.diff(rec_bins, prepend=-1))
+        run_end = np.append(run_start[1:], len(rec_bins)) - 1
+        for b, s, e in zip(rec_bins[run_start].tolist(), ustart[run_start].tolist(), uend[run_end].tolist()):
+            chunks = bins.setdefault(b, [])
+            if chunks and chunks[-1][1] == s:
+                chunks[-1][1] = e
+            else:
+                chunks.append([s, e])
+        #Linear index: smallest record offset overlapping each 16 kb window
+        first_win = np.asarray(beg, dtype=np.int64) >> LINEAR_SHIFT
+        last_win = (np.maximum(np.asarray(end, dtype=np.int64), np.asarray(beg, dtype=np.int64) + 1) - 1) >> LINEAR_SHIFT
+        n_win = int(last_win.max()) + 1
+        if n_win > len(linear):
+            linear = np.append(linear, np.full(n_win - len(linear), NO_OFFSET, dtype=np.int64))
+        span = last_win - first_win
+        for k in range(int(span.max()) + 1):
+            sel = span >= k
+            np.minimum.at(linear, first_win[sel] + k, ustart[sel])
+        ref[1] = linear
+        ref[2] += len(beg)
+        ref[4] = int(uend[-1])
+
+    def add_vcf_lines(self, lines, ustart):
+        """Adds encoded VCF records that were written back to back starting at offset ustart"""
+        if not lines:
+            return
+        fields = [l.split(b"\t", 4) for l in lines]
+        beg = np.array([int(f[1]) for f in fields], dtype=np.int64) - 1
+        end = beg + np.array([len(f[3]) for f in fields], dtype=np.int64)
+        uend = ustart + np.cumsum([len(l) for l in lines], dtype=np.int64)
+        starts = np.append(ustart, uend[:-1])
+        chroms = [f[0] for f in fields]
+        s = 0
+        for i in range(1, len(chroms) + 1):
+            if i == len(chroms) or chroms[i] != chroms[s]:
+                self.add(chroms[s].decode(), beg[s:i], end[s:i], starts[s:i], uend[s:i])
+                s = i
+
+    def write(self, path, writer):
+        """Writes the index for the file written by writer (a closed BgzfWriter)"""
+        refs = []
+        for name in self.names:
+            bins, linear, n_records, first_offset, last_offset = self.refs[name]
+            vbins = {}
+            for b, chunks in bins.items():
+                flat = writer.virtual_offsets(np.array(chunks, dtype=np.int64).ravel())
+                vbins[b] = flat.reshape(-1, 2).tolist()
+            vfirst, vlast = writer.virtual_offsets([first_offset, last_offset]).tolist()
+            vbins[PSEUDO_BIN] = [[vfirst, vlast], [n_records, 0]]
+            #Empty windows take the previous window's offset (the first record's when leading), as htslib does
+            vlinear = np.full(len(linear), vfirst, dtype=np.int64)
+            have = linear != NO_OFFSET
+            vlinear[have] = writer.virtual_offsets(linear[have])
+            for i in range(1, len(vlinear)):
+                if not have[i]:
+                    vlinear[i] = vlinear[i - 1]
+            refs.append((name, vbins, vlinear.tolist()))
+        write_tabix(path, refs)
+
+def write_tabix(path, refs):
+    """Writes a .tbi file. refs: [(name, {bin: [[vbeg, vend], ...]}, [linear offsets]), ...]"""
+    names = b"".join(name.encode() + b"\0" for name, _, _ in refs)
+    out = [TBI_MAGIC, struct.pack("<8i", len(refs), TBI_VCF, 1, 2, 0, ord("#"), 0, len(names)), names]
+    for _, bins, linear in refs:
+        out.append(struct.pack("<i", len(bins)))
+        for b in sorted(bins):
+            chunks = bins[b]
+            out.append(struct.pack("<Ii", b, len(chunks)))
+            out.append(struct.pack("<%dQ" % (2 * len(chunks)), *[x for c in chunks for x in c]))
+        out.append(struct.pack("<i%dQ" % len(linear), len(linear), *linear))
+    writer = BgzfWriter(path)
+    writer.write(b"".join(out))
+    writer.close()
+
+def read_tabix(path):
+    """Reads a .tbi file into the refs structure used by write_tabix"""
+    with gzip.open(path, "rb") as inp:
+        data = inp.read()
+    if data[:4] != TBI_MAGIC:
+        raise Exception("Not a tabix index: "+path)
+    n_ref = struct.unpack_from("<i", data, 4)[0]
+    l_nm = struct.unpack_from("<i", data, 32)[0]
+    names = data[36:36 + l_nm].split(b"\0")[:n_ref]
+    pos = 36 + l_nm
+    refs = []
+    for name in names:
+        n_bin = struct.unpack_from("<i", data, pos)[0]; pos += 4
+        bins = {}
+        for _ in range(n_bin):
+            b, n_chunk = struct.unpack_from("<Ii", data, pos); pos += 8
+            flat = struct.unpack_from("<%dQ" % (2 * n_chunk), data, pos); pos += 16 * n_chunk
+            bins[b] = [list(flat[i:i + 2]) for i in range(0, len(flat), 2)]
+        n_intv = struct.unpack_from("<i", data, pos)[0]; pos += 4
+        linear = list(struct.unpack_from("<%dQ" % n_intv, data, pos)); pos += 8 * n_intv
+        refs.append((name.decode(), bins, linear))
+    return refs
+
+def shift_tabix(refs, delta):
+    """Moves every virtual offset in refs delta bytes further into the compressed file"""
+    shift = lambda v: ((v >> 16) + delta) << 16 | (v & 0xffff)
+    shifted = []
+    for name, bins, linear in refs:
+        new_bins = {}
+        for b, chunks in bins.items():
+            if b == PSEUDO_BIN:
+                new_bins[b] = [[shift(chunks[0][0]), shift(chunks[0][1])], chunks[1]]
+            else:
+                new_bins[b] = [[shift(s), shift(e)] for s, e in chunks]
+        shifted.append((name, new_bins, [shift(v) for v in linear]))
+    return shifted
+
+def merge_tabix_refs(refs):
+    """Joins consecutive refs on the same sequence, as from files holding successive regions of it"""
+    merged = []
+    for name, bins, linear in refs:
+        if not merged or merged[-1][0] != name:
+            if any(m[0] == name for m in merged):
+                raise Exception("Records on "+name+" are split by another sequence")
+            merged.append((name, dict(bins), list(linear)))
+            continue
+        _, merged_bins, merged_linear = merged[-1]
+        for b, chunks in bins.items():
+            if b == PSEUDO_BIN and b in merged_bins:
+                (vbeg, vend), (mapped, unmapped) = merged_bins[b]
+                merged_bins[b] = [[min(vbeg, chunks[0][0]), max(vend, chunks[0][1])], [mapped + chunks[1][0], unmapped + chunks[1][1]]]
+            else:
+                merged_bins[b] = merged_bins.get(b, []) + chunks
+        #Windows already covered keep the earlier file's offsets, which come first
+        merged_linear.extend(linear[len(merged_linear):])
+    return merged
+
+def reg2bins(beg, end, min_shift=LINEAR_SHIFT, depth=5):
+    """Every bin overlapping the 0-based, half open [beg, end)"""
+    bins = []
+    end -= 1
+    t = 0
+    s = min_shift + depth * 3
+    for level in range(depth + 1):
+        bins.extend(range(t + (beg >> s), t + (end >> s) + 1))
+        t += 1 << (level * 3)
+        s -= 3
+    return bins
+
+def read_csi(path):
+    """Reads a .csi file. Returns (min_shift, depth, refs) with refs as from read_tabix
+    except that the third item maps each bin to its minimum offset instead of a linear index."""
+    with gzip.open(path, "rb") as inp:
+        data = inp.read()
+    if data[:4] != CSI_MAGIC:
+        raise Exception("Not a CSI index: "+path)
+    min_shift, depth, l_aux = struct.unpack_from("<3i", data, 4)
+    aux = data[16:16 + l_aux]
+    pos = 16 + l_aux
+    n_ref = struct.unpack_from("<i", data, pos)[0]; pos += 4
+    #Sequence names are kept in a tabix style header in aux
+    names = aux[28:].split(b"\0")[:n_ref] if len(aux) >= 28 else []
+    if len(names) < n_ref:
+        raise Exception("CSI index without sequence names: "+path)
+    refs = []
+    for name in names:
+        n_bin = struct.unpack_from("<i", data, pos)[0]; pos += 4
+        bins = {}
+        loffsets = {}
+        for _ in range(n_bin):
+            b, loffset, n_chunk = struct.unpack_from("<IQi", data, pos); pos += 16
+            flat = struct.unpack_from("<%dQ" % (2 * n_chunk), data, pos); pos += 16 * n_chunk
+            bins[b] = [list(flat[i:i + 2]) for i in range(0, len(flat), 2)]
+            loffsets[b] = loffset
+        refs.append((name.decode(), bins, loffsets))
+    return min_shift, depth, refs
+
+def read_index(path, chrom):
+    """Index of path on chrom: (min_shift, depth, bins, offsets) from path.tbi or path.csi
+
+    offsets is the tabix linear index (a list) or the CSI minimum offset of each
+    bin (a dict). Returns None if there is no index, [] if chrom is not in it.
+    chrom may be given with or without a "chr" prefix.
+    """
+    if os.path.exists(path+".tbi"):
+        min_shift, depth, refs = LINEAR_SHIFT, 5, read_tabix(path+".tbi")
+    elif os.path.exists(path+".csi"):
+        min_shift, depth, refs = read_csi(path+".csi")
+    else:
+        return None
+    refs = dict((name, (bins, offsets)) for name, bins, offsets in refs)
+    for name in (chrom, "chr"+chrom, chrom.removeprefix("chr")):
+        if name in refs:
+            return (min_shift, depth) + refs[name]
+    return []
+
+def index_density(path, chrom):
+    """(positions, offsets): compressed file offsets at increasing positions on chrom, from the index of path
+
+    The offset grows with the number of records before a position, so the pairs
+    show how records are spread along the chromosome. Returns None without an index.
+    """
+    index = read_index(path, chrom)
+    if not index:
+        return index
+    min_shift, depth, bins, offsets = index
+    if isinstance(offsets, list): #Tabix linear index: one offset per 16 kb window
+        positions = np.arange(len(offsets), dtype=np.int64) << LINEAR_SHIFT
+        return positions + 1, np.asarray(offsets, dtype=np.uint64) >> 16
+    #CSI: where the records of each bin on the finest level start (loffset may be left as 0)
+    first = ((1 << (depth * 3)) - 1) // 7
+    leaves = sorted(b for b in bins if first <= b < first + (1 << (depth * 3)))
+    positions = (np.array(leaves, dtype=np.int64) - first) << min_shift
+    return positions + 1, np.array([min(c[0] for c in bins[b]) >> 16 for b in leaves], dtype=np.uint64)
+
+def index_chunks(path, chrom, beg, end):
+    """Virtual offset ranges of path that hold every record overlapping chrom:[beg, end)
+
+    Uses path.tbi or path.csi. Returns None if there is no index, [] if chrom is not in it.
+    chrom may be given with or without a "chr" prefix.
+    """
+    index = read_index(path, chrom)
+    if not index:
+        return index
+    min_shift, depth, bins, offsets = index
+    if isinstance(offsets, list): #Tabix linear index: no record before this offset overlaps beg
+        min_offset = offsets[min(beg >> LINEAR_SHIFT, len(offsets) - 1)] if offsets else 0
+    else:
+        min_offset = 0
+    chunks = sorted(c for b in reg2bins(beg, end, min_shift, depth) if b in bins and b != PSEUDO_BIN
+                    for c in bins[b] if c[1] > min_offset)
+    merged = []
+    for vbeg, vend in chunks:
+        if merged and vbeg <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], vend)
+        else:
+            merged.append([max(vbeg, min_offset), vend])
+    return merged
+
+def read_virtual(f, vbeg, vend):
+    """Returns the uncompressed bytes of an open BGZF file between two virtual offsets"""
+    f.seek(vbeg >> 16)
+    coffset = vbeg >> 16
+    out = []
+    for block in iter_blocks(f):
+        data = block_data(block)
+        lo = vbeg & 0xffff if coffset == vbeg >> 16 else 0
+        if coffset == vend >> 16:
+            out.append(data[lo:vend & 0xffff])
+            break
+        out.append(data[lo:])
+        coffset += len(block)
+        if coffset > vend >> 16:
+            break
+    return b"".join(out)
+
+def parse_region(region):
+    """'chr6:1000000-21000000' -> ('chr6', 1000000, 21000000), 1-based and inclusive.
+    The end may be left out ('chr6:1000000-' or 'chr6:1000000') and so may the range ('chr6')."""
+    chrom, _, span = region.partition(":")
+    start, _, end = span.replace(",", "").partition("-")
+    try:
+        start = int(start) if start else 1
+        end = int(end) if end else 2**31 - 1
+    except ValueError:
+        raise Exception("Could not read region "+region+". Use chr:start-end")
+    if not chrom or start < 1 or end < start:
+        raise Exception("Could not read region "+region+". Use chr:start-end")
+    return chrom, start, end
+
+def fetch(path, chrom, start, end):
+    """VCF records (bytes lines) on chrom with POS in [start, end] (1-based, inclusive)
+
+    Reads only the blocks the index points to. Returns None if path has no index.
+    """
+    chunks = index_chunks(path, chrom, start - 1, end)
+    if chunks is None:
+        return None
+    lines = []
+    with open(path, "rb") as f:
+        for vbeg, vend in chunks:
+            for line in read_virtual(f, vbeg, vend).split(b"\n"):
+                if not line or line.startswith(b"#"):
+                    continue
+                parts = line.split(b"\t", 2)
+                if parts[0].decode().removeprefix("chr") == chrom.removeprefix("chr") and start <= int(parts[1]) <= end:
+                    lines.append(line+b"\n")
+    return lines
+
+def header_end(data, mid_line):
+    """Offset of the first record line in a block of VCF data, None if the block is all header
+
+    mid_line: the previous block ended inside a header line. Returns (offset, mid_line
+    for the next block), as a header can run over many blocks that split its lines.
+    """
+    pos = 0
+    if mid_line:
+        pos = data.find(b"\n") + 1
+        if pos == 0:
+            return None, True
+    while pos < len(data):
+        if data[pos:pos+1] != b"#":
+            return pos, False
+        pos = data.find(b"\n", pos) + 1
+        if pos == 0:
+            return None, True
+    return None, False
+
+def concat_vcfs(paths, out_path):
+    """Concatenates BGZF VCFs by copying their blocks, keeping only the first header
+
+    Files written by sim_to_genotypes.py keep the header in blocks of its own, so no
+    data is recompressed. A block mixing header and records is recompressed without
+    the header lines. Returns True if a merged .tbi index was written, which needs
+    every input to have an index and no recompressed blocks.
+    """
+    refs = []
+    indexed = True
+    coffset = 0
+    with open(out_path, "wb") as out:
+        for n, path in enumerate(paths):
+            in_header = n > 0
+            mid_line = False #The last header block ended inside a line
+            delta = None #Shift of this file's data blocks in the output
+            with open(path, "rb") as inp:
+                inp_offset = 0
+                for block in iter_blocks(inp):
+                    block_offset = inp_offset
+                    inp_offset += len(block)
+                    if struct.unpack("<I", block[-4:])[0] == 0: #Empty, e.g. the EOF marker
+                        continue
+                    if in_header:
+                        data = block_data(block)
+                        start, mid_line = header_end(data, mid_line)
+                        if start is None:
+                            continue
+                        if b"\n#" in data[start:]:
+                            raise Exception(path+" has a header line after its first record")
+                        if start > 0:
+                            block = compress_block(data[start:])
+                            indexed = False
+                        in_header = False
+                    if delta is None:
+                        delta = coffset - block_offset
+                    out.write(block)
+                    coffset += len(block)
+            if indexed and os.path.exists(path+".tbi"):
+                refs.extend(shift_tabix(read_tabix(path+".tbi"), delta or 0))
+            else:
+                indexed = False
+        out.write(EOF_BLOCK)
+    if indexed:
+        write_tabix(out_path+".tbi", merge_tabix_refs(refs))
+    elif os.path.exists(out_path+".tbi"):
+        os.remove(out_path+".tbi")
+    return indexed
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+#Simulated cohorts archived as diagrams and founders instead of genotypes
+#Every simulated allele is a copy of the founder haplotype the chromosome diagrams name at that
+#position, so a run of sim_to_genotypes.py --mode=IBD is fully described by its diagrams, its
+#--write-names file(s), the reference panels and the options that chose the variants. An archive
+#stores those, plus the sample sets of any smaller versions of the pedigree, in one zip file and
+#exports the VCF and PLINK files of the run again on demand:
+#  python cohort_archive.py -s sim_diag.txt --read-names=sim_diag.names --out=sim.cohort ref.chr{chr}.vcf.gz
+#  python cohort_archive.py --export=sim.cohort --out=sim.vcf.gz --bed=sim
+#
+#An archive holds:
+#  cohort.json      format version, chromosomes, panel paths with size and sha256 per chromosome,
+#                   options (--bp-cm-sim, --bp-cm-map, --chunk, founders kept, populations, QC options),
+#                   the names file of each chromosome and the sample sets
+#  diagrams.txt     recomb_sim.py output
+#  names/*.names    --write-names files
+#  keep/<chr>.bits  np.packbits of the --extract/--frq/--maf/--geno variant mask, if there was one
+
+import json
+import os
+import sys
+import tempfile
+import zipfile
+
+import numpy as np
+
+from pipeline import WriterThread
+from plink_bed import BedWriter, write_fam
+from populations import DEFAULT_POPULATION_FILE, parse_population_spec
+from sim_cache import file_digest
+from sim_to_genotypes import Panel, Pedigree, VcfOutput, chromosome_files, drop_pedigrees, max_founders, read_genome_diagrams
+from variant_qc import keep_mask
+
+ARCHIVE_VERSION = 1
+
+def read_fam_ids(path):
+    """IIDs of a .fam or .ped file, in order"""
+    try:
+        with open(path, "rt") as inp:
+            return [l.split()[1] for l in inp if l.strip()]
+    except (OSError, IndexError) as e:
+        print(e)
+        sys.exit("Failed to read "+path)
+
+def write_archive(path, diagrams, names, panels, chroms=None, bptm=1000000, bptm_map=1000000, chunk=10000, max_haplotypes=None,
+                  population="", population_file=DEFAULT_POPULATION_FILE, extract="", frq="", maf=0.0, geno=1.0, sample_sets=None, threads=1):
+    """Archives an IBD mode run of sim_to_genotypes.py
+
+    diagrams, names (the --write-names file, with {chr} if there is one per
+    chromosome) and panels (with {chr}) are those of the run, as are the options.
+    chroms defaults to every chromosome of the diagrams. sample_sets maps a name
+    to the IIDs of a smaller version of the pedigree, exported with samples=name.
+    """
+    genome = read_genome_diagrams(diagrams, bptm, set(chroms) if chroms else None)
+    chroms = chroms or list(genome)
+    for chrom in chroms:
+        if chrom not in genome:
+            sys.exit("No diagrams for chromosome "+chrom+" in "+diagrams)
+    if max_haplotypes is None:
+        max_haplotypes = max(max_founders([Pedigree(diagrams, chrom, bptm, genome[chrom])]) for chrom in chroms)
+    individuals = set(genome[chroms[0]][0])
+    for name, ids in (sample_sets or {}).items():
+        missing = [i for i in ids if i not in individuals]
+        if missing:
+            sys.exit("Sample set "+name+" has individuals not in the diagrams: "+", ".join(missing[:5]))
+    info = {"version": ARCHIVE_VERSION, "mode": "IBD", "chromosomes": chroms, "panels": [os.path.abspath(p) for p in panels],
+            "panel_files": {}, "bptm": bptm, "bptm_map": bptm_map, "chunk": chunk, "max_haplotypes": max_haplotypes,
+            "population": population, "populations": parse_population_spec(population, population_file) if population else None,
+            "qc": {"extract": extract, "frq": frq, "maf": maf, "geno": geno}, "names": {}, "keep": {}, "sample_sets": sample_sets or {}}
+    variant_qc = extract or frq or maf > 0 or geno < 1
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as archive:
+        archive.write(diagrams, "diagrams.txt")
+        for chrom in chroms:
+            files = chromosome_files(panels, chrom)
+            for f in files:
+                if not os.path.exists(f):
+                    sys.exit("Failed to open "+f)
+            info["panel_files"][chrom] = [{"size": os.path.getsize(f), "sha256": file_digest(f)} for f in files]
+            member = "names/"+(chrom if "{chr}" in names else "all")+".names"
+            if member not in archive.namelist():
+                archive.write(names.replace("{chr}", chrom), member)
+            info["names"][chrom] = member
+            if variant_qc:
+                keep = keep_mask(files[0], extract, frq, maf, geno, None, threads)
+                archive.writestr("keep/"+chrom+".bits", np.packbits(keep).tobytes())
+                info["keep"][chrom] = len(keep)
+            print("Archived chromosome "+chrom)
+        archive.writestr("cohort.json", json.dumps(info, indent=1))
+    return info
+
+def read_archive(path):
+    """The cohort.json of an archive"""
+    try:
+        with zipfile.ZipFile(path) as archive:
+            info = json.loads(archive.read("cohort.json"))
+    except (OSError, KeyError, ValueError, zipfile.BadZipFile) as e:
+        print(e)
+        sys.exit("Failed to read archive "+path)
+    if info.get("version") != ARCHIVE_VERSION:
+        sys.exit(path+" is a version "+str(info.get("version"))+" archive, this script reads version "+str(ARCHIVE_VERSION))
+    return info
+
+def export_archive(path, out, bed="", chroms=None, samples="", panels=None, threads=1, workers=1, verify=True):
+    """Writes the VCF (and PLINK files with prefix bed) of an archived run
+
+    The same as the run's output, for the chromosomes in chroms (default all)
+    and the individuals of sample set samples (default all). panels replaces
+    the archived panel paths, e.g. on another machine; the files must be the
+    same, which is checked against the archived checksums when verify is set.
+    """
+    info = read_archive(path)
+    chroms = chroms or info["chromosomes"]
+    for chrom in chroms:
+        if chrom not in info["chromosomes"]:
+            sys.exit("Chromosome "+chrom+" is not in "+path)
+    if samples and samples not in info["sample_sets"]:
+        sys.exit("No sample set "+samples+" in "+path+". Sets: "+", ".join(info["sample_sets"]))
+    panels = panels or info["panels"]
+    populations = info["populations"]
+    outputs = [] #[VcfOutput, BedWriter or None] once the first chromosome is read
+    with zipfile.ZipFile(path) as archive, tempfile.TemporaryDirectory() as tmp:
+        diagrams = archive.extract("diagrams.txt", tmp)
+        genome = read_genome_diagrams(diagrams, info["bptm"], set(chroms))
+        for chrom in chroms:
+            files = chromosome_files(panels, chrom)
+            if len(files) != len(info["panel_files"][chrom]):
+                sys.exit("The archive has "+str(len(info["panel_files"][chrom]))+" genotype files per chromosome, "+str(len(files))+" were given")
+            for f, archived in zip(files, info["panel_files"][chrom]):
+                if not os.path.exists(f):
+                    sys.exit("Failed to open "+f)
+                if os.path.getsize(f) != archived["size"] or verify and file_digest(f) != archived["sha256"]:
+                    sys.exit(f+" is not the genotype file the archive was made with")
+            keep = None
+            if chrom in info["keep"]:
+                bits = np.frombuffer(archive.read("keep/"+chrom+".bits"), dtype=np.uint8)
+                keep = np.unpackbits(bits, count=info["keep"][chrom]).astype(bool)
+            pedigree = Pedigree(diagrams, chrom, info["bptm"], genome[chrom])
+            panel = Panel(files, info["max_haplotypes"], info["chunk"], info["bptm_map"], "", keep, None, False, threads, populations)
+            pedigree.pick_founders(panel, read_file=archive.extract(info["names"][chrom], tmp))
+            if samples:
+                kept = set(info["sample_sets"][samples])
+                pedigree.names = [n for n in pedigree.names if n in kept]
+
+            #Outputs are opened with the first chromosome, as sim_to_genotypes.py --chr=all does
+            if not outputs:
+                outputs = [VcfOutput(out, panel.meta, pedigree.names, panel.allele_table, threads), None]
+                if bed:
+                    outputs[1] = BedWriter(bed, panel.allele_table)
+                    write_fam(bed+".fam", pedigree.names, pedigree.fam_info)
+            elif not pedigree.names == outputs[0].names:
+                sys.exit("The diagrams for chromosome "+chrom+" do not have the same individuals as for chromosome "+chroms[0])
+            else:
+                outputs[0].allele_table = panel.allele_table
+                if outputs[1] is not None:
+                    outputs[1].set_allele_table(panel.allele_table)
+
+            def write_chunk(chunk):
+                snp_names, (genotypes,) = chunk
+                for output in outputs:
+                    if output is not None:
+                        output.write(snp_names, genotypes)
+            writer = WriterThread(write_chunk)
+            for snp_names, cm, genotypes in drop_pedigrees(panel, [pedigree], workers):
+                writer.put((snp_names, genotypes))
+            writer.close()
+            panel.close()
+            print("Exported chromosome "+chrom)
+    for output in outputs:
+        if output is not None:
+            output.close()
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+
+    from schedule_genotypes import parse_chromosomes
+
+    parser = OptionParser(usage = "%prog [options] -s sim_diag.txt --read-names=sim_diag.names --out=sim.cohort ref.chr{chr}.vcf.gz ...\n       %prog --export=sim.cohort --out=sim.vcf.gz [--bed=sim] [ref.chr{chr}.vcf.gz ...]\nArchives an IBD mode sim_to_genotypes.py run as its diagrams and founders, or exports the run's genotypes from an archive.")
+    parser.add_option("--export", default="", dest="export", help="Archive to export. Genotype files given after the options replace the archived paths.")
+    parser.add_option("--out", dest="out", default="", help="Archive to write, or with --export the VCF to write (BGZF compressed and tabix indexed if it ends in .gz). (required)")
+    parser.add_option("--bed", default="", dest="bed", help="With --export, also write PLINK .bed/.bim/.fam files with this prefix.")
+    parser.add_option("--samples", default="", dest="samples", help="With --export, only the individuals of this sample set of the archive.")
+    parser.add_option("-s", "--simulation", default="", dest="s", help="Chromosome diagrams of the run.")
+    parser.add_option("--read-names", default="", dest="read", help="The --write-names file of the run, with {chr} in place of the chromosome if there is one per chromosome.")
+    parser.add_option("-c", "--chr", dest="c", default="", help="Chromosomes, e.g. 1-22 or 1,2,X. Default is every chromosome of the diagrams, or of the archive with --export.")
+    parser.add_option("--fam", default="", dest="fam", help="Comma separated .fam files of smaller versions of the pedigree, stored as sample sets named after the files.")
+    parser.add_option("--extract", default="", dest="extract", help="The --extract of the run, if any.")
+    parser.add_option("--frq", default="", dest="frq", help="The --frq of the run, if any.")
+    parser.add_option("--maf", default=0.0, type="float", dest="maf", help="The --maf of the run, if any.")
+    parser.add_option("--geno", default=1.0, type="float", dest="geno", help="The --geno of the run, if any.")
+    parser.add_option("--population", default="", dest="population", help="The --population of the run, if any.")
+    parser.add_option("--population-file", default=DEFAULT_POPULATION_FILE, dest="population_file", help="The --population-file of the run.")
+    parser.add_option("--founders", default=0, type="int", dest="founders", help="Panel haplotypes the run kept: twice the number of individuals in the largest pedigree of its batch. Default is right for runs of one pedigree.")
+    parser.add_option("--chunk", default=10000, type="int", dest="chunk", help="The --chunk of the run. BGZF output only matches the run byte for byte with the same chunk.")
+    parser.add_option("--bp-cm-sim", default=1000000, dest="bptm", type="int", help="The --bp-cm-sim of the run.")
+    parser.add_option("--bp-cm-map", default=1000000, dest="bptm_map", type="int", help="The --bp-cm-map of the run.")
+    parser.add_option("--workers", default=1, type="int", dest="workers", help="With --export, processes dropping the genotypes, see sim_to_genotypes.py.")
+    parser.add_option("--threads", default=1, type="int", dest="threads", help="Threads for decompressing BGZF genotype files and compressing the output.")
+    parser.add_option("--no-verify", action="store_false", default=True, dest="verify", help="With --export, compare only the sizes of the genotype files with the archive, not their checksums.")
+    (opts, args) = parser.parse_args()
+
+    if not opts.out:
+        sys.exit("Improper usage. --out is required. Use -h for help.")
+    chroms = parse_chromosomes(opts.c) if opts.c else None
+    if opts.export:
+        export_archive(opts.export, opts.out, opts.bed, chroms, opts.samples, args or None, opts.threads, opts.workers, opts.verify)
+        sys.exit()
+    if not (opts.s and opts.read) or len(args) == 0:
+        sys.exit("Improper usage. --simulation, --read-names and at least one genotype file are required. Use -h for help.")
+    for path in args:
+        if ".vcf" not in path.lower():
+            sys.exit("Archives need VCF genotype files, "+path+" is not one")
+    sample_sets = {}
+    for path in opts.fam.split(",") if opts.fam else []:
+        sample_sets[os.path.basename(path).removesuffix(".fam")] = read_fam_ids(path)
+    info = write_archive(opts.out, opts.s, opts.read, args, chroms, opts.bptm, opts.bptm_map, opts.chunk, opts.founders or None,
+                         opts.population, opts.population_file, opts.extract, opts.frq, opts.maf, opts.geno, sample_sets, opts.threads)
+    print("Wrote "+opts.out+" ("+str(os.path.getsize(opts.out) // 1024)+"KB) for chromosomes "+",".join(info["chromosomes"]))
@@ -0,0 +1,29 @@
+#!/usr/bin/env python
+#Compiles reference VCF panels into the memory-mapped cache read by sim_to_genotypes.py
+#Run once per panel, e.g. python compile_reference.py ../../data/reference/EUR/
+
+import os
+import sys
+
+from reference_panel import compile_vcf
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+
+    parser = OptionParser(usage = "%prog [options] ref1.vcf.gz ref2.vcf.gz ... | reference_dir\n")
+    parser.add_option("--bp-cm-map", type="int", dest="bptm_map", default=1000000, help="Conversion used to precompute cM positions. Must match the --bp-cm-map given to sim_to_genotypes.py for the cached cM to be used. Default is 1 Mb = 1cM.")
+    parser.add_option("--threads", default=1, type="int", dest="threads", help="Threads for decompressing BGZF panels.")
+    parser.add_option("--force", action="store_true", default=False, dest="force", help="Recompile even if an up to date cache exists.")
+    (opts, args) = parser.parse_args()
+
+    if len(args) == 0:
+        sys.exit("Improper usage. At least one reference VCF or directory is required. Use -h for help.")
+    vcfs = []
+    for a in args:
+        if os.path.isdir(a):
+            vcfs.extend(sorted(os.path.join(a, f) for f in os.listdir(a) if f.endswith(".vcf.gz")))
+        else:
+            vcfs.append(a)
+    for vcf in vcfs:
+        print("Compiling "+vcf)
+        compile_vcf(vcf, opts.bptm_map, force=opts.force, threads=opts.threads)
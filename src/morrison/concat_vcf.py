@@ -0,0 +1,23 @@
+#!/usr/bin/env python
+#Joins per-chromosome (or per-shard) BGZF VCFs from sim_to_genotypes.py into one indexed file
+#Blocks are copied as they are, so this replaces bcftools concat without recompressing
+
+import sys
+
+from bgzf import concat_vcfs
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+
+    parser = OptionParser(usage = "%prog --out=all.vcf.gz chr1.vcf.gz chr2.vcf.gz ...\n")
+    parser.add_option("--out", dest="out", default="", help="Output file name. (required)")
+    (opts, args) = parser.parse_args()
+
+    if not opts.out or len(args) == 0:
+        sys.exit("Improper usage. --out and at least one BGZF VCF are required. Use -h for help.")
+    try:
+        indexed = concat_vcfs(args, opts.out)
+    except Exception as e:
+        sys.exit("Failed to concatenate: "+str(e))
+    if not indexed:
+        print("Not every input had a tabix index; "+opts.out+" was written without one")
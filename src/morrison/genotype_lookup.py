@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+#Genotypes of a few simulated individuals or sites, without simulating the whole cohort
+#A simulated allele is a copy of the founder haplotype its chromosome diagram names at that position, and
+#the --write-names file of the run says which panel haplotype each founder label is. With those and the
+#run's genotype files, the genotypes in a region are dropped again from just that part of the panel,
+#read through its index, and match the same part of the full output.
+
+import sys
+
+from bgzf import open_vcf, parse_region
+from populations import DEFAULT_POPULATION_FILE, parse_population_spec
+from reference_panel import read_vcf_header
+from sim_to_genotypes import GenotypeBlock, Panel, Pedigree, VcfOutput, drop_genotypes, max_founders
+
+SITE_GAP = 100000 #Sites further apart than this are read as separate regions
+
+def read_sites(path, chrom):
+    """Positions on chrom from a file of CHROM POS or CHROM:POS lines, sorted"""
+    try:
+        inp = open(path, "rt")
+    except Exception as e:
+        print(e)
+        sys.exit("Failed to open "+path)
+    positions = set()
+    for line in inp:
+        l = line.replace(":", " ").split()
+        if not l or l[0].startswith("#"):
+            continue
+        try:
+            if l[0].removeprefix("chr") == chrom.removeprefix("chr"):
+                positions.add(int(l[1]))
+        except (IndexError, ValueError):
+            sys.exit("Could not read site "+line.strip()+" in "+path+". Use CHROM POS")
+    inp.close()
+    return sorted(positions)
+
+def site_regions(chrom, positions, gap=SITE_GAP):
+    """(chrom, start, end) regions covering sorted positions, joining those less than gap apart"""
+    regions = []
+    for pos in positions:
+        if regions and pos - regions[-1][2] < gap:
+            regions[-1] = (chrom, regions[-1][1], pos)
+        else:
+            regions.append((chrom, pos, pos))
+    return regions
+
+def lookup_genotypes(diagrams, names_file, panels, chrom, regions, individuals=None, sites=None, bptm=1000000, bptm_map=1000000,
+                     max_haplotypes=None, threads=1, population="", population_file=DEFAULT_POPULATION_FILE):
+    """Genotypes of simulated individuals in regions of one chromosome, from an IBD mode run's diagrams and names file
+
+    A generator of GenotypeBlock like sim_to_genotypes.simulate_genotypes. regions
+    are (chrom, start, end) tuples or strings such as "chr6:1-20000000", in order,
+    and only those parts of the panels are read. individuals are IIDs from the
+    diagrams, every individual if None, and sites an optional set of positions
+    to keep. panels, population and max_haplotypes (the haplotypes the run kept,
+    twice its largest pedigree) must match the run for the founder names to resolve.
+    """
+    pedigree = Pedigree(diagrams, chrom, bptm)
+    if not pedigree.names:
+        sys.exit("No diagrams for chromosome "+chrom+" in "+diagrams)
+    names = pedigree.names if individuals is None else list(individuals)
+    for n in names:
+        if n not in pedigree.simu_data1:
+            sys.exit("Individual "+n+" not found in "+diagrams)
+    populations = parse_population_spec(population, population_file) if population else None
+    if max_haplotypes is None:
+        max_haplotypes = max_founders([pedigree])
+    for region in regions:
+        panel = Panel(panels, max_haplotypes, bptm_map=bptm_map, region=parse_region(region) if isinstance(region, str) else region,
+                      threads=threads, populations=populations)
+        pedigree.pick_founders(panel, read_file=names_file)
+        cursors = pedigree.cursors(names)
+        for snp_names, cm, founders in panel.chunks():
+            if sites is not None:
+                rows = [i for i, s in enumerate(snp_names) if int(s.split("\t", 2)[1]) in sites]
+                snp_names = [snp_names[i] for i in rows]
+                cm = cm[rows]
+                founders = founders.select(rows)
+            if len(snp_names):
+                yield GenotypeBlock(names, snp_names, cm, drop_genotypes(founders, cm, cursors, pedigree.founder_range), tuple(panel.allele_table))
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+
+    parser = OptionParser(usage = "%prog [options] -s sim_diag.txt --read-names=sim.names --chr=6 --region=chr6:1-20000000 --out=out.vcf ref.chr{chr}.vcf.gz ...\nWrites the genotypes a sim_to_genotypes.py --mode=IBD run gave some individuals or sites, reading only those parts of the genotype files.")
+    parser.add_option("-s", "--simulation", default="", dest="s", help="Chromosome diagrams the run simulated from. (required)")
+    parser.add_option("--read-names", default="", dest="read", help="The --write-names file of the run, with {chr} in place of the chromosome if there is one per chromosome. (required)")
+    parser.add_option("-c", "--chr", dest="c", default="", help="Chromosome of the diagrams. (required)")
+    parser.add_option("--region", default="", dest="region", help="Region to look up, e.g. chr6:1-20000000. Default is the whole chromosome.")
+    parser.add_option("--sites", default="", dest="sites", help="File of CHROM POS lines. Only these sites of --chr are looked up, instead of --region.")
+    parser.add_option("--individuals", default="", dest="individuals", help="Comma separated IIDs to look up. Default is every individual in the diagrams.")
+    parser.add_option("--out", dest="out", default="", help="Output VCF, BGZF compressed and tabix indexed if it ends in .gz. (required)")
+    parser.add_option("--bp-cm-sim", default=1000000, dest="bptm", type="int", help="As for sim_to_genotypes.py.")
+    parser.add_option("--bp-cm-map", default=1000000, dest="bptm_map", type="int", help="As for sim_to_genotypes.py.")
+    parser.add_option("--population", default="", dest="population", help="The --population of the run, if any.")
+    parser.add_option("--population-file", default=DEFAULT_POPULATION_FILE, dest="population_file", help="The --population-file of the run.")
+    parser.add_option("--founders", default=0, type="int", dest="founders", help="Panel haplotypes the run kept: twice the number of individuals in the largest pedigree of its batch. Default is twice the individuals in these diagrams, right for runs of one pedigree.")
+    parser.add_option("--threads", default=1, type="int", dest="threads", help="Threads for decompressing BGZF genotype files and compressing the output.")
+    (opts, args) = parser.parse_args()
+
+    if not (opts.s and opts.read and opts.c and opts.out) or len(args) == 0:
+        sys.exit("Improper usage. --simulation, --read-names, --chr, --out and at least one genotype file are required. Use -h for help.")
+    if opts.region and opts.sites:
+        sys.exit("Use --region or --sites, not both")
+    files = [a.replace("{chr}", opts.c) for a in args]
+    for path in files:
+        if ".vcf" not in path.lower():
+            sys.exit("Genotype lookup needs VCF genotype files, "+path+" is not one")
+    sites = None
+    if opts.sites:
+        sites = read_sites(opts.sites, opts.c)
+        regions = site_regions(opts.c, sites)
+        sites = set(sites)
+    else:
+        try:
+            regions = [parse_region(opts.region or opts.c)]
+        except Exception as e:
+            sys.exit(str(e))
+    individuals = opts.individuals.split(",") if opts.individuals else None
+
+    with open_vcf(files[0]) as f:
+        meta, _ = read_vcf_header(f)
+    output = None
+    for block in lookup_genotypes(opts.s, opts.read.replace("{chr}", opts.c), files, opts.c, regions, individuals, sites, opts.bptm, opts.bptm_map,
+                                  opts.founders or None, opts.threads, opts.population, opts.population_file):
+        if output is None:
+            output = VcfOutput(opts.out, meta, block.names, block.allele_table, opts.threads)
+        output.allele_table = block.allele_table #Each region's panel has its own codes
+        output.write(block.snp_names, block.genotypes)
+    if output is None:
+        sys.exit("No variants of the genotype files in the "+("sites" if sites is not None else "region"))
+    output.close()
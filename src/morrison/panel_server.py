@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+#A local service that reads reference panels once and shares them between runs of sim_to_genotypes.py
+#Decoded founder haplotypes are kept in shared memory and handed out over a Unix socket, so runs on the
+#same node for the same panel, chromosome, region and populations skip reading it. Panels not in use are
+#dropped least recently used first when --mem is exceeded. sim_to_genotypes.py asks the server at
+#DEFAULT_SOCKET and reads the files itself when no server is running.
+#
+#A client sends one JSON line describing the panel it wants and gets one JSON line back: the shared
+#memory block holding the panel and what is needed to rebuild the VcfData around it. The panel stays
+#leased to the client, and so is not dropped, until the client closes the connection.
+
+import base64
+import hashlib
+import json
+import os
+import socket
+import socketserver
+import sys
+import tempfile
+import threading
+
+import numpy as np
+
+from collections import OrderedDict
+
+from reference_panel import PackedAlleles, VcfData, load_panel
+from shared_arrays import SharedArrays
+
+DEFAULT_SOCKET = os.path.join(tempfile.gettempdir(), "pedsim-panels-"+str(os.getuid())+".sock")
+
+def panel_request(path, max_haplotypes, chunk, bptm, keep=None, region=None, populations=None):
+    """The JSON request for a panel, with the arguments of reference_panel.load_panel"""
+    request = {"path": os.path.abspath(path), "max_haplotypes": max_haplotypes, "chunk": chunk, "bptm": bptm,
+               "region": list(region) if region is not None else None,
+               "populations": [[w, list(ids)] for w, ids in populations] if populations is not None else None,
+               "keep": None, "n_keep": 0}
+    if keep is not None:
+        keep = np.asarray(keep, dtype=bool)
+        request["keep"] = base64.b64encode(np.packbits(keep).tobytes()).decode()
+        request["n_keep"] = len(keep)
+    return request
+
+def request_key(request):
+    """Key of a request: its arguments and the size and modification time of the panel file"""
+    st = os.stat(request["path"])
+    key = json.dumps([request, st.st_size, st.st_mtime_ns], sort_keys=True)
+    return hashlib.sha256(key.encode()).hexdigest()
+
+def load_request(request, threads=1):
+    """Reads the panel a request asks for"""
+    keep = None
+    if request["keep"] is not None:
+        keep = np.unpackbits(np.frombuffer(base64.b64decode(request["keep"]), dtype=np.uint8), count=request["n_keep"]).astype(bool)
+    region = tuple(request["region"]) if request["region"] is not None else None
+    populations = [(w, ids) for w, ids in request["populations"]] if request["populations"] is not None else None
+    return load_panel(request["path"], request["max_haplotypes"], request["chunk"], request["bptm"], keep, region, threads, populations)
+
+def share_panel(data: VcfData):
+    """Copies a VcfData into a SharedArrays block. Returns it and the reply fields clients rebuild the data from."""
+    chunks = data.founder_chunks
+    n_variants = len(data.positions)
+    n_haplotypes = chunks[0].n_haplotypes if chunks else 0
+    n_escapes = sum(len(c.escape_rows) for c in chunks)
+    names = "\n".join(data.snp_names).encode()
+    shared = SharedArrays.create([("bits", (n_variants, chunks[0].bits.shape[1] if chunks else 0), np.uint8),
+                                  ("ref", (n_variants,), np.uint8), ("alt", (n_variants,), np.uint8),
+                                  ("escape_rows", (n_escapes,), np.int64), ("escape_codes", (n_escapes, n_haplotypes), np.uint8),
+                                  ("positions", (n_variants,), np.int64), ("cm", (n_variants if data.cm is not None else 0,), np.float64),
+                                  ("snp_names", (len(names),), np.uint8)])
+    a = shared.arrays
+    for name in ("bits", "ref", "alt", "escape_rows", "escape_codes"):
+        start = 0
+        for c in chunks:
+            part = getattr(c, name)
+            a[name][start:start+len(part)] = part
+            start += len(part)
+    a["positions"][:] = data.positions
+    if data.cm is not None:
+        a["cm"][:] = data.cm
+    a["snp_names"][:] = np.frombuffer(names, dtype=np.uint8)
+    reply = {"spec": shared.spec(), "meta": data.meta, "fnames": data.fnames, "allele_table": data.allele_table, "n_haplotypes": n_haplotypes,
+             "cm": data.cm is not None, "chunks": [len(c) for c in chunks], "escapes": [len(c.escape_rows) for c in chunks]}
+    return shared, reply
+
+def unshare_panel(shared, reply) -> VcfData:
+    """The VcfData of share_panel on an attached block. Founder chunks are views of the block; the rest are copies."""
+    a = shared.arrays
+    founder_chunks = []
+    start = escape = 0
+    for n, n_escapes in zip(reply["chunks"], reply["escapes"]):
+        founder_chunks.append(PackedAlleles(a["bits"][start:start+n], a["ref"][start:start+n], a["alt"][start:start+n], reply["n_haplotypes"],
+                                            a["escape_rows"][escape:escape+n_escapes], a["escape_codes"][escape:escape+n_escapes]))
+        start += n
+        escape += n_escapes
+    positions = a["positions"].copy()
+    cm = a["cm"].copy() if reply["cm"] else None
+    snp_names = a["snp_names"].tobytes().decode().split("\n") if len(positions) else []
+    return VcfData(reply["meta"], reply["fnames"], snp_names, positions, cm, founder_chunks, reply["allele_table"])
+
+class PanelLease:
+    """A panel served by panel_server.py
+
+    data is a VcfData whose founder chunks are views of the server's shared
+    memory. They, and any views made from them, must not be used after close(),
+    which hands the panel back to the server.
+    """
+    def __init__(self, conn, shared, data):
+        self.conn = conn
+        self.shared = shared
+        self.data = data
+
+    def close(self):
+        self.data = None
+        self.shared.close()
+        self.conn.close()
+
+def fetch_panel(socket_path, path, max_haplotypes, chunk, bptm, keep=None, region=None, populations=None):
+    """A PanelLease on the panel load_panel would read, from the server at socket_path
+
+    None if no server is running there or it could not read the panel; the caller
+    then reads the file itself.
+    """
+    if not socket_path or not os.path.exists(socket_path):
+        return None
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(socket_path)
+        conn.sendall((json.dumps(panel_request(path, max_haplotypes, chunk, bptm, keep, region, populations))+"\n").encode())
+        with conn.makefile("rb") as f:
+            reply = json.loads(f.readline() or b"{}")
+    except (OSError, ValueError) as e:
+        conn.close()
+        print("Not using the panel server at "+socket_path+": "+str(e))
+        return None
+    if "spec" not in reply:
+        conn.close()
+        print("The panel server could not read "+path+": "+reply.get("error", "no reply"))
+        return None
+    shared = SharedArrays.attach(reply["spec"], own_tracker=True)
+    return PanelLease(conn, shared, unshare_panel(shared, reply))
+
+class Entry:
+    """A panel held by the server"""
+    def __init__(self, path, shared, reply):
+        self.path = path
+        self.shared = shared
+        self.reply = reply
+        self.size = shared.block.size
+        self.leases = 0
+
+class PanelStore:
+    """Shared panels by request key, in order of last use
+
+    budget is in bytes. Panels that no client holds are dropped, least recently
+    used first, while the total is over it. A panel is read once even when
+    several clients ask for it at the same time.
+    """
+    def __init__(self, budget, threads=1):
+        self.budget = budget
+        self.threads = threads
+        self.entries = OrderedDict() #key -> Entry
+        self.loading = {} #key -> threading.Event set once the panel is read
+        self.used = 0
+        self.lock = threading.Lock()
+
+    def lease(self, request):
+        key = request_key(request)
+        while True:
+            with self.lock:
+                entry = self.entries.get(key)
+                if entry is not None:
+                    self.entries.move_to_end(key)
+                    entry.leases += 1
+                    return entry
+                if key not in self.loading:
+                    done = self.loading[key] = threading.Event()
+                    break
+                done = self.loading[key]
+            done.wait()
+        entry = None
+        try:
+            entry = Entry(request["path"], *share_panel(load_request(request, self.threads)))
+            print("Loaded "+entry.path+" ("+str(entry.size // 2**20)+"MB)", flush=True)
+        finally:
+            with self.lock:
+                del self.loading[key]
+                if entry is not None:
+                    entry.leases = 1
+                    self.entries[key] = entry
+                    self.used += entry.size
+                    self.evict()
+            done.set()
+        return entry
+
+    def release(self, entry):
+        with self.lock:
+            entry.leases -= 1
+            self.evict()
+
+    def evict(self):
+        """Drops unleased panels, least recently used first, while over budget. Called with the lock held."""
+        for key, entry in list(self.entries.items()):
+            if self.used <= self.budget:
+                break
+            if entry.leases == 0:
+                del self.entries[key]
+                self.used -= entry.size
+                entry.shared.close(unlink=True)
+                print("Dropped "+entry.path, flush=True)
+
+    def close(self):
+        """Unlinks every panel. Clients still holding one keep their mapping of it."""
+        with self.lock:
+            for entry in self.entries.values():
+                entry.shared.close(unlink=True)
+            self.entries.clear()
+            self.used = 0
+
+class PanelHandler(socketserver.StreamRequestHandler):
+    """One request per connection; the panel is leased until the client disconnects"""
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return #A check for a running server, see server_running
+        try:
+            entry = self.server.store.lease(json.loads(line))
+        except (SystemExit, Exception) as e: #The readers sys.exit on bad input
+            try:
+                self.wfile.write((json.dumps({"error": str(e)})+"\n").encode())
+            except OSError:
+                pass
+            return
+        try:
+            self.wfile.write((json.dumps(entry.reply)+"\n").encode())
+            self.wfile.flush()
+            while self.rfile.read(1 << 16):
+                pass
+        except OSError:
+            pass
+        finally:
+            self.server.store.release(entry)
+
+class PanelServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, store):
+        super().__init__(path, PanelHandler)
+        self.store = store
+
+def server_running(path):
+    """Whether a server answers at the socket path"""
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(path)
+        return True
+    except OSError:
+        return False
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    import signal
+
+    from optparse import OptionParser
+
+    from schedule_genotypes import available_memory
+
+    parser = OptionParser(usage = "%prog [options]\nServes decoded reference panels to sim_to_genotypes.py from shared memory until stopped.")
+    parser.add_option("--socket", default=DEFAULT_SOCKET, dest="socket", help="Unix socket to listen on. Default is "+DEFAULT_SOCKET+", where sim_to_genotypes.py looks by default.")
+    parser.add_option("--mem", default=0, type="float", dest="mem", help="Memory for panels in GB. Panels not in use are dropped, least recently used first, above this. Default is half the memory currently available.")
+    parser.add_option("--threads", default=1, type="int", dest="threads", help="Threads for decompressing BGZF genotype files.")
+    (opts, args) = parser.parse_args()
+
+    if opts.mem:
+        budget = int(opts.mem * 2**30)
+    else:
+        budget = available_memory()
+        if budget is None:
+            sys.exit("Could not read available memory. Set --mem.")
+        budget //= 2
+    if os.path.exists(opts.socket):
+        if server_running(opts.socket):
+            sys.exit("A panel server is already running at "+opts.socket)
+        os.remove(opts.socket) #Left by a server that did not shut down
+
+    store = PanelStore(budget, opts.threads)
+    server = PanelServer(opts.socket, store)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print("Serving reference panels at "+opts.socket+" with "+str(budget // 2**20)+"MB", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(opts.socket)
+        store.close()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+#Threads that overlap reading, dropping and writing genotypes in sim_to_genotypes.py
+#gzip decompression, zlib compression, file writes and much of the numpy work release the GIL,
+#so a reader and a writer thread can run alongside the thread dropping genotypes. Stages hand
+#whole chunks to each other through bounded queues, so only a few chunks are held at once.
+
+import queue
+import threading
+
+DEPTH = 2 #Chunks waiting between two stages
+
+_END = object() #Marks the end of a queue
+
+class _Failed:
+    def __init__(self, error):
+        self.error = error
+
+def read_ahead(iterable, depth=DEPTH):
+    """Yields the items of iterable, produced on a background thread up to depth items ahead
+
+    An exception raised while producing an item (sys.exit included) is raised
+    again here. Closing the generator early stops the thread.
+    """
+    items = queue.Queue(depth)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+            put(_END)
+        except BaseException as e:
+            put(_Failed(e))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if item is _END:
+                return
+            if isinstance(item, _Failed):
+                raise item.error
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+        if hasattr(iterable, "close"):
+            iterable.close()
+
+class WriterThread:
+    """Calls write(item) on a background thread for each item put, in order
+
+    put() blocks while depth items are waiting. close() waits for everything
+    to be written. An exception raised by write is raised again by the next
+    put() or by close(), and later items are dropped.
+    """
+    def __init__(self, write, depth=DEPTH):
+        self.write = write
+        self.items = queue.Queue(depth)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            item = self.items.get()
+            if item is _END:
+                return
+            if self.error is None:
+                try:
+                    self.write(item)
+                except BaseException as e:
+                    self.error = e
+
+    def put(self, item):
+        if self.error is not None:
+            raise self.error
+        self.items.put(item)
+
+    def close(self):
+        self.items.put(_END)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
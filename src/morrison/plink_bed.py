@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+#Writes simulated genotypes as PLINK binary files (.bed/.bim/.fam)
+#The .bed is SNP-major: a 3 byte header, then one row of 2 bit genotypes per variant,
+#4 samples per byte with the first sample in the low bits
+#Run as a script to join per-chromosome files, e.g. python plink_bed.py --out=all chr1 chr2 ...
+
+import sys
+
+import numpy as np
+
+BED_MAGIC = bytes([0x6c, 0x1b, 0x01])
+MISSING = 2 #Allele index for anything other than REF (0) and the first ALT (1)
+#Genotype codes by ALT (A1) allele count, 3 = missing
+BED_CODES = np.array([0b11, 0b10, 0b00, 0b01], dtype=np.uint8)
+
+def allele_indices(allele_table):
+    """Maps allele codes to 0 (REF), 1 (first ALT) or MISSING"""
+    return np.array([int(a) if a in ("0", "1") else MISSING for a in allele_table], dtype=np.uint8)
+
+def encode_bed_rows(codes, indices):
+    """Packs a uint8 allele code matrix (variants x haplotypes, two per sample) into .bed rows
+
+    Multi-allelic sites keep REF and the first ALT; genotypes with any other
+    allele, or a missing one, are written as missing.
+    """
+    a = indices[codes[:, 0::2]]
+    b = indices[codes[:, 1::2]]
+    dosage = np.where((a == MISSING) | (b == MISSING), 3, a + b)
+    genos = BED_CODES[dosage]
+    n_samples = genos.shape[1]
+    pad = -n_samples % 4
+    if pad:
+        genos = np.hstack([genos, np.zeros((len(genos), pad), dtype=np.uint8)])
+    genos = genos.reshape(len(genos), -1, 4)
+    return genos[:, :, 0] | (genos[:, :, 1] << 2) | (genos[:, :, 2] << 4) | (genos[:, :, 3] << 6)
+
+class BedWriter:
+    """Writes <prefix>.bed and <prefix>.bim chunk by chunk
+
+    allele_table may grow between chunks (a streamed panel), new codes are picked up on write.
+    """
+    def __init__(self, prefix, allele_table):
+        self.bed = open(prefix+".bed", "wb")
+        self.bim = open(prefix+".bim", "wt")
+        self.bed.write(BED_MAGIC)
+        self.allele_table = allele_table
+        self.indices = allele_indices(allele_table)
+
+    def set_allele_table(self, allele_table):
+        """Switches to another panel's allele codes, e.g. for the next chromosome"""
+        self.allele_table = allele_table
+        self.indices = allele_indices(allele_table)
+
+    def write(self, snp_names, genos):
+        """snp_names: VCF fixed columns for each variant, genos: PackedAlleles (variants x haplotypes)"""
+        for name in snp_names:
+            chrom, pos, rsid, ref, alt = name.split("\t", 5)[:5]
+            alt = alt.split(",")[0]
+            self.bim.write("\t".join([chrom, rsid, "0", pos, "0" if alt == "." else alt, ref])+"\n")
+        if len(self.indices) < len(self.allele_table):
+            self.indices = allele_indices(self.allele_table)
+        encode_bed_rows(genos.unpack(), self.indices).tofile(self.bed)
+
+    def close(self):
+        self.bed.close()
+        self.bim.close()
+
+def write_fam(path, names, fam_info):
+    """Writes a .fam for names in output order. fam_info: IID -> [FID, IID, PID, MID, SEX]"""
+    with open(path, "wt") as out:
+        for n in names:
+            out.write("\t".join(fam_info[n][:5] + ["0"])+"\n")
+
+def concat_beds(prefixes, out_prefix):
+    """Joins SNP-major .bed/.bim files over the same samples, in order, and copies the first .fam"""
+    with open(prefixes[0]+".fam", "rt") as inp:
+        fam = inp.read()
+    with open(out_prefix+".bed", "wb") as bed, open(out_prefix+".bim", "wt") as bim:
+        bed.write(BED_MAGIC)
+        for prefix in prefixes:
+            with open(prefix+".fam", "rt") as inp:
+                if inp.read() != fam:
+                    raise Exception(prefix+".fam does not match "+prefixes[0]+".fam")
+            with open(prefix+".bed", "rb") as inp:
+                if inp.read(3) != BED_MAGIC:
+                    raise Exception(prefix+".bed is not a SNP-major .bed file")
+                while True:
+                    block = inp.read(1 << 24)
+                    if not block:
+                        break
+                    bed.write(block)
+            with open(prefix+".bim", "rt") as inp:
+                for line in inp:
+                    bim.write(line)
+    with open(out_prefix+".fam", "wt") as out:
+        out.write(fam)
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+
+    parser = OptionParser(usage = "%prog --out=all_chr prefix1 prefix2 ...\n")
+    parser.add_option("--out", dest="out", default="", help="Output prefix. (required)")
+    (opts, args) = parser.parse_args()
+
+    if not opts.out or len(args) == 0:
+        sys.exit("Improper usage. --out and at least one .bed/.bim/.fam prefix are required. Use -h for help.")
+    try:
+        concat_beds(args, opts.out)
+    except Exception as e:
+        sys.exit("Failed to concatenate: "+str(e))
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+#Founder populations for sim_to_genotypes.py --population
+#A spec such as EUR, CEU+TSI or CEU:3+YRI:1 picks the founder samples of a combined reference
+#panel by 1000 Genomes population, using the sample lists in 1kg.json
+
+import json
+import os
+import sys
+
+from itertools import zip_longest
+
+DEFAULT_POPULATION_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "1kg.json")
+
+#1000 Genomes superpopulations and their populations
+SUPERPOPULATIONS = {
+    "AFR": ["YRI", "LWK", "GWD", "MSL", "ESN", "ASW", "ACB"],
+    "AMR": ["MXL", "PUR", "CLM", "PEL"],
+    "EAS": ["CHB", "JPT", "CHS", "CDX", "KHV"],
+    "EUR": ["CEU", "TSI", "FIN", "GBR", "IBS"],
+    "SAS": ["GIH", "PJL", "BEB", "STU", "ITU"],
+}
+
+def parse_population_spec(spec, population_file=DEFAULT_POPULATION_FILE):
+    """'CEU:3+YRI:1' -> [(weight, sample ids), ...], one entry per + separated part
+
+    A part is a population or superpopulation, optionally with a weight after a
+    colon. The weight is None when not given: the part then counts by its
+    number of samples, so 'CEU+TSI' draws from the two as one pool.
+    """
+    try:
+        with open(population_file, "rt") as inp:
+            samples = json.load(inp)
+    except (OSError, ValueError) as e:
+        print(e)
+        sys.exit("Failed to read population file "+population_file)
+    populations = []
+    for part in spec.split("+"):
+        name, _, weight = part.strip().partition(":")
+        members = [m for m in SUPERPOPULATIONS[name] if m in samples] if name in SUPERPOPULATIONS else [name]
+        if not members or any(m not in samples for m in members):
+            sys.exit("Unknown population "+name+" in --population="+spec+". Known: "+", ".join(sorted(list(samples) + list(SUPERPOPULATIONS))))
+        try:
+            weight = float(weight) if weight else None
+        except ValueError:
+            sys.exit("Could not read the weight of "+part+" in --population="+spec)
+        if weight is not None and weight <= 0:
+            sys.exit("Population weights must be positive: "+part)
+        #A superpopulation's samples alternate between its populations, so its first founders are a mix
+        populations.append((weight, [s for group in zip_longest(*[samples[m] for m in members]) for s in group if s is not None]))
+    if len(set(w is None for w, _ in populations)) > 1:
+        sys.exit("Give a weight to every population in --population="+spec+" or to none")
+    return populations
+
+def founder_columns(fnames, max_haplotypes, populations=None):
+    """Haplotype columns of a panel to keep as founders, in founder order
+
+    fnames are the panel's haplotype names (each sample twice). Without populations
+    these are the first max_haplotypes. Otherwise each population of
+    parse_population_spec gets its weighted share of the founder samples (at most
+    max_haplotypes // 2), taken in order from its samples in the panel, and the
+    populations follow each other.
+    """
+    if populations is None:
+        return list(range(min(len(fnames), max_haplotypes)))
+    sample_index = dict((name, i) for i, name in reversed(list(enumerate(fnames[0::2]))))
+    present = [] #Panel samples of each population, each sample in the first population listing it
+    seen = set()
+    for _, ids in populations:
+        present.append([sample_index[s] for s in dict.fromkeys(ids) if s in sample_index and s not in seen])
+        seen.update(ids)
+    weights = [len(p) if w is None else w for (w, _), p in zip(populations, present)]
+    shares = [w / sum(weights) for w in weights] if sum(weights) else [0.0] * len(weights)
+    #As many samples as are needed and every population can supply at its share
+    n = max_haplotypes // 2
+    for share, p in zip(shares, present):
+        if share > 0:
+            n = min(n, int(len(p) / share + 1e-9))
+    #Largest remainder rounding, so the counts add up to n
+    counts = [int(n * share) for share in shares]
+    by_remainder = sorted(range(len(shares)), key=lambda i: n * shares[i] - counts[i], reverse=True)
+    for i in by_remainder[:n - sum(counts)]:
+        counts[i] += 1
+    return [2 * s + h for count, p in zip(counts, present) for s in p[:min(count, len(p))] for h in (0, 1)]
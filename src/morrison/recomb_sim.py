@@ -2,14 +2,18 @@
 
 #Will print Chrom diagram in bp
 import sys
-from random import expovariate
-from random import uniform
+import random
+
+from sim_cache import ResultCache, stream
+
+CACHE_VERSION = 1 #Bump when the diagrams for a seed change
 #random.expovariate(lambd)
 #Exponential distribution. lambd is 1.0 divided by the desired mean. It should be nonzero. 
-def recomb(hap1, hap2, rate=1):  
+def recomb(hap1, hap2, rate=1, rng=random):  
     #mat and pat are chromosome diagrams
     #[fgl1 stop1 fgl2 stop2 ... fgln stopn]
     #Distance between recombinations = exponential(rate)
+    #rng: source of random numbers, the random module unless seeded
     haplos=[hap1, hap2]
     chr_length=float(hap1[-1])
     dp = len(str(hap1[-1]).split("."))-1
@@ -20,13 +24,13 @@ def recomb(hap1, hap2, rate=1):
     lam = 1/float(rate)
     pos=0; breaks=[]
     while pos < chr_length: #Get recombination break points
-        nb = round(pos + expovariate(lam), digits)        
+        nb = round(pos + rng.expovariate(lam), digits)        
         if dp==0:
             nb =int(nb)
         if nb < chr_length:
             breaks.append(nb)
         pos=nb
-    start=uniform(0, 1) #choose random chromosome to start on 
+    start=rng.uniform(0, 1) #choose random chromosome to start on 
     if start < 0.5:
         hap=0
     else:
@@ -56,7 +60,7 @@ def recomb(hap1, hap2, rate=1):
     newhap=newhap+haplos[hap]
     return(newhap)
 
-def gethap(cur_cd, family, iid, fgl, chr_length, rate):
+def gethap(cur_cd, family, iid, fgl, chr_length, rate, rng=random):
     #cur_cd dictionary: iid-> [chrom diagram1, chrom diagram2]
     #family: iid ->parents
     #iid
@@ -70,9 +74,9 @@ def gethap(cur_cd, family, iid, fgl, chr_length, rate):
             cur_cd[iid][parent] = newhap
             continue
         elif len(cur_cd[P][parent])==0:
-            G=gethap(cur_cd, family, P, fgl, chr_length, rate)    
+            G=gethap(cur_cd, family, P, fgl, chr_length, rate, rng)    
             cur_cd = G[0]; fgl=G[1]
-        newhap=recomb(cur_cd[P][0], cur_cd[P][1], rate)
+        newhap=recomb(cur_cd[P][0], cur_cd[P][1], rate, rng)
         cur_cd[iid][parent]=newhap
     return([cur_cd, fgl])
 
@@ -91,6 +95,10 @@ if __name__ == '__main__':
             help="Recombination rate per base-pair. Default is 1Mb = 1cM or --bp-to-cM=1000000.")
     parser.add_option("--print-cM", default=False, action="store_true", dest="print_cM", \
             help="Print chromosome diagrams in cM. Not yet implemented.")
+    parser.add_option("--seed", default="", dest="seed", \
+            help="Seed for the simulation. Each chromosome gets its own random stream.")
+    parser.add_option("--cache", default="", dest="cache", \
+            help="Directory of cached results. With --seed, diagrams already simulated for the same inputs are copied from here.")
     (opts, args) = parser.parse_args()
     if (not opts.fam) or opts.chr_lengths=="":
         sys.exit("Usage error. Please give a fam file with --fam and use the --chr-lengths option.")
@@ -100,6 +108,13 @@ if __name__ == '__main__':
     except Exception as e:
         print(e)
         sys.exit("recomb_sim.py died: Error opening input file.")
+    cache = None
+    if opts.cache and opts.seed:
+        cache = ResultCache(opts.cache)
+        key = cache.key("recomb_sim", CACHE_VERSION, [opts.fam, opts.chr_lengths], [opts.seed, opts.cM, opts.bp_cM])
+        if cache.fetch(key, {"diagrams": opts.out}):
+            print("Diagrams copied from the cache: "+key)
+            sys.exit()
     c_lengths=[l.strip() for l in cl]
     cl.close()
     n = len(c_lengths)+1
@@ -120,13 +135,16 @@ if __name__ == '__main__':
     out=open(opts.out, "wt") #FID IID PID MID SEX CHR_ORIGIN CHR CHR_DIAGRAM
     for chr in range(1, n):
         fgl=1 
+        rng = stream(opts.seed, "recomb_sim", chr) if opts.seed else random
         clength=c_lengths[chr-1]
         cur_cd = dict([(i,[[], []] ) for i in iids])
         for i in iids:
-            G=gethap(cur_cd, fam, i, fgl, clength, rate)    
+            G=gethap(cur_cd, fam, i, fgl, clength, rate, rng)    
             cur_cd = G[0]; fgl=G[1]
         for i in iids:
             for X in [0, 1]: #M for maternal chrom. P for paternal chrom
                 P = ["P", "M"][X]
                 out.write(" ".join([info[i][0], i, fam[i][0], fam[i][1], info[i][1], P, str(chr)]+ [str(c) for c in cur_cd[i][X]])+"\n")
     out.close()
+    if cache is not None:
+        cache.store(key, {"diagrams": opts.out})
@@ -0,0 +1,565 @@
+#!/usr/bin/env python
+#Reading reference VCF panels for sim_to_genotypes.py
+#A panel can be read directly from its .vcf.gz or from a compiled cache made by compile_reference.py
+
+import gzip
+import hashlib
+import json
+import os
+import re
+import struct
+import sys
+
+import numpy as np
+
+from bgzf import fetch, index_density, open_vcf, uncompressed_size
+from populations import founder_columns
+from typing import BinaryIO, NamedTuple, Optional, TextIO
+
+COMPILED_VERSION = 2 #Bump when the compiled layout changes
+COMPILED_SUFFIX = ".compiled"
+
+class VcfData(NamedTuple):
+    meta: list[str] #"##" header lines
+    fnames: list[str] #Haplotype names, each sample twice
+    snp_names: list[str] #First 9 columns of each record, tab joined
+    positions: np.ndarray #POS column of each record (int64)
+    cm: Optional[np.ndarray] #Precomputed cM positions, None if not available
+    founder_chunks: list["PackedAlleles"] #Founder alleles (chunk x kept haplotypes)
+    allele_table: list[str] #uint8 code -> allele
+
+class PackedAlleles:
+    """Allele codes for a block of variants x haplotypes stored at 1 bit per allele
+
+    Each variant keeps the codes of its two observed alleles in ref and alt and one
+    bit per haplotype (0 = ref, 1 = alt). Variants with more than two distinct codes
+    among the stored haplotypes (multi-allelic or partly missing sites) are escaped:
+    their full uint8 rows are kept in escape_codes and override the bits on unpack.
+    """
+    def __init__(self, bits, ref, alt, n_haplotypes, escape_rows, escape_codes):
+        self.bits = bits #uint8, variants x ceil(n_haplotypes / 8), see np.packbits
+        self.ref = ref #uint8 code of the 0 allele of each variant
+        self.alt = alt #uint8 code of the 1 allele of each variant
+        self.n_haplotypes = n_haplotypes
+        self.escape_rows = escape_rows #Variant rows that are not biallelic
+        self.escape_codes = escape_codes #uint8, len(escape_rows) x n_haplotypes
+
+    def __len__(self):
+        return len(self.ref)
+
+    @classmethod
+    def pack(cls, codes):
+        """Packs a uint8 code matrix (variants x haplotypes)"""
+        codes = np.asarray(codes, dtype=np.uint8)
+        n, h = codes.shape
+        if h == 0:
+            zero = np.zeros(n, dtype=np.uint8)
+            return cls(np.zeros((n, 0), dtype=np.uint8), zero, zero, 0, np.zeros(0, dtype=np.int64), np.zeros((0, 0), dtype=np.uint8))
+        ref = codes[:, 0]
+        is_alt = codes != ref[:, None]
+        alt = codes[np.arange(n), np.argmax(is_alt, axis=1)] #ref again if every allele is ref
+        escape_rows = np.flatnonzero(np.any(is_alt & (codes != alt[:, None]), axis=1))
+        return cls(np.packbits(is_alt, axis=1), ref, alt, h, escape_rows, codes[escape_rows])
+
+    def unpack(self):
+        """Returns the uint8 code matrix (variants x haplotypes)"""
+        is_alt = np.unpackbits(self.bits, axis=1, count=self.n_haplotypes).astype(bool)
+        codes = np.where(is_alt, self.alt[:, None], self.ref[:, None]).astype(np.uint8)
+        codes[self.escape_rows] = self.escape_codes
+        return codes
+
+    def take_columns(self, columns):
+        """Keeps the given haplotype columns, in that order"""
+        columns = np.asarray(columns, dtype=np.intp)
+        return self.take(np.broadcast_to(columns, (len(self), len(columns))))
+
+    def take(self, hap_index):
+        """Gathers hap_index[v, j] from each variant v without unpacking (variants x new haplotypes)"""
+        hap_index = np.asarray(hap_index, dtype=np.intp)
+        byte = np.take_along_axis(self.bits, hap_index >> 3, axis=1)
+        is_alt = (byte >> (7 - (hap_index & 7)).astype(np.uint8)) & 1
+        escape_codes = np.take_along_axis(self.escape_codes, hap_index[self.escape_rows], axis=1)
+        return PackedAlleles(np.packbits(is_alt, axis=1), self.ref, self.alt, hap_index.shape[1], self.escape_rows, escape_codes)
+
+    def select(self, rows):
+        """Keeps the given variant rows (sorted indices)"""
+        rows = np.asarray(rows, dtype=np.int64)
+        pos = np.searchsorted(rows, self.escape_rows)
+        hit = np.zeros(len(self.escape_rows), dtype=bool)
+        if len(rows):
+            hit = rows[np.minimum(pos, len(rows) - 1)] == self.escape_rows
+        return PackedAlleles(self.bits[rows], self.ref[rows], self.alt[rows], self.n_haplotypes, pos[hit], self.escape_codes[hit])
+
+    def remap(self, lookup):
+        """Translates allele codes through lookup (old code -> new code)"""
+        return PackedAlleles(self.bits, lookup[self.ref], lookup[self.alt], self.n_haplotypes, self.escape_rows, lookup[self.escape_codes])
+
+    @classmethod
+    def hstack(cls, blocks):
+        """Joins blocks over the same variants side by side"""
+        if len(blocks) == 1:
+            return blocks[0]
+        return cls.pack(np.hstack([b.unpack() for b in blocks]))
+
+def encode_alleles(rows, allele_codes, allele_table):
+    """Encodes a chunk of allele strings as a uint8 matrix (variants x founder haplotypes)"""
+    #allele_codes: allele -> code, allele_table: code -> allele
+    #Both are shared between chunks so codes stay stable for the whole chromosome
+    rows = np.asarray(rows)
+    values, inverse = np.unique(rows, return_inverse=True)
+    lookup = np.empty(len(values), dtype=np.uint8)
+    for i, v in enumerate(values.tolist()):
+        if v not in allele_codes:
+            if len(allele_table) == 256:
+                sys.exit("More than 256 distinct alleles found in founder genomes")
+            allele_codes[v] = len(allele_table)
+            allele_table.append(v)
+        lookup[i] = allele_codes[v]
+    return lookup[inverse].reshape(rows.shape)
+
+def extend_allele_table(table, allele_codes, allele_table):
+    """Adds the alleles of one file's table to a merged allele_codes/allele_table. Returns the lookup from file codes to merged codes."""
+    lookup = np.empty(len(table), dtype=np.uint8)
+    for i, a in enumerate(table):
+        if a not in allele_codes:
+            if len(allele_table) == 256:
+                sys.exit("More than 256 distinct alleles found in founder genomes")
+            allele_codes[a] = len(allele_table)
+            allele_table.append(a)
+        lookup[i] = allele_codes[a]
+    return lookup
+
+def merge_allele_tables(tables):
+    """Merges per-file allele tables. Returns (allele_table, lookups) where lookups[i] maps file i codes to merged codes."""
+    allele_codes = {}
+    allele_table = []
+    lookups = [extend_allele_table(table, allele_codes, allele_table) for table in tables]
+    return allele_table, lookups
+
+def read_vcf_header(f: BinaryIO):
+    """Reads up to and including the #CHROM line. Returns ("##" lines, haplotype names)."""
+    meta = []
+    fnames = []
+    for line in f:
+        line = line.decode()
+        if line.startswith("##"):
+            meta.append(line)
+            continue
+        if line.startswith("#"):
+            for i in line.split()[9:]:
+                fnames.append(i)
+                fnames.append(i) # We need to double so we get haplotypes
+            break
+    return meta, fnames
+
+TAB = 9
+NEWLINE = 10
+PIPE = ord("|")
+
+def parse_vcf_chunk(lines, columns, allele_codes, allele_table):
+    """Pulls the alleles of the selected haplotype columns out of a chunk of VCF records
+
+    lines are raw record lines (bytes). columns are haplotype indices (2 * sample + 0/1).
+    Returns (snp_names, positions, matrix) where matrix is uint8 (records x columns).
+    Only the genotype bytes up to the last selected sample are looked at: with phased
+    single-character genotypes every sample field is "a|b" plus a separator, so each
+    allele sits at a fixed offset from the start of the genotype columns. Records that
+    do not fit that layout fall back to splitting the line.
+    """
+    columns = np.asarray(columns, dtype=np.int64)
+    width = 4 * (int(columns.max()) // 2 + 1) if len(columns) else 0 #Bytes covering every selected sample
+    snp_names = []
+    positions = []
+    payload = []
+    for line in lines:
+        parts = line.split(b"\t", 9)
+        positions.append(int(parts[1]))
+        if len(parts) == 10:
+            snp_names.append(line[:len(line) - len(parts[9]) - 1].decode())
+            payload.append(parts[9][:width].ljust(width, b"\0"))
+        else:
+            snp_names.append(line.rstrip().decode())
+            payload.append(b"\0" * width)
+
+    matrix = np.empty((len(lines), len(columns)), dtype=np.uint8)
+    if len(columns) == 0:
+        return snp_names, positions, matrix
+    fields = np.frombuffer(b"".join(payload), dtype=np.uint8).reshape(len(lines), -1, 4)
+    fast = np.all(fields[:, :, 1] == PIPE, axis=1) & \
+        np.all((fields[:, :, 3] == TAB) | (fields[:, :, 3] == NEWLINE) | (fields[:, :, 3] == 0), axis=1)
+
+    if fast.any():
+        alleles = fields.reshape(len(lines), -1)[fast][:, 4 * (columns // 2) + 2 * (columns % 2)]
+        lut = np.zeros(256, dtype=np.uint8)
+        for b in np.unique(alleles).tolist():
+            a = chr(b)
+            if a not in allele_codes:
+                if len(allele_table) == 256:
+                    sys.exit("More than 256 distinct alleles found in founder genomes")
+                allele_codes[a] = len(allele_table)
+                allele_table.append(a)
+            lut[b] = allele_codes[a]
+        matrix[fast] = lut[alleles]
+    slow = np.flatnonzero(~fast)
+    if len(slow):
+        rows = []
+        for i in slow.tolist():
+            fields = lines[i].decode().rstrip().split("\t")[9:]
+            rows.append([re.split(r"[|/]", fields[s])[h] for s, h in zip((columns // 2).tolist(), (columns % 2).tolist())])
+        matrix[slow] = encode_alleles(rows, allele_codes, allele_table)
+    return snp_names, positions, matrix
+
+def iter_vcf_chunks(f: BinaryIO, columns, chunk: int, allele_codes, allele_table):
+    """Yields (snp_names, positions, matrix) for each chunk of records after the header"""
+    lines = []
+    for line in f:
+        if line.startswith(b"#"):
+            continue
+        lines.append(line)
+        if len(lines) == chunk:
+            yield parse_vcf_chunk(lines, columns, allele_codes, allele_table)
+            lines = []
+    if lines:
+        yield parse_vcf_chunk(lines, columns, allele_codes, allele_table)
+
+def kept_names(fnames, columns, populations):
+    """fnames of a panel as VcfData holds them: all of them, or only the kept columns' with populations"""
+    return fnames if populations is None else [fnames[c] for c in columns]
+
+def read_vcf(f: BinaryIO, max_haplotypes: int, chunk: int, records=None, populations=None) -> VcfData:
+    """Reads a reference VCF (opened in binary mode) in a single pass
+
+    Collects the header, haplotype names, fixed columns and positions, and the
+    alleles of the first max_haplotypes haplotypes encoded chunk by chunk.
+    records (record lines, e.g. from bgzf.fetch) are read instead of the rest of f.
+    With populations (see populations.founder_columns) only their founders are
+    decoded and fnames holds just their names.
+    """
+    meta, fnames = read_vcf_header(f)
+    columns = founder_columns(fnames, max_haplotypes, populations)
+    allele_codes = {}; allele_table = []
+    snp_names = []
+    positions = []
+    founder_chunks = []
+    records = f if records is None else records
+    for names_chunk, pos_chunk, matrix in iter_vcf_chunks(records, columns, chunk, allele_codes, allele_table):
+        snp_names.extend(names_chunk)
+        positions.extend(pos_chunk)
+        founder_chunks.append(PackedAlleles.pack(matrix))
+    positions = np.array(positions, dtype=np.int64)
+    return VcfData(meta, kept_names(fnames, columns, populations), snp_names, positions, None, founder_chunks, allele_table)
+
+def read_bgl(f: TextIO, max_haplotypes: int, chunk: int) -> VcfData:
+    """Reads a phased BGL file (I rsid hap1 hap2 ... / M rsid a1 a2 ...) into the form read_vcf returns
+
+    snp_names holds the rsids. BGL files have no positions or header lines, so
+    positions and meta are empty and cM positions come from a separate map file.
+    """
+    fnames = f.readline().split()[2:] #List of haplotype names in this file
+    n = min(len(fnames), max_haplotypes)
+    allele_codes = {}; allele_table = []
+    snp_names = []
+    founder_chunks = []
+    rows = []
+    for line in f:
+        l = line.split()
+        snp_names.append(l[1])
+        rows.append(l[2:2+n])
+        if len(rows) == chunk:
+            founder_chunks.append(PackedAlleles.pack(encode_alleles(rows, allele_codes, allele_table)))
+            rows = []
+    if rows:
+        founder_chunks.append(PackedAlleles.pack(encode_alleles(rows, allele_codes, allele_table)))
+    return VcfData([], fnames, snp_names, np.zeros(0, dtype=np.int64), None, founder_chunks, allele_table)
+
+class VcfStream:
+    """A reference VCF read one chunk at a time instead of all at once as by read_vcf
+
+    The header is read on opening. chunks() yields (snp_names, positions, PackedAlleles)
+    for each chunk of records and closes the file at the end. allele_table grows as
+    new alleles are seen. region (chrom, start, end) reads only those records.
+    threads decompress a BGZF file, see bgzf.open_vcf. populations as read_vcf.
+    """
+    def __init__(self, path, max_haplotypes: int, chunk: int, region=None, threads=1, populations=None):
+        self.f = open_vcf(path, threads)
+        self.meta, fnames = read_vcf_header(self.f)
+        self.columns = founder_columns(fnames, max_haplotypes, populations)
+        self.fnames = kept_names(fnames, self.columns, populations)
+        self.chunk = chunk
+        self.records = self.f if region is None else region_records(path, self.f, region)
+        self.allele_codes = {}; self.allele_table = []
+
+    def chunks(self):
+        try:
+            for names_chunk, pos_chunk, matrix in iter_vcf_chunks(self.records, self.columns, self.chunk, self.allele_codes, self.allele_table):
+                yield names_chunk, np.array(pos_chunk, dtype=np.int64), PackedAlleles.pack(matrix)
+        finally:
+            self.f.close()
+
+class BglStream:
+    """A phased BGL file read one chunk at a time, see VcfStream. BGL files have no positions, so those are None."""
+    def __init__(self, path, max_haplotypes: int, chunk: int):
+        self.f = gzip.open(path, "rt")
+        self.meta = []
+        self.fnames = self.f.readline().split()[2:]
+        self.n = min(len(self.fnames), max_haplotypes)
+        self.chunk = chunk
+        self.allele_codes = {}; self.allele_table = []
+
+    def chunks(self):
+        try:
+            snp_names = []
+            rows = []
+            for line in self.f:
+                l = line.split()
+                snp_names.append(l[1])
+                rows.append(l[2:2+self.n])
+                if len(rows) == self.chunk:
+                    yield snp_names, None, PackedAlleles.pack(encode_alleles(rows, self.allele_codes, self.allele_table))
+                    snp_names = []
+                    rows = []
+            if rows:
+                yield snp_names, None, PackedAlleles.pack(encode_alleles(rows, self.allele_codes, self.allele_table))
+        finally:
+            self.f.close()
+
+def select_variants(data: VcfData, keep) -> VcfData:
+    """Drops the variants of data where the boolean mask keep is False"""
+    keep = np.asarray(keep, dtype=bool)
+    if len(keep) != len(data.snp_names):
+        sys.exit("Variant mask has "+str(len(keep))+" sites but the panel has "+str(len(data.snp_names)))
+    founder_chunks = []
+    start = 0
+    for block in data.founder_chunks:
+        stop = start + len(block)
+        rows = np.flatnonzero(keep[start:stop])
+        if len(rows):
+            founder_chunks.append(block.select(rows))
+        start = stop
+    snp_names = [n for n, k in zip(data.snp_names, keep.tolist()) if k]
+    cm = data.cm[keep] if data.cm is not None else None
+    return VcfData(data.meta, data.fnames, snp_names, data.positions[keep], cm, founder_chunks, data.allele_table)
+
+##Compiled panels
+#A compiled panel for ref.vcf.gz lives in ref.vcf.gz.compiled/ and holds:
+#  panel.json      source checksum, size and mtime, header, haplotype names, allele table, shape
+#  haplotypes.bits PackedAlleles bits, variants x ceil(haplotypes / 8), row major (memory-mapped on load)
+#  escapes.u8      full uint8 code rows of the escaped (not biallelic) variants (memory-mapped on load)
+#  variants.npz    pos (int64), cm (float64, computed with bp_cm_map from panel.json),
+#                  ref and alt codes of every variant and the rows of the escaped variants
+#  fixed.txt       first 9 columns of each record, tab joined (ID, REF and ALT included)
+
+def file_checksum(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def compiled_dir(path):
+    return path+COMPILED_SUFFIX
+
+def read_compiled_info(path):
+    """Returns panel.json of the compiled cache for path if it is current, otherwise None"""
+    info_file = os.path.join(compiled_dir(path), "panel.json")
+    if not os.path.exists(info_file):
+        return None
+    with open(info_file, "rt") as inp:
+        info = json.load(inp)
+    if info.get("version") != COMPILED_VERSION:
+        return None
+    st = os.stat(path)
+    if info["size"] == st.st_size and info["mtime"] == st.st_mtime:
+        return info
+    #Touched or copied: only trust the cache if the contents are unchanged
+    if info["size"] == st.st_size and info["sha256"] == file_checksum(path):
+        return info
+    return None
+
+def compile_vcf(path, bptm=1000000, chunk=10000, force=False, threads=1):
+    """Compiles a gzipped reference VCF into a memory-mappable cache. Returns the cache directory."""
+    out_dir = compiled_dir(path)
+    if not force and read_compiled_info(path) is not None:
+        return out_dir
+    os.makedirs(out_dir, exist_ok=True)
+    if os.path.exists(os.path.join(out_dir, "panel.json")):
+        os.remove(os.path.join(out_dir, "panel.json"))
+    st = os.stat(path)
+    checksum = file_checksum(path)
+    allele_codes = {}; allele_table = []
+    positions = []
+    ref = []; alt = []; escape_rows = []
+    n_variants = 0
+    with open_vcf(path, threads) as inp, \
+            open(os.path.join(out_dir, "haplotypes.bits"), "wb") as haps, \
+            open(os.path.join(out_dir, "escapes.u8"), "wb") as escapes, \
+            open(os.path.join(out_dir, "fixed.txt"), "wt") as fixed:
+        meta, fnames = read_vcf_header(inp)
+        for names_chunk, pos_chunk, matrix in iter_vcf_chunks(inp, range(len(fnames)), chunk, allele_codes, allele_table):
+            packed = PackedAlleles.pack(matrix)
+            packed.bits.tofile(haps)
+            packed.escape_codes.tofile(escapes)
+            ref.append(packed.ref); alt.append(packed.alt)
+            escape_rows.append(packed.escape_rows + n_variants)
+            fixed.write("\n".join(names_chunk)+"\n")
+            positions.extend(pos_chunk)
+            n_variants += len(matrix)
+    positions = np.array(positions, dtype=np.int64)
+    cm = positions/bptm if bptm else positions.astype(np.float64)
+    empty_u8 = np.zeros(0, dtype=np.uint8)
+    np.savez(os.path.join(out_dir, "variants.npz"), pos=positions, cm=cm,
+             ref=np.concatenate(ref + [empty_u8]), alt=np.concatenate(alt + [empty_u8]),
+             escape_rows=np.concatenate(escape_rows + [np.zeros(0, dtype=np.int64)]))
+    info = {"version": COMPILED_VERSION, "source": os.path.basename(path), "size": st.st_size,
+            "mtime": st.st_mtime, "sha256": checksum, "n_variants": n_variants,
+            "n_haplotypes": len(fnames), "bp_cm_map": bptm, "meta": meta, "fnames": fnames,
+            "allele_table": allele_table}
+    #panel.json is written last so an interrupted compile is never picked up
+    with open(os.path.join(out_dir, "panel.json"), "wt") as out:
+        json.dump(info, out)
+    return out_dir
+
+GZIP_RATIO = 10 #Rough compression ratio, used to undo the 4GB wraparound of a plain gzip size field
+SAMPLE_LINES = 1000 #Lines read to estimate the length of a record
+
+def panel_dimensions(path):
+    """Returns (variants, haplotypes) of a reference VCF. Exact if compiled, otherwise estimated from the file size."""
+    info = read_compiled_info(path)
+    if info is not None:
+        return info["n_variants"], info["n_haplotypes"]
+    with gzip.open(path, "rb") as inp:
+        meta, fnames = read_vcf_header(inp)
+        header_end = inp.tell()
+        lengths = [len(line) for _, line in zip(range(SAMPLE_LINES), inp)]
+    if not lengths:
+        return 0, len(fnames)
+    size = uncompressed_size(path)
+    if size is None:
+        #The gzip trailer holds the size modulo 2^32
+        with open(path, "rb") as f:
+            f.seek(-4, 2)
+            isize = struct.unpack("<I", f.read(4))[0]
+        size = isize + max(0, round((os.path.getsize(path) * GZIP_RATIO - isize) / 2**32)) * 2**32
+    return max(len(lengths), int((size - header_end) / np.mean(lengths))), len(fnames)
+
+def open_memmap_or_empty(path, shape):
+    #np.memmap cannot map an empty file
+    if shape[0] * shape[1] == 0:
+        return np.zeros(shape, dtype=np.uint8)
+    return np.memmap(path, dtype=np.uint8, mode="r", shape=shape)
+
+def load_compiled(path, max_haplotypes: int, chunk: int, bptm: int, region=None, populations=None) -> Optional[VcfData]:
+    """Memory-maps the compiled cache for path. Returns None if there is no current cache.
+
+    region (start, end) keeps only the variants with POS in that range (1-based, inclusive).
+    populations as read_vcf: their founders' bits are gathered from each chunk.
+    """
+    info = read_compiled_info(path)
+    if info is None:
+        return None
+    cache = compiled_dir(path)
+    n_variants, n_haplotypes = info["n_variants"], info["n_haplotypes"]
+    variants = np.load(os.path.join(cache, "variants.npz"))
+    escape_rows = variants["escape_rows"]
+    haps = open_memmap_or_empty(os.path.join(cache, "haplotypes.bits"), (n_variants, (n_haplotypes + 7) // 8))
+    escapes = open_memmap_or_empty(os.path.join(cache, "escapes.u8"), (len(escape_rows), n_haplotypes))
+    #Only the first keep haplotypes are used: their bits are a prefix of each row
+    keep = min(n_haplotypes, max_haplotypes)
+    columns = None if populations is None else founder_columns(info["fnames"], max_haplotypes, populations)
+    lo, hi = 0, n_variants
+    if region is not None:
+        lo = int(np.searchsorted(variants["pos"], region[0], side="left"))
+        hi = int(np.searchsorted(variants["pos"], region[1], side="right"))
+    founder_chunks = []
+    for i in range(lo, hi, chunk):
+        i_end = min(i + chunk, hi)
+        e_lo, e_hi = np.searchsorted(escape_rows, [i, i_end])
+        if columns is not None:
+            founder_chunks.append(PackedAlleles(haps[i:i_end], variants["ref"][i:i_end], variants["alt"][i:i_end], n_haplotypes,
+                                                escape_rows[e_lo:e_hi] - i, escapes[e_lo:e_hi]).take_columns(columns))
+            continue
+        founder_chunks.append(PackedAlleles(haps[i:i_end, :(keep + 7) // 8], variants["ref"][i:i_end],
+                                            variants["alt"][i:i_end], keep, escape_rows[e_lo:e_hi] - i, escapes[e_lo:e_hi, :keep]))
+    cm = variants["cm"][lo:hi] if info["bp_cm_map"] == bptm else None
+    with open(os.path.join(cache, "fixed.txt"), "rt") as inp:
+        snp_names = inp.read().splitlines()[lo:hi]
+    return VcfData(info["meta"], kept_names(info["fnames"], columns, populations), snp_names, variants["pos"][lo:hi], cm, founder_chunks, info["allele_table"])
+
+def load_region(path, max_haplotypes: int, chunk: int, bptm: int, region, threads=1, populations=None) -> VcfData:
+    """Reads the variants of path on chrom with POS in [start, end], region = (chrom, start, end)
+
+    Uses the compiled cache if there is one, then a .tbi or .csi index, and
+    otherwise reads through the whole file. populations as read_vcf.
+    """
+    chrom, start, end = region
+    data = load_compiled(path, max_haplotypes, chunk, bptm, (start, end), populations)
+    if data is not None:
+        if data.snp_names and data.snp_names[0].split("\t", 1)[0].removeprefix("chr") != chrom.removeprefix("chr"):
+            return select_variants(data, np.zeros(len(data.snp_names), dtype=bool))
+        return data
+    with open_vcf(path, threads) as f:
+        return read_vcf(f, max_haplotypes, chunk, region_records(path, f, region), populations)
+
+def load_panel(path, max_haplotypes: int, chunk: int, bptm: int, keep=None, region=None, threads=1, populations=None) -> VcfData:
+    """Reads a reference VCF the way sim_to_genotypes.py uses it
+
+    Only the region (chrom, start, end) if given, through the compiled cache when
+    it is current, and without the variants where the mask keep is False.
+    """
+    if region is not None:
+        data = load_region(path, max_haplotypes, chunk, bptm, region, threads, populations)
+    else:
+        data = load_compiled(path, max_haplotypes, chunk, bptm, None, populations)
+        if data is None:
+            with open_vcf(path, threads) as f:
+                data = read_vcf(f, max_haplotypes, chunk, None, populations)
+    if keep is not None:
+        data = select_variants(data, keep)
+    return data
+
+def region_records(path, f: BinaryIO, region):
+    """Record lines of path on chrom with POS in [start, end], region = (chrom, start, end)
+
+    Read through a .tbi or .csi index if there is one, otherwise filtered from the
+    rest of f (path opened in binary mode) as it is read.
+    """
+    chrom, start, end = region
+    records = fetch(path, chrom, start, end)
+    if records is None:
+        print("No .tbi or .csi index for "+path+". Reading the whole file for the region.")
+        chrom = chrom.removeprefix("chr").encode()
+        records = (l for l in f if not l.startswith(b"#") and l.split(b"\t", 1)[0].removeprefix(b"chr") == chrom
+                   and start <= int(l.split(b"\t", 2)[1]) <= end)
+    return records
+
+def shard_regions(path, chrom, n, threads=1):
+    """Splits chrom into n contiguous (chrom, start, end) regions holding about as many variants of path each
+
+    The regions cover the whole chromosome, the last one running to 2**31 - 1.
+    Variant positions come from the compiled cache if there is one. Otherwise a
+    .tbi or .csi index gives how the compressed records are spread, and without
+    either the positions are read from the file.
+    """
+    info = read_compiled_info(path)
+    density = None if info is not None else index_density(path, chrom)
+    if info is not None:
+        with np.load(os.path.join(compiled_dir(path), "variants.npz")) as variants:
+            positions = variants["pos"]
+        weights = np.arange(len(positions))
+    elif density:
+        positions, weights = density
+    else:
+        chrom_key = chrom.removeprefix("chr").encode()
+        with open_vcf(path, threads) as f:
+            positions = np.array([int(l.split(b"\t", 2)[1]) for l in f
+                                  if not l.startswith(b"#") and l.split(b"\t", 1)[0].removeprefix(b"chr") == chrom_key], dtype=np.int64)
+        weights = np.arange(len(positions))
+    bounds = [1]
+    for k in range(1, n):
+        start = bounds[-1] + 1
+        if len(positions):
+            target = weights[0] + (weights[-1] - weights[0]) * k / n
+            start = max(start, int(positions[min(len(positions) - 1, np.searchsorted(weights, target))]))
+        bounds.append(start)
+    bounds.append(2**31)
+    return [(chrom, bounds[k], bounds[k + 1] - 1) for k in range(n)]
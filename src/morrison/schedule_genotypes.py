@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+#Runs sim_to_genotypes.py for each chromosome within a memory budget
+#Jobs are started largest first, as many at a time as fit in --mem and --cores
+
+import os
+import subprocess
+import sys
+import time
+
+from bgzf import concat_vcfs
+from plink_bed import concat_beds
+from reference_panel import panel_dimensions
+
+#Peak memory model, fit to measured runs of sim_to_genotypes.py on VCF panels
+BASE_BYTES = 50 * 2**20 #Interpreter, numpy and output buffers
+VARIANT_BYTES = 250 #Per variant for the whole chromosome: fixed columns, positions, cM
+PANEL_HAP_BYTES = 1.6 #Per panel haplotype and variant in a chunk: raw lines and parsed alleles
+INDIVIDUAL_BYTES = 67 #Per simulated individual and variant in a chunk: formatted genotypes
+STREAM_VARIANT_BYTES = 9 #Per variant for the whole chromosome with --stream: the QC mask and its positions
+SAFETY = 1.25
+
+POLL_SECONDS = 0.2 #How often running jobs are checked
+
+def estimate_memory(n_variants, n_panel_haplotypes, n_individuals, chunk, stream=False):
+    """Estimated peak bytes for one chromosome"""
+    whole = n_variants * (VARIANT_BYTES + n_individuals / 4) #Founders are kept bit-packed
+    if stream:
+        whole = n_variants * STREAM_VARIANT_BYTES #Only one chunk of the panel is held at a time
+    per_chunk = min(chunk, n_variants) * (PANEL_HAP_BYTES * n_panel_haplotypes + INDIVIDUAL_BYTES * n_individuals)
+    return int(SAFETY * (BASE_BYTES + whole + per_chunk))
+
+def count_individuals(diagram, chrom):
+    """Number of simulated individuals in a diagram file for one chromosome"""
+    n = 0
+    with open(diagram, "rt") as inp:
+        for line in inp:
+            l = line.split(None, 7)
+            if len(l) > 6 and l[6] == chrom:
+                n += 1
+    return n // 2 #One line per haplotype
+
+def available_memory():
+    """MemAvailable from /proc/meminfo in bytes, or None where it is not available"""
+    try:
+        with open("/proc/meminfo", "rt") as inp:
+            for line in inp:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def parse_chromosomes(spec):
+    """'1-22' or '1,2,X' -> list of chromosome names"""
+    chroms = []
+    for part in spec.split(","):
+        if "-" in part:
+            start, stop = part.split("-")
+            chroms.extend(str(c) for c in range(int(start), int(stop) + 1))
+        elif part:
+            chroms.append(part)
+    return chroms
+
+def shard_name(paths, k):
+    """out.chr1.vcf.gz -> out.chr1.shard2.vcf.gz, prefix -> prefix.shard2, for each entry of a comma separated list"""
+    names = []
+    for path in paths.split(","):
+        base, vcf, ext = path.rpartition(".vcf")
+        names.append(base+".shard"+str(k)+vcf+ext if vcf else path+".shard"+str(k))
+    return ",".join(names)
+
+def join_shards(out, write, bed, n_shards):
+    """Joins the outputs of the shards of one chromosome (comma separated batch entries) and removes them"""
+    for path in out.split(","):
+        parts = [shard_name(path, k) for k in range(1, n_shards + 1)]
+        concat_vcfs(parts, path)
+        for part in parts:
+            for f in (part, part+".tbi"):
+                if os.path.exists(f):
+                    os.remove(f)
+    for prefix in bed.split(",") if bed else []:
+        parts = [shard_name(prefix, k) for k in range(1, n_shards + 1)]
+        concat_beds(parts, prefix)
+        for part in parts:
+            for ext in (".bed", ".bim", ".fam"):
+                os.remove(part+ext)
+    #Every shard picks the same founders, so any names file will do
+    for path in write.split(",") if write else []:
+        os.replace(shard_name(path, 1), path)
+        for k in range(2, n_shards + 1):
+            os.remove(shard_name(path, k))
+
+def run_jobs(jobs, budget, cores):
+    """Runs (name, command, memory) jobs largest first. Returns names of failed jobs."""
+    pending = sorted(jobs, key=lambda j: j[2], reverse=True)
+    running = {} #Popen -> job
+    used = 0
+    failed = []
+    while pending or running:
+        #Start every pending job that fits. A job larger than the whole budget runs alone.
+        for job in list(pending):
+            if failed or len(running) >= cores:
+                break
+            if used + job[2] <= budget or not running:
+                if job[2] > budget:
+                    print("Warning: chromosome "+job[0]+" needs about "+str(job[2] // 2**20)+"MB, more than --mem. Running it alone.")
+                pending.remove(job)
+                running[subprocess.Popen(job[1])] = job
+                used += job[2]
+        if not running:
+            break
+        #Polled through the Popen handles, which reap their own processes
+        finished = [proc for proc in running if proc.poll() is not None]
+        if not finished:
+            time.sleep(POLL_SECONDS)
+        for proc in finished:
+            job = running.pop(proc)
+            used -= job[2]
+            if proc.returncode != 0:
+                print("Job for chromosome "+job[0]+" failed with exit status "+str(proc.returncode))
+                failed.append(job[0])
+    return failed
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+
+    parser = OptionParser(usage = "%prog [options] -s simulated_data.txt -m data.map --out=out.chr{chr}.vcf.gz ref.chr{chr}.vcf.gz ...\n")
+    parser.add_option("-s", "--simulation", default="", dest="s", help="Chromosome diagram output from recomb_sim.py. (required) A comma separated list runs the pedigrees as one batch per chromosome; --out, --write-names and --bed then take one entry per file.")
+    parser.add_option("-m", "--map", default="", dest="m", help="Map file passed to sim_to_genotypes.py. (required)")
+    parser.add_option("--out", dest="out", default="", help="Output file name with {chr} in place of the chromosome. (required)")
+    parser.add_option("--write-names", default="", dest="write", help="Names file with {chr} in place of the chromosome.")
+    parser.add_option("--bed", default="", dest="bed", help="PLINK .bed/.bim/.fam prefix with {chr} in place of the chromosome.")
+    parser.add_option("--extract", default="", dest="extract", help="Passed to sim_to_genotypes.py: only simulate variants in this .bim file.")
+    parser.add_option("--frq", default="", dest="frq", help="Passed to sim_to_genotypes.py: .frq file consulted by --maf.")
+    parser.add_option("--maf", default=0.0, type="float", dest="maf", help="Passed to sim_to_genotypes.py: minimum panel minor allele frequency.")
+    parser.add_option("--geno", default=1.0, type="float", dest="geno", help="Passed to sim_to_genotypes.py: maximum fraction of missing alleles in the panel.")
+    parser.add_option("--chr", dest="c", default="1-22", help="Chromosomes to run, e.g. 1-22 or 1,2,X. Default is 1-22.")
+    parser.add_option("--chunk", default=10000, type="int", dest="chunk", help="Number of SNPs per chunk to process.")
+    parser.add_option("--population", default="", dest="population", help="Passed to sim_to_genotypes.py: founder populations in a combined panel, e.g. CEU+TSI.")
+    parser.add_option("--seed", default="", dest="seed", help="Passed to sim_to_genotypes.py: seed for picking founders. The founders depend only on the seed and the contents of the diagram file, so identical diagram files get identical founders; give replicates different seeds.")
+    parser.add_option("--cache", default="", dest="cache", help="Passed to sim_to_genotypes.py: directory of cached seeded results.")
+    parser.add_option("--stream", action="store_true", default=False, dest="stream", help="Passed to sim_to_genotypes.py: read the genotype files a chunk at a time.")
+    parser.add_option("--workers", default=1, type="int", dest="workers", help="Passed to sim_to_genotypes.py: processes per chromosome, each counted against --cores.")
+    parser.add_option("--shards", default=1, type="int", dest="shards", help="Split each chromosome into this many regions with about as many variants each, run them as separate jobs and join the outputs. Needs --seed and an --out ending in .gz.")
+    parser.add_option("--mem", default=0, type="float", dest="mem", help="Memory budget in GB. Default is the memory currently available.")
+    parser.add_option("--cores", default=0, type="int", dest="cores", help="Maximum number of chromosomes run at once, times --workers. Default is the number of CPUs.")
+    (opts, args) = parser.parse_args()
+
+    if not (opts.s and opts.m and opts.out) or len(args) == 0:
+        sys.exit("Improper usage. --simulation, --map, --out and at least one reference file are required. Use -h for help.")
+    budget = int(opts.mem * 2**30) if opts.mem else available_memory()
+    if budget is None:
+        sys.exit("Could not read available memory. Set --mem.")
+    if opts.shards > 1 and not (opts.seed and all(o.endswith(".gz") for o in opts.out.split(","))):
+        sys.exit("--shards needs --seed and an --out ending in .gz")
+    cores = opts.cores or os.cpu_count() or 1
+
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sim_to_genotypes.py")
+    jobs = []
+    for chrom in parse_chromosomes(opts.c):
+        refs = [a.replace("{chr}", chrom) for a in args]
+        for ref in refs:
+            if not os.path.exists(ref):
+                sys.exit("Failed to open "+ref)
+        n_individuals = sum(count_individuals(s, chrom) for s in opts.s.split(","))
+        n_variants, n_haplotypes = 0, 0
+        for ref in refs:
+            v, h = panel_dimensions(ref)
+            n_variants = max(n_variants, v)
+            n_haplotypes += h
+        out, write, bed = (o.replace("{chr}", chrom) for o in (opts.out, opts.write, opts.bed))
+        command = [sys.executable, script, "--mode=IBD", "--chr="+chrom, "--simulation="+opts.s, "--map="+opts.m, "--chunk="+str(opts.chunk), "--gzip"]
+        if opts.extract:
+            command.append("--extract="+opts.extract)
+        if opts.frq:
+            command.append("--frq="+opts.frq)
+        command += ["--maf="+str(opts.maf), "--geno="+str(opts.geno)]
+        if opts.population:
+            command.append("--population="+opts.population)
+        if opts.seed:
+            command.append("--seed="+opts.seed)
+        if opts.cache:
+            command.append("--cache="+opts.cache)
+        if opts.stream:
+            command.append("--stream")
+        if opts.workers > 1:
+            command.append("--workers="+str(opts.workers))
+        if opts.shards <= 1:
+            outputs = ["--out="+out] + (["--write-names="+write] if write else []) + (["--bed="+bed] if bed else [])
+            jobs.append((chrom, command + outputs + refs, estimate_memory(n_variants, n_haplotypes, n_individuals, opts.chunk, opts.stream)))
+            continue
+        memory = estimate_memory(-(-n_variants // opts.shards), n_haplotypes, n_individuals, opts.chunk, opts.stream)
+        for k in range(1, opts.shards + 1):
+            outputs = ["--shard="+str(k)+"/"+str(opts.shards), "--out="+shard_name(out, k)]
+            outputs += (["--write-names="+shard_name(write, k)] if write else []) + (["--bed="+shard_name(bed, k)] if bed else [])
+            jobs.append((chrom+" shard "+str(k), command + outputs + refs, memory))
+
+    print("Running "+str(len(jobs))+" jobs with "+str(budget // 2**20)+"MB and "+str(cores)+" cores")
+    failed = run_jobs(jobs, budget, max(1, cores // max(1, opts.workers)))
+    if failed:
+        sys.exit("sim_to_genotypes.py failed for chromosome(s) "+", ".join(failed))
+    if opts.shards > 1:
+        for chrom in parse_chromosomes(opts.c):
+            join_shards(*(o.replace("{chr}", chrom) for o in (opts.out, opts.write, opts.bed)), opts.shards)
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+#numpy arrays in one multiprocessing.shared_memory block
+#The block is created by one process and attached by name from others, so arrays such as a chunk of
+#founder haplotypes reach worker processes without being pickled or copied
+
+import numpy as np
+
+from multiprocessing import resource_tracker, shared_memory
+
+ALIGN = 64 #Arrays start on cache line boundaries
+
+def start_tracker():
+    """Starts the resource tracker, so worker processes started afterwards share it with this one
+
+    Otherwise a worker that attaches a block gets its own tracker, which warns
+    about the block and unlinks it when the worker exits.
+    """
+    resource_tracker.ensure_running()
+
+class SharedArrays:
+    """Named arrays laid out back to back in a SharedMemory block
+
+    arrays maps each name to an ndarray on the block. spec() is what another
+    process passes to attach() to get the same arrays. Views must be dropped
+    before close(); the creator unlinks the block when every process is done.
+    """
+    def __init__(self, block, layout):
+        self.block = block
+        self.layout = layout #[(name, shape, dtype, offset)]
+        self.arrays = {name: np.ndarray(shape, dtype=dtype, buffer=block.buf, offset=offset) for name, shape, dtype, offset in layout}
+
+    @classmethod
+    def create(cls, shapes):
+        """shapes: [(name, shape, dtype)]. The arrays are not initialised."""
+        layout = []
+        size = 0
+        for name, shape, dtype in shapes:
+            shape = tuple(int(s) for s in shape)
+            dtype = np.dtype(dtype)
+            layout.append((name, shape, dtype.str, size))
+            size += -(-int(np.prod(shape)) * dtype.itemsize // ALIGN) * ALIGN
+        return cls(shared_memory.SharedMemory(create=True, size=max(size, 1)), layout)
+
+    @classmethod
+    def attach(cls, spec, own_tracker=False):
+        """own_tracker: this process was not started by the creator, so does not share its resource tracker"""
+        name, layout = spec
+        try:
+            block = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            #Before Python 3.13 attaching registers the block with the resource tracker again,
+            #which is harmless when the tracker is shared with the creator (see start_tracker)
+            block = shared_memory.SharedMemory(name=name)
+            if own_tracker:
+                #Otherwise this process's tracker unlinks the block when the process exits
+                resource_tracker.unregister(block._name, "shared_memory")
+        return cls(block, layout)
+
+    def spec(self):
+        return self.block.name, self.layout
+
+    def close(self, unlink=False):
+        self.arrays = {}
+        self.block.close()
+        if unlink:
+            self.block.unlink()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+#Seeded random streams and an on-disk cache of simulation results
+#With --seed every stage draws from its own stream per chromosome, so a chromosome's result does not
+#depend on which other chromosomes or pedigrees are simulated with it. Seeded results are stored under
+#a key hashing the seed, the contents of the input files and the options that change the output, and
+#are copied back instead of being simulated again on a rerun.
+
+import hashlib
+import json
+import os
+import random
+import shutil
+
+def stream(seed, *parts):
+    """Independent random.Random for one seed and stage, e.g. stream(seed, "recomb_sim", chrom)"""
+    key = json.dumps([str(seed)] + [str(p) for p in parts])
+    return random.Random(int.from_bytes(hashlib.sha256(key.encode()).digest()[:8], "little"))
+
+def file_digest(path):
+    """sha256 of the contents of a file"""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+class ResultCache:
+    """Results of simulation stages stored under root/<stage>/<key>/
+
+    Each entry holds one file per output role (e.g. "out", "out.tbi", "names") and
+    entry.json listing them. Entries are written to a temporary directory and
+    renamed into place, so jobs sharing a cache never see a partial entry.
+    """
+    def __init__(self, root):
+        self.root = root
+
+    def digest(self, path):
+        """file_digest, remembered by path, size and mtime so large panels are only read once"""
+        st = os.stat(path)
+        memo = os.path.join(self.root, "digests", hashlib.sha1(os.path.abspath(path).encode()).hexdigest()+".json")
+        if os.path.exists(memo):
+            with open(memo, "rt") as inp:
+                info = json.load(inp)
+            if info["size"] == st.st_size and info["mtime"] == st.st_mtime:
+                return info["sha256"]
+        info = {"path": os.path.abspath(path), "size": st.st_size, "mtime": st.st_mtime, "sha256": file_digest(path)}
+        os.makedirs(os.path.dirname(memo), exist_ok=True)
+        tmp = memo+"."+str(os.getpid())
+        with open(tmp, "wt") as out:
+            json.dump(info, out)
+        os.replace(tmp, memo)
+        return info["sha256"]
+
+    def key(self, stage, version, inputs, options):
+        """Key for a stage's result. inputs: files whose contents matter ("" for unused), options: JSON-able settings"""
+        parts = [stage, version, [self.digest(p) if p else "" for p in inputs], options]
+        return stage+"/"+hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()[:32]
+
+    def fetch(self, key, outputs):
+        """Copies a stored result to outputs (role -> path). Returns False if it is not stored."""
+        entry = os.path.join(self.root, key)
+        try:
+            with open(os.path.join(entry, "entry.json"), "rt") as inp:
+                roles = json.load(inp)["roles"]
+        except (OSError, ValueError):
+            return False
+        if any(role not in roles for role in outputs):
+            return False
+        for role, path in outputs.items():
+            shutil.copyfile(os.path.join(entry, role), path)
+        return True
+
+    def store(self, key, outputs):
+        """Stores the files in outputs (role -> path) as the result for key"""
+        entry = os.path.join(self.root, key)
+        tmp = entry+".tmp"+str(os.getpid())
+        try:
+            os.makedirs(tmp)
+            for role, path in outputs.items():
+                shutil.copyfile(path, os.path.join(tmp, role))
+            with open(os.path.join(tmp, "entry.json"), "wt") as out:
+                json.dump({"roles": sorted(outputs)}, out)
+            if os.path.exists(entry):
+                shutil.rmtree(entry, ignore_errors=True)
+            os.rename(tmp, entry)
+        except OSError as e:
+            print("Could not cache "+key+": "+str(e))
+            shutil.rmtree(tmp, ignore_errors=True)
@@ -4,80 +4,710 @@
 #Modified May 17 to output names of founders used for each FGL
 
 import gzip
+import multiprocessing
+import random
 import sys
-import re
 
-from typing import TextIO
+import numpy as np
+
+from typing import NamedTuple
 from enum import Enum
+from itertools import islice, zip_longest
+
+from bgzf import BgzfWriter, TabixIndex, parse_region
+from pipeline import WriterThread, read_ahead
+from plink_bed import BedWriter, write_fam
+from populations import DEFAULT_POPULATION_FILE, parse_population_spec
+from panel_server import DEFAULT_SOCKET, fetch_panel
+from reference_panel import BglStream, PackedAlleles, VcfStream, extend_allele_table, load_panel, merge_allele_tables, read_bgl, shard_regions
+from schedule_genotypes import parse_chromosomes
+from shared_arrays import SharedArrays, start_tracker
+from sim_cache import ResultCache, file_digest, stream
+from variant_qc import keep_mask
+
+CACHE_VERSION = 2 #Bump when the genotypes for a seed change
 
 class FileFormat(Enum):
     VCF = 1
     BGL = 2
 
+def diagram_to_arrays(chrom):
+    #chrom: [fgl1, stop1, fgl2, stop2, ...]
+    #Returns (fgls, stops) as int32 and float64 arrays
+    fgls = np.array([int(x) for x in chrom[0::2]], dtype=np.int32)
+    stops = np.array([float(x) for x in chrom[1::2]], dtype=np.float64)
+    return fgls, stops
+
+class SegmentCursor:
+    """Walks one simulated haplotype's chromosome diagram from chunk to chunk
+
+    The cursor remembers the segment covering the last position it was asked
+    about, so each chunk only searches the segments that remain and the whole
+    chromosome is translated in one forward sweep whatever the chunk size.
+    """
+    def __init__(self, chrom):
+        self.fgls, self.stops = diagram_to_arrays(chrom)
+        self.seg = 0 #Segment covering the last position seen
+
+    def advance(self, cm):
+        """Returns the fgl covering each position in cm. Positions must not decrease between calls."""
+        #A position belongs to the first segment whose stop is >= the position
+        seg = self.seg + np.searchsorted(self.stops[self.seg:], cm, side="left")
+        if len(seg):
+            if seg.max() >= len(self.stops):
+                sys.exit("Error in SegmentCursor:\nChromosome length must be greater than largest snp position")
+            self.seg = int(seg[-1])
+        return self.fgls[seg]
+
 def translate_simu(fgl_dict, cm_list, chrom):
     #fgl_dict: fgl -> [g1, g2, ...]
     #cmlist = [pos1, pos2, ...]
     #Stops in chrom assumed to be in cM
-    my_chrom = chrom[:]
-    my_cm_list = [float(x) for x in cm_list]
+    #chrom is either a diagram or a SegmentCursor carried over from the previous chunk
+    cursor = chrom if isinstance(chrom, SegmentCursor) else SegmentCursor(chrom)
     simu_genos = []
-    next_stop = 0
-    cur_fgl = "N"
-    for i in range(len(my_cm_list)):
-        while next_stop < my_cm_list[i]: #time to get the next fgl
-            if len(my_chrom) == 0:
-                sys.exit("Error in translate_simu:\nChromosome length must be greater than largest snp position")
-            cur_fgl = int(my_chrom.pop(0))
-            next_stop = my_chrom.pop(0)
-            if cur_fgl not in fgl_dict:
-                sys.exit("Founder genome label "+cur_fgl+" not found.")
+    for i, cur_fgl in enumerate(cursor.advance(np.asarray(cm_list, dtype=np.float64)).tolist()):
+        if cur_fgl not in fgl_dict:
+            sys.exit("Founder genome label "+str(cur_fgl)+" not found.")
         simu_genos.append(fgl_dict[cur_fgl][i])
     return(simu_genos)
 
-def get_fnames_vcf(f: TextIO):
-    f.seek(0)
-    for line in f:
-        if line.startswith("##"):
-            # Skip all meta information lines
+def drop_genotypes(founders, cm, cursors, founder_columns=None):
+    """Gathers the simulated alleles for one chunk (variants x simulated haplotypes)"""
+    #founders: PackedAlleles for the chunk, stays packed
+    #cursors: one SegmentCursor per simulated haplotype, in output order
+    #founder_columns: column of founders for each fgl - 1, None if fgl - 1 is the column
+    n_founders = founders.n_haplotypes if founder_columns is None else len(founder_columns)
+    hap_index = np.empty((len(cm), len(cursors)), dtype=np.intp)
+    for h, cursor in enumerate(cursors):
+        fgl = cursor.advance(cm)
+        if len(fgl) and (fgl.min() < 1 or fgl.max() > n_founders):
+            bad = fgl[(fgl < 1) | (fgl > n_founders)][0]
+            sys.exit("Founder genome label "+str(bad)+" not found.")
+        hap_index[:, h] = fgl - 1
+    if founder_columns is not None:
+        hap_index = np.asarray(founder_columns, dtype=np.intp)[hap_index]
+    return founders.take(hap_index)
+
+def format_genotypes(genos, allele_table, sep):
+    """Returns one list of 'a1<sep>a2' strings per variant from packed (variants x haplotypes) alleles"""
+    #Haplotypes are ordered ind1 hap1, ind1 hap2, ind2 hap1, ...
+    genos = genos.unpack()
+    k = len(allele_table)
+    pairs = np.array([a+sep+b for a in allele_table for b in allele_table], dtype=object)
+    codes = genos[:, 0::2].astype(np.intp)*k + genos[:, 1::2]
+    return pairs[codes].tolist()
+
+def read_diagrams(path, chrom, bptm):
+    """Reads the diagrams of one chromosome from recomb_sim.py or admixture_sim.py output
+
+    Returns (names, simu_data1, simu_data2, fam_info, fgls_used). simu_data1 and
+    simu_data2 hold the M and P diagrams keyed by IID with stops converted to cM.
+    """
+    return read_genome_diagrams(path, bptm, {chrom}).get(chrom, ([], {}, {}, {}, set()))
+
+def read_genome_diagrams(path, bptm, chroms=None):
+    """Reads the diagrams of every chromosome, or of those in chroms, in one pass over path
+
+    Returns {chrom: (names, simu_data1, simu_data2, fam_info, fgls_used)} in file order, as read_diagrams.
+    """
+    try:
+        inp = open(path, "rt")
+    except Exception as e:
+        print(e)
+        sys.exit("Failed to open "+path )
+    diagrams = {} #chrom -> (simu_data1, simu_data2, fam_info, fgls_used)
+    chrom_lengths = {}
+    for l in inp:
+        l = l.split()
+        chrom = l[6]
+        if chroms is not None and chrom not in chroms:
             continue
-        if line.startswith("#"):
-            # Header line. VCF returns 1 record per diplotype
-            out_list = []
-            for i in line.split()[9:]:
-                out_list.append(i)
-                out_list.append(i)
-
-            return out_list # We need to double so we get haplotypes
-
-def get_fnames_bgl(f: TextIO):
-    f.seek(0)
-    return f.readline().split()[2:] #List of haplotype names in this file
-
-def get_snp_names(f: TextIO, file_format: FileFormat) -> list[str]:
-    """Returns a list of SNPs from a BGL file or list of positions from VCF"""
-    if file_format == FileFormat.VCF:
-        snp_names = []
-        for line in f:
-            # Skip all header lines
-            if line.startswith("#"):
-                continue
-            cols = line.split(None, 9)[:9]
-            #cols[7] = "." # Remove INFO, its no longer relevant
-            snp_names.append("\t".join(cols))
-        f.seek(0)
-        for line in f:
-            # Return the cursor to end of header
-            if line.startswith("#"):
+        if chrom not in diagrams:
+            diagrams[chrom] = ({}, {}, {}, set([]))
+        simu_data1, simu_data2, fam_info, fgls_used = diagrams[chrom] #Chroms for first and second haplotype keyed by IID, IID -> FID IID PID MID SEX
+        n=l[1] #IID
+        chromid=l[5] #M or P
+        fam_info[n] = l[:5] #FID IID PID MID SEX
+        l=l[7:] #Chromosome diagram
+        fgls_used.update(int(l[x]) for x in range(0, len(l), 2))
+        if bptm:
+            for i in range(1, len(l), 2):
+                l[i] = float(l[i])/bptm
+        if chrom not in chrom_lengths:
+            chrom_lengths[chrom] = float(l[-1])
+        elif not chrom_lengths[chrom] == float(l[-1]):
+            sys.exit("Chromosome lengths are not the same")
+        if chromid=="M":
+            simu_data1[n]= l[:]
+        elif chromid=="P":
+            simu_data2[n] = l[:]
+        else:
+            sys.exit("Error on "+l[0]+" chrmoid "+chromid)
+    inp.close()
+    genome = {}
+    for chrom, (simu_data1, simu_data2, fam_info, fgls_used) in diagrams.items():
+        names = list(simu_data1.keys())
+        if not len(list(simu_data2.keys())) == len(names):
+            sys.exit("Something wonky...")
+        genome[chrom] = (names, simu_data1, simu_data2, fam_info, fgls_used)
+    return genome
+
+def assign_founders(founder_names, coerced_names, names, simu_data1, simu_data2, fgls_used,
+                    mode="IBD", pop_ids_file="", founder_ids_file="", read_file="", bind=False, write_file="", rng=random):
+    """Picks the founder haplotype for each fgl of one pedigree. Returns founder_range.
+
+    founder_names are the working names of the available haplotypes. The fgl i is
+    founder_range[i-1], an index into founder_names. In admix mode the population
+    ids in simu_data1 and simu_data2 are recoded to fgls in place. Founders are
+    shuffled with rng, the random module unless seeded.
+    """
+    #Read provided haplotype correspondences
+    if read_file:
+        try:
+            inp=open(read_file, "rt")
+        except Exception as e:
+            print(e)
+            sys.exit("Failed to open"+read_file)
+        set_haplos=dict([l.split() for l in inp])
+        inp.close()
+
+    #Read population dictionary
+    if mode == "admix":
+        try:
+            inp = open(pop_ids_file, "rt")
+            #Format: Name PopID
+        except Exception as e:
+            print(e)
+            sys.exit("Failed to open "+pop_ids_file)
+        my_fns = set(founder_names)
+        pop_ids = {} #population id --> [list of founder names]
+        fids=set([])
+        for l in inp:
+            [n, p] = l.split()
+            p = int(p)
+            if not n in my_fns:
                 continue
-        return snp_names
-    elif file_format == FileFormat.BGL:
-        snp_names = [l.split(None, 2)[1] for l in f]
-        f.seek(0)
-        next(f)
-        return snp_names
+            if p in pop_ids:
+                pop_ids[p].append(n)
+            else:
+                pop_ids[p] = [n]
+            my_fns.remove(n)
+            fids.add(n)
+            if n in coerced_names:
+                for new_name in coerced_names[n]:
+                    pop_ids[p].append(new_name) 
+                    my_fns.remove(new_name)
+                    fids.add(new_name)
+        inp.close()
+        if not len(fgls_used - set(pop_ids.keys()))== 0 :
+            print((list(pop_ids.keys())))
+            print(fgls_used)
+            sys.exit("Some of the population ids in the simulated data have no associated founders.")
+        #print(("I found populaion information for " +str((len(fids))) + " ids."))
+        print((str(len(my_fns)) +" haplotypes have no population information and will be discarded."))
+        for population in list(pop_ids.keys()):
+            rng.shuffle(pop_ids[population])
+
+    #Read ids to include from --founder-ids option
+    if founder_ids_file:
+        try:
+            inp = open(founder_ids_file, "rt")
+        except Exception as e:
+            print(e)
+            sys.exit("Failed to open "+ founder_ids_file)
+        fids = set([])
+        for l in inp:
+            l=l.split()
+            fids = fids.union(set(l))
+            for x in l:
+                if x in coerced_names:
+                    fids=fids.union(set(coerced_names[x]))
+        inp.close()
+        #print((str(len(fids))+" read from "+founder_ids_file))
+    elif mode=="IBD":
+        fids=set(founder_names)
+    
+    #founder_names contains full set of working haplotype names
+    #fids is subset of working haplotype names that will be used
+    founder_range = [i for i in range(len(founder_names)) if founder_names[i] in fids]
+    my_fns = fids - set(founder_names)
+
+    if read_file:
+        name_index = dict((name, i) for i, name in enumerate(founder_names)) #working name -> index
+        for fgl in list(set_haplos.keys()):
+            if not set_haplos[fgl] in name_index:
+                sys.exit("Haplotype "+set_haplos[fgl]+" from "+read_file+" not found")
+            founder_range[int(fgl)-1]=name_index[set_haplos[fgl]]
+    elif bind:
+        even_range = [founder_range[x] for x in range(0, len(founder_range), 2)]
+        even_index = dict([(founder_range[x], x) for x in range(0, len(founder_range), 2)])
+        rng.shuffle(even_range)
+        newrange =[]
+        for k in range(len(even_range)):
+            newrange.append(even_range[k])
+            indx=even_index[even_range[k]]+1
+            newrange.append(founder_range[indx])
+        founder_range=newrange[:]
     else:
-        raise Exception(f"Unknown file format for reference population file")
+        rng.shuffle(founder_range)
+    founder_names = [founder_names[x] for x in founder_range]
+    if write_file :
+        #write out
+        #fgl founder_name(working)
+        try:
+            write_out = open(write_file, "wt")
+        except:
+            sys.exit("Failed to open "+write_file)
+        for i in range(len(founder_range)):
+            write_out.write(" ".join([str(i+1), founder_names[i]])+"\n")
+        write_out.close()
+    if not len(my_fns) == 0:
+        print((str(len(my_fns))+" Ids not found\n"))
+    #print((str(len(founder_names))+" founder haplotypes remain."))
+    #founder_names now contains only working names to use
+    #their file indices are in founder_range
+    #index in founder_range will be fgl
+    
+    #Recode ids in chromosome diagrams for admix mode
+    #Individual k takes founders 2k and 2k+1 of each population's shuffled list
+    if mode == "admix":
+        if write_file:
+            #write out
+            #name p:newfgl1,newfgl2 p:newfgl1,newfgl2, ...
+            try:
+                write_out = open(write_file+".admix", "wt")
+            except:
+                sys.exit("Failed to open "+write_file+".admix")
+        fgl_of = dict((name, str(i+1)) for i, name in enumerate(founder_names)) #working name -> fgl
+        for k, n in enumerate(names):
+            if write_file:
+                write_out.write(n+" ") 
+            new_fgls1 = {} #population id -> fgl, for each haplotype
+            new_fgls2 = {}
+            for population in list(pop_ids.keys()):
+                if len(pop_ids[population]) < 2*k+2:
+                    sys.exit("Insufficient number of individuals for population "+str(population))
+                new_fgls1[str(population)] = fgl_of[pop_ids[population][2*k]]
+                new_fgls2[str(population)] = fgl_of[pop_ids[population][2*k+1]]
+                if write_file:
+                    write_out.write(str(population)+":"+new_fgls1[str(population)]+","+new_fgls2[str(population)]+" ")
+            #Every population is relabelled in one pass, so a new fgl is never taken for a population id
+            simu_data1[n][0::2] = [new_fgls1.get(x, x) for x in simu_data1[n][0::2]]
+            simu_data2[n][0::2] = [new_fgls2.get(x, x) for x in simu_data2[n][0::2]]
+            if write_file:
+                write_out.write("\n")
+        if write_file:
+            write_out.close()
+    return founder_range
+
+def chromosome_files(paths, chrom):
+    """Fills in {chr} in paths such as ref.chr{chr}.vcf.gz"""
+    return [path.replace("{chr}", chrom) for path in paths]
+
+def file_format(path):
+    """FileFormat of a genotype file from its name, None if it is neither"""
+    if ".vcf" in path.lower():
+        return FileFormat.VCF
+    elif ".bgl" in path.lower():
+        return FileFormat.BGL
+    return None
+
+class Panel:
+    """Founder haplotypes for one chromosome from one or more reference files
+
+    Files are all VCF (read through a compiled cache from compile_reference.py when
+    there is one) or all phased BGL, which take cM positions from map_file. Only the
+    first max_haplotypes haplotypes over all files are kept, as only those can be
+    founders. Names repeated across files are coerced to unique working names.
+    keep is an optional variant mask from variant_qc.keep_mask and region an optional
+    (chrom, start, end) from bgzf.parse_region, both VCF only. populations, from
+    populations.parse_population_spec, picks the founders of a combined VCF panel
+    by population instead of taking its first haplotypes.
+
+    With streaming the files are read a chunk at a time while chunks() is iterated,
+    so memory does not grow with the length of the chromosome. Only the headers are
+    read up front: snp_names and cm are None, and allele_table grows as chunks are
+    read. Compiled caches are not used when streaming. threads decompress BGZF
+    VCF files (see bgzf.BgzfReader).
+
+    Otherwise VCF files are taken from the panel_server.py listening at server when
+    one is running. Its founder haplotypes are shared memory that close() gives back.
+    """
+    def __init__(self, files, max_haplotypes, chunk=10000, bptm_map=1000000, map_file="", keep=None, region=None, streaming=False, threads=1, populations=None, server=""):
+        self.file_format = file_format(files[0])
+        if region is not None and self.file_format == FileFormat.BGL:
+            sys.exit("Regions are only supported with VCF genotype files")
+        if populations is not None and self.file_format == FileFormat.BGL:
+            sys.exit("Populations are only supported with VCF genotype files")
+        self.streaming = streaming
+        self.bptm_map = bptm_map
+        self.keep = keep
+        self.data = []
+        self.leases = [] #panel_server.PanelLease of each file from the server
+        self.founder_names = [] #List of working names of founder haplotypea from data
+                                #If haplotypes are not named uniquely they will be coerced into unique names
+        self.coerced_names = {} #Old name -> [newname1, newname2, ...]
+        tagending=0 
+        hap_name_set = set([]) #set of unique haplotype names
+        n_haps = 0 #Haplotypes in the files read so far
+        for path in files:
+            if not file_format(path) == self.file_format:
+                sys.exit(f"All input files must be the same format. {files[0]} and {path} differ. Expected vcf or bgl.")
+            n_keep = max(0, max_haplotypes - n_haps)
+            try:
+                if streaming and self.file_format == FileFormat.VCF:
+                    data = VcfStream(path, n_keep, chunk, region, threads, populations)
+                elif streaming:
+                    data = BglStream(path, n_keep, chunk)
+                elif self.file_format == FileFormat.VCF:
+                    lease = fetch_panel(server, path, n_keep, chunk, bptm_map, keep, region, populations)
+                    if lease is not None:
+                        self.leases.append(lease)
+                        data = lease.data
+                    else:
+                        data = load_panel(path, n_keep, chunk, bptm_map, keep, region, threads, populations)
+                else:
+                    with gzip.open(path, "rt") as f:
+                        data = read_bgl(f, n_keep, chunk)
+            except OSError as e:
+                print(e)
+                sys.exit("Failed to open and read file "+path)
+            self.data.append(data)
+            n_haps += len(data.fnames)
 
+            #List of haplotype names in this file
+            fnames = data.fnames[:]
+            for j in range(len(fnames)):
+                if fnames[j] in hap_name_set: #Name is not unique
+                    if fnames[j] in self.coerced_names:
+                        self.coerced_names[fnames[j]].append(fnames[j]+"_"+str(tagending))
+                    else:
+                        self.coerced_names[fnames[j]]=[fnames[j]+"_"+str(tagending)]
+                    fnames[j] = fnames[j]+"_"+str(tagending)
+                    tagending=tagending+1
+                hap_name_set.add(fnames[j])
+            self.founder_names.extend(fnames)
+
+        self.meta = self.data[0].meta
+        if streaming:
+            self.snp_names = None
+            self.cm = None
+            self.allele_table = []
+            self.map_file = None
+            if self.file_format == FileFormat.BGL:
+                try:
+                    self.map_file = gzip.open(map_file, "rt")
+                except Exception as e:
+                    print(e)
+                    sys.exit("Failed to open "+map_file )
+            return
+        self.snp_names = self.data[0].snp_names
+        for data in self.data[1:]:
+            if not len(data.snp_names) == len(self.snp_names):
+                sys.exit("All reference files must contain the same variants.")
+        if self.file_format == FileFormat.BGL:
+            # BGL format needs a map.
+            try:
+                inp = gzip.open(map_file, "rt")
+                cm_list = [float(l.split()[1]) for l in inp]
+                inp.close()
+            except Exception as e:
+                print(e)
+                sys.exit("Failed to open "+map_file )
+            self.cm = np.array(cm_list, dtype=np.float64)
+            if bptm_map:
+                self.cm = self.cm/bptm_map
+            if not len(self.snp_names) == len(self.cm):
+                sys.exit("Map file must contain the same snps as bgl files.")
+        elif self.data[0].cm is not None:
+            self.cm = self.data[0].cm
+        elif bptm_map:
+            self.cm = self.data[0].positions/bptm_map
+        else:
+            self.cm = self.data[0].positions.astype(np.float64)
+        self.allele_table, self.allele_lookups = merge_allele_tables([data.allele_table for data in self.data])
+
+    def close(self):
+        """Gives the files taken from the panel server back. Founders from chunks() must no longer be in use."""
+        self.data = []
+        for lease in self.leases:
+            lease.close()
+        self.leases = []
+
+    def chunks(self):
+        """Yields (snp_names, cm, founders) for each chunk, founders being PackedAlleles (variants x kept haplotypes)"""
+        if self.streaming:
+            yield from self.stream_chunks()
+            return
+        start = 0
+        for c in range(len(self.data[0].founder_chunks)):
+            founders = PackedAlleles.hstack([data.founder_chunks[c].remap(lookup) for data, lookup in zip(self.data, self.allele_lookups)])
+            stop = start + len(founders)
+            yield self.snp_names[start:stop], self.cm[start:stop], founders
+            start = stop
+
+    def stream_chunks(self):
+        """chunks() when streaming: reads a chunk from every file, works out its cM and drops sites not in keep"""
+        allele_codes = {}
+        start = 0 #Records read so far, the index into keep
+        for parts in zip_longest(*[data.chunks() for data in self.data]):
+            if any(p is None or len(p[0]) != len(parts[0][0]) for p in parts):
+                sys.exit("All reference files must contain the same variants.")
+            snp_names, positions, _ = parts[0]
+            n = len(snp_names)
+            if self.map_file is not None:
+                cm = np.array([float(l.split()[1]) for l in islice(self.map_file, n)], dtype=np.float64)
+                if not len(cm) == n:
+                    sys.exit("Map file must contain the same snps as bgl files.")
+                if self.bptm_map:
+                    cm = cm/self.bptm_map
+            elif self.bptm_map:
+                cm = positions/self.bptm_map
+            else:
+                cm = positions.astype(np.float64)
+            #Alleles are added to the merged table as they are first seen
+            lookups = [extend_allele_table(data.allele_table, allele_codes, self.allele_table) for data in self.data]
+            founders = PackedAlleles.hstack([p[2].remap(lookup) for p, lookup in zip(parts, lookups)])
+            if self.keep is not None:
+                rows = np.flatnonzero(self.keep[start:start+n])
+                if len(rows) < n:
+                    snp_names = [snp_names[i] for i in rows.tolist()]
+                    cm = cm[rows]
+                    founders = founders.select(rows)
+            start += n
+            if len(founders):
+                yield snp_names, cm, founders
+        if self.keep is not None and not start == len(self.keep):
+            sys.exit("Variant mask has "+str(len(self.keep))+" sites but the panel has "+str(start))
+        if self.map_file is not None:
+            if self.map_file.readline():
+                sys.exit("Map file must contain the same snps as bgl files.")
+            self.map_file.close()
+
+class Pedigree:
+    """One pedigree's chromosome diagrams and, once picked, its founders"""
+    def __init__(self, path, chrom, bptm=1000000, diagrams=None):
+        #diagrams: this chromosome's entry of read_genome_diagrams(path), read here if not given
+        self.path = path
+        if diagrams is None:
+            diagrams = read_diagrams(path, chrom, bptm)
+        self.names, self.simu_data1, self.simu_data2, self.fam_info, self.fgls_used = diagrams
+        self.founder_range = None
+
+    def pick_founders(self, panel, mode="IBD", pop_ids_file="", founder_ids_file="", read_file="", bind=False, write_file="", rng=random):
+        """Assigns a panel haplotype to each fgl, see assign_founders"""
+        # Limit founder names to maximum of 2x names
+        # Admix mode draws 2 founders per individual from every population, so it keeps them all
+        founder_names = panel.founder_names
+        if mode == "IBD" and len(founder_names) >= len(self.names) * 2:
+            founder_names = founder_names[:(len(self.names) * 2)]
+        self.founder_range = assign_founders(founder_names, panel.coerced_names, self.names, self.simu_data1, self.simu_data2,
+                                             self.fgls_used, mode, pop_ids_file, founder_ids_file, read_file, bind, write_file, rng)
+
+    def cursors(self, names=None):
+        """One SegmentCursor per simulated haplotype, in output order, of every individual or those in names"""
+        hap_cursors = []
+        for n in self.names if names is None else names:
+            hap_cursors.append(SegmentCursor(self.simu_data1[n]))
+            hap_cursors.append(SegmentCursor(self.simu_data2[n]))
+        return hap_cursors
+
+def max_founders(pedigrees, mode="IBD"):
+    """Number of panel haplotypes that can be founders for a batch of pedigrees"""
+    if mode == "admix":
+        return sys.maxsize
+    return 2 * max(len(p.names) for p in pedigrees)
+
+def founder_stream(seed, diagrams):
+    """Random stream for picking one pedigree's founders, the random module without a seed
+
+    The stream depends on the contents of the diagrams, not on the chromosome or
+    the pedigree's place in a batch, so every chromosome, shard or job picks the same founders.
+    """
+    if not seed:
+        return random
+    return stream(seed, "sim_to_genotypes", file_digest(diagrams))
+
+#Pedigrees of a DropPool in each worker process: [(cursors, founder_range)]
+_pool_pedigrees = None
+
+def _init_drop_worker(pedigrees):
+    global _pool_pedigrees
+    _pool_pedigrees = pedigrees
+
+def _drop_into(arrays, p, h0, h1, n_founders):
+    cursors, founder_columns = _pool_pedigrees[p]
+    founders = PackedAlleles(arrays["bits"], arrays["ref"], arrays["alt"], n_founders, arrays["escape_rows"], arrays["escape_codes"])
+    genos = drop_genotypes(founders, arrays["cm"], cursors[h0:h1], founder_columns)
+    #h0 is a multiple of 8, so the slice's bits are whole bytes of the output rows
+    arrays["out_bits"+str(p)][:, h0 // 8:h0 // 8 + genos.bits.shape[1]] = genos.bits
+    arrays["out_escapes"+str(p)][:, h0:h1] = genos.escape_codes
+
+def _drop_slice(task):
+    """Drops one chunk into simulated haplotypes [h0, h1) of pedigree p. Returns an error message or None."""
+    spec, p, h0, h1, n_founders = task
+    shared = SharedArrays.attach(spec)
+    error = None
+    try:
+        _drop_into(shared.arrays, p, h0, h1, n_founders)
+    except SystemExit as e:
+        error = str(e.code)
+    finally:
+        shared.close()
+    return error
+
+class DropPool:
+    """Worker processes that drop each chunk into slices of the simulated haplotypes
+
+    The chunk's founders go into shared memory once and every worker writes its
+    slice of each pedigree's genotypes into a shared output buffer, so neither is
+    copied between processes. Slices are whole bytes (8 haplotypes) of the packed
+    output. Workers carry their own copies of the cursors; a cursor that missed
+    chunks only searches a little more. Founders must be picked first.
+    """
+    def __init__(self, pedigrees, workers):
+        self.n_haplotypes = [2 * len(p.names) for p in pedigrees]
+        self.slices = []
+        for p, h in enumerate(self.n_haplotypes):
+            step = -(-h // workers // 8) * 8 or 8
+            self.slices.extend((p, h0, min(h0 + step, h)) for h0 in range(0, h, step))
+        #forkserver rather than fork: the reader and writer threads may already be running
+        start_tracker()
+        self.pool = multiprocessing.get_context("forkserver").Pool(min(workers, len(self.slices)) or 1, _init_drop_worker,
+                                         ([(p.cursors(), p.founder_range) for p in pedigrees],))
+
+    def drop(self, founders, cm):
+        """Returns one PackedAlleles (variants x simulated haplotypes) per pedigree, as drop_genotypes"""
+        shapes = [("bits", founders.bits.shape, np.uint8), ("ref", founders.ref.shape, np.uint8), ("alt", founders.alt.shape, np.uint8),
+                  ("escape_rows", founders.escape_rows.shape, np.int64), ("escape_codes", founders.escape_codes.shape, np.uint8),
+                  ("cm", (len(cm),), np.float64)]
+        for p, h in enumerate(self.n_haplotypes):
+            shapes.append(("out_bits"+str(p), (len(founders), (h + 7) // 8), np.uint8))
+            shapes.append(("out_escapes"+str(p), (len(founders.escape_rows), h), np.uint8))
+        shared = SharedArrays.create(shapes)
+        try:
+            arrays = shared.arrays
+            arrays["bits"][:] = founders.bits
+            arrays["ref"][:] = founders.ref
+            arrays["alt"][:] = founders.alt
+            arrays["escape_rows"][:] = founders.escape_rows
+            arrays["escape_codes"][:] = founders.escape_codes
+            arrays["cm"][:] = cm
+            spec = shared.spec()
+            errors = self.pool.map(_drop_slice, [(spec, p, h0, h1, founders.n_haplotypes) for p, h0, h1 in self.slices])
+            for error in errors:
+                if error is not None:
+                    sys.exit(error)
+            genotypes = [PackedAlleles(arrays["out_bits"+str(p)].copy(), founders.ref, founders.alt, h, founders.escape_rows,
+                                       arrays["out_escapes"+str(p)].copy()) for p, h in enumerate(self.n_haplotypes)]
+            del arrays
+        finally:
+            shared.close(unlink=True)
+        return genotypes
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+def drop_pedigrees(panel, pedigrees, workers=1):
+    """Yields (snp_names, cm, genotypes) for each chunk of panel
+
+    genotypes holds one PackedAlleles (variants x simulated haplotypes) per
+    pedigree. Each chunk is decoded once and dropped into every pedigree, by
+    a DropPool of workers processes when workers > 1. Founders must be picked first.
+    The next chunks are read on a background thread while one is dropped.
+    """
+    if workers > 1:
+        pool = DropPool(pedigrees, workers) #Started before the reader thread, as the workers are forked
+        try:
+            for snp_names, cm, founders in read_ahead(panel.chunks()):
+                yield snp_names, cm, pool.drop(founders, cm)
+        finally:
+            pool.close()
+        return
+    cursors = [p.cursors() for p in pedigrees]
+    for snp_names, cm, founders in read_ahead(panel.chunks()):
+        yield snp_names, cm, [drop_genotypes(founders, cm, c, p.founder_range) for p, c in zip(pedigrees, cursors)]
+
+class GenotypeBlock(NamedTuple):
+    names: list[str] #Simulated individuals, two haplotypes each
+    snp_names: list[str] #VCF fixed columns or BGL rsids of each variant
+    cm: np.ndarray #cM position of each variant
+    genotypes: PackedAlleles #Simulated alleles (variants x haplotypes), unpack() for uint8 codes
+    allele_table: tuple[str, ...] #uint8 code -> allele, as far as read when the block was yielded
+
+def simulate_genotypes(diagrams, panels, chrom, chunk=10000, bptm=1000000, bptm_map=1000000, map_file="", keep=None, region="",
+                       mode="IBD", pop_ids_file="", founder_ids_file="", read_file="", bind=False, write_file="", seed="", streaming=False, workers=1, threads=1,
+                       population="", population_file=DEFAULT_POPULATION_FILE, panel_server=DEFAULT_SOCKET):
+    """Drops genotypes from reference panels through one pedigree's diagrams, without writing them out
+
+    A generator of GenotypeBlock, one per chunk of variants. diagrams is recomb_sim.py
+    or admixture_sim.py output and panels the reference files for chrom, as on the
+    command line. The other arguments match the command line options; a region
+    such as "chr6:1-20000000" needs keep to be for that region too. With a seed the
+    founders are drawn from the same stream as sim_to_genotypes.py --seed. With
+    streaming the panels are read as the blocks are consumed (see Panel), and
+    workers > 1 drops each block with a DropPool. threads decompress BGZF panels.
+    A population spec such as "CEU+TSI" picks the founders from a combined panel.
+    Panels come from a panel_server.py at panel_server when one is running there.
+    """
+    pedigree = Pedigree(diagrams, chrom, bptm)
+    populations = parse_population_spec(population, population_file) if population else None
+    panel = Panel(panels, max_founders([pedigree], mode), chunk, bptm_map, map_file, keep, parse_region(region) if region else None, streaming, threads, populations, panel_server)
+    try:
+        pedigree.pick_founders(panel, mode, pop_ids_file, founder_ids_file, read_file, bind, write_file, founder_stream(seed, diagrams))
+        for snp_names, cm, (genos,) in drop_pedigrees(panel, [pedigree], workers):
+            yield GenotypeBlock(pedigree.names, snp_names, cm, genos, tuple(panel.allele_table))
+    finally:
+        panel.close()
+
+class VcfOutput:
+    """Writes simulated genotypes as VCF, BGZF compressed and tabix indexed if path ends in .gz"""
+    def __init__(self, path, meta, names, allele_table, threads=1):
+        self.path = path
+        self.names = names
+        self.allele_table = allele_table
+        if path.endswith(".gz"):
+            self.output = BgzfWriter(path, threads)
+            self.index = TabixIndex()
+        else:
+            self.output = open(path, "wt")
+            self.index = None
+        for line in meta:
+            self.output.write(line)
+        self.output.write("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t"+"\t".join(names)+"\n")
+        if self.index is not None:
+            self.output.flush() #Header gets its own blocks so concat_vcf.py can drop it
+
+    def write(self, snp_names, genos):
+        lines = ["\t".join([snp_names[i]]+row)+"\n" for i, row in enumerate(format_genotypes(genos, self.allele_table, "|"))]
+        if self.index is None:
+            self.output.writelines(lines)
+        else:
+            lines = [l.encode() for l in lines]
+            self.index.add_vcf_lines(lines, self.output.tell())
+            self.output.write(b"".join(lines))
+
+    def close(self):
+        self.output.close()
+        if self.index is not None:
+            self.index.write(self.path+".tbi", self.output)
+
+class BglOutput:
+    """Writes simulated genotypes in BGL format"""
+    def __init__(self, path, names, allele_table):
+        self.names = names
+        self.allele_table = allele_table
+        self.output = open(path, "wt")
+        self.output.write("I rsid "+" ".join([n+" "+n for n in names])+"\n")
+
+    def write(self, snp_names, genos):
+        for i, row in enumerate(format_genotypes(genos, self.allele_table, " ")):
+            self.output.write(" ".join(["M", snp_names[i]]+row)+"\n")
+
+    def close(self):
+        self.output.close()
 
 ##bgl file format (same as phased):
 #I rsid Id1 Id1 Id2 Id2 Id3 Id3 ...
@@ -93,24 +723,38 @@ def get_snp_names(f: TextIO, file_format: FileFormat) -> list[str]:
 
 if __name__ == '__main__':
 
-    from random import shuffle
     from optparse import OptionParser
 
     parser =OptionParser(usage = "%prog [options] -c N -s simulated_data.txt -m data.map fg1.bgl fg2.bgl ...\n")
     parser.add_option("--mode", type="choice",  choices=("IBD", "admix"), default="IBD", help="To use with output of recomb_sim.py use 'IBD' mode. To use with output of admixture_sim.py use 'admix' mode. Admix mode requires a file with population ID for each individual in the genotype files.") 
-    parser.add_option("-c", "--chr", dest="c", default = "", help="Chromosome number. (required)")
-    parser.add_option("-s", "--simulation", default = "", dest="s", help="Chromosome diagram output from recomb_sim.py or admix_sim.py. (required)")
+    parser.add_option("-c", "--chr", dest="c", default = "", help="Chromosome number. (required) 'all', or a list such as 1-22 or 1,2,X, simulates those chromosomes of the diagrams in one run into one genome-wide output, from genotype files named with {chr} in place of the chromosome. The diagrams are read and the founders picked once, so each founder haplotype comes from the same sample on every chromosome.")
+    parser.add_option("-s", "--simulation", default = "", dest="s", help="Chromosome diagram output from recomb_sim.py or admix_sim.py. (required) Give a comma separated list to simulate several pedigrees from one pass over the VCF genotype files.")
     parser.add_option("-m", "--map", default="", dest="m", help="File giving marker positions in cM or bp if using bp-cm-map option. File must contain exactly the snps in the bgl files. (required)")
-    parser.add_option("--out", dest="out", default="out.txt", help="Output file name.")
+    parser.add_option("--out", dest="out", default="out.txt", help="Output file name. Comma separated, one per --simulation file.")
     parser.add_option("--chunk", default = 100, type = "int", dest="chunk", help="Number of SNPs per chunk to process.")
     parser.add_option("--gzip", action="store_true", default = False, dest="gz", help="Indicates genotype files are gzipped")
     parser.add_option("--bp-cm-sim", default=1000000, dest="bptm", help="If stop points are in bp give the conversion. Defaulta assumes bp and uses 1Mb=1cM. For files in cM use --bp-cm-sim=0 ", type="int")
     parser.add_option("--bp-cm-map", type="int", dest="bptm_map", help="If map file is in bp give conversion to cM. Default assumes map file is in bp and uses 1 Mb = 1cM. For map file in cM use --bp-cm-map=0.", default=1000000)
     parser.add_option("--founder-ids", default = "", dest="fids", help="Text file containing list of founder ids to use.")
     parser.add_option("--pop-ids", default="", dest="pid", help="A file with population id for all ids in bgl files. Use this option with 'admix' mode.")
-    parser.add_option("--write-names", default="" , dest="write", help="Write out haplotypes used for each FGL")
-    parser.add_option("--read-names", default="" , dest="read", help="Provide haplotype assignments from a previous chromosome.")
+    parser.add_option("--write-names", default="" , dest="write", help="Write out haplotypes used for each FGL. Comma separated, one per --simulation file.")
+    parser.add_option("--read-names", default="" , dest="read", help="Provide haplotype assignments from a previous chromosome. Comma separated, one per --simulation file.")
     parser.add_option("--bind-haplos", default=False, action="store_true", dest="bind", help="Bind founder haplotypes")
+    parser.add_option("--bed", default="", dest="bed", help="Also write PLINK .bed/.bim/.fam files with this prefix. The .fam takes FID, PID, MID and sex from the diagrams. VCF input only. Comma separated, one per --simulation file.")
+    parser.add_option("--extract", default="", dest="extract", help="Only simulate variants whose IDs are in this .bim file. VCF input only.")
+    parser.add_option("--frq", default="", dest="frq", help="PLINK .frq file consulted by --maf alongside the panel frequencies.")
+    parser.add_option("--maf", default=0.0, type="float", dest="maf", help="Only simulate variants with at least this minor allele frequency in the panel. VCF input only.")
+    parser.add_option("--geno", default=1.0, type="float", dest="geno", help="Only simulate variants with at most this fraction of missing alleles in the panel. VCF input only.")
+    parser.add_option("--region", default="", dest="region", help="Only simulate variants in this region, e.g. chr6:1-20000000. Reads only that part of indexed (.tbi or .csi) genotype files. VCF input only.")
+    parser.add_option("--shard", default="", dest="shard", help="K/N: only simulate the Kth of N regions of the chromosome holding about as many variants each. Needs --seed or --read-names so every shard picks the same founders. Join the outputs in order with concat_vcf.py and plink_bed.py. VCF input only.")
+    parser.add_option("--population", default="", dest="population", help="Founder populations in a combined panel such as the full 1000 Genomes one, e.g. EUR, CEU+TSI or CEU:3+YRI:1 for a 3:1 mix. Founders are taken from each population's samples in --population-file. VCF input only.")
+    parser.add_option("--population-file", default=DEFAULT_POPULATION_FILE, dest="population_file", help="JSON file listing the sample IDs of each population. Default is 1kg.json next to this script.")
+    parser.add_option("--seed", default="", dest="seed", help="Seed for picking founders. The founders depend only on the seed and the contents of the diagram file, so every chromosome of a pedigree gets the same ones and identical diagram files get identical founders; give replicates different seeds.")
+    parser.add_option("--cache", default="", dest="cache", help="Directory of cached results. With --seed, outputs already simulated for the same inputs are copied from here.")
+    parser.add_option("--stream", action="store_true", default=False, dest="stream", help="Read the genotype files a chunk at a time as genotypes are written, so memory does not grow with the chromosome. Compiled panels are not used.")
+    parser.add_option("--panel-server", default=DEFAULT_SOCKET, dest="panel_server", help="Socket of a panel_server.py to take VCF genotype files from, already decoded, instead of reading them. Default is "+DEFAULT_SOCKET+". The files are read directly when no server is running there; give --panel-server= to always read them. Not used with --stream.")
+    parser.add_option("--workers", default=1, type="int", dest="workers", help="Processes dropping the genotypes of each chunk, splitting the simulated individuals between them. Worth it for pedigrees of hundreds of individuals.")
+    parser.add_option("--threads", default=1, type="int", dest="threads", help="Threads for decompressing BGZF genotype files and compressing VCF output. Output is BGZF compressed and tabix indexed when --out ends in .gz")
     (opts, args) = parser.parse_args()
 
     #Check options
@@ -131,593 +775,190 @@ if __name__ == '__main__':
         sys.exit("Please don't use both --read-names and --founder-ids")
     
     # Determine BGL or VCF by looking at extension of first file.
-    if ".vcf" in args[0].lower():
-        file_mode = FileFormat.VCF
-    elif ".bgl" in args[0].lower():
-        file_mode = FileFormat.BGL
-    else:
+    file_mode = file_format(args[0])
+    if file_mode is None:
         sys.exit(f"""Failed to determine file format for file {args[0]}.
 Expected vcf or bgl. Ensure that .vcf or .bgl is in file name""")
-
-    if file_mode == FileFormat.BGL:
-        # Read map
-        # BGL format needs a map.
+    if opts.bed and file_mode == FileFormat.BGL:
+        sys.exit("--bed is only supported with VCF genotype files")
+    genome = opts.c == "all" or "," in opts.c or "-" in opts.c
+    if genome:
+        if opts.region or opts.shard:
+            sys.exit("--region and --shard need a single chromosome in --chr")
+        if not all("{chr}" in path for path in args):
+            sys.exit("--chr="+opts.c+" needs genotype files named with {chr} in place of the chromosome, e.g. ref.chr{chr}.vcf.gz")
+    if (opts.region or opts.shard) and file_mode == FileFormat.BGL:
+        sys.exit("--region and --shard are only supported with VCF genotype files")
+    if opts.shard:
+        if opts.region:
+            sys.exit("Please don't use both --region and --shard")
+        if not (opts.seed or opts.read):
+            sys.exit("--shard needs --seed or --read-names, so that every shard picks the same founders")
         try:
-            inp = gzip.open(opts.m, "rt")
-        except Exception as e:
-            print(e)
-            sys.exit("Failed to open "+opts.m )
-        cm_list = [l.split()[1] for l in inp]
-        if opts.bptm_map:
-            #print(("Converting map bp positions to cM: "+str(opts.bptm_map)+"=1cM"))
-            cm_list = [float(x)/opts.bptm_map for x in cm_list]
-        inp.close()
-        #print(("Last SNP position: "+str(cm_list[-1])))
-
-        #Read simulated chromosome diagrams 
+            shard, n_shards = (int(k) for k in opts.shard.split("/"))
+        except ValueError:
+            sys.exit("Could not read --shard="+opts.shard+". Use K/N, e.g. 2/8")
+        if not 1 <= shard <= n_shards:
+            sys.exit("--shard="+opts.shard+" needs 1 <= K <= N")
+        #Every shard works out the same boundaries from the first genotype file
+        opts.region = "%s:%d-%d" % shard_regions(args[0], opts.c, n_shards, opts.threads)[shard - 1]
+        print("Shard "+opts.shard+" is region "+opts.region)
+    region = None
+    if opts.region:
         try:
-            inp = open(opts.s, "rt")
+            region = parse_region(opts.region)
         except Exception as e:
-            print(e)
-            sys.exit("Failed to open "+opts.s )
-        simu_data1 = {} #Chroms for first haplotype, keyed by IID
-        simu_data2 = {} #For second haplotype
-        chrom_length="N"
-        fgls_used = set([])
-        for l in inp:
-            l = l.split()
-            if not l[6] == opts.c:
-                continue
-            n=l[1] #IID
-            chromid=l[5] #M or P
-            l=l[7:] #Chromosome diagram
-            fgls_used = fgls_used.union(set([int(l[x]) for x in range(0, len(l), 2)]))
-            if opts.bptm:
-                for i in range(1, len(l), 2):
-                    l[i] = float(l[i])/opts.bptm
-            if chrom_length == "N":
-                chrom_length = float(l[-1])
-            elif not chrom_length == float(l[-1]):
-                sys.exit("Chromosome lengths are not the same")
-            if chromid=="M":
-                simu_data1[n]= l[:]
-            elif chromid=="P":
-                simu_data2[n] = l[:]
-            else:
-                sys.exit("Error on "+l[0]+" chrmoid "+chromid)
-        inp.close()
-        #print(("Chromosome length: "+str(chrom_length)))
-        names = list(simu_data1.keys())
-        if not len(list(simu_data2.keys())) == len(names):
-            sys.exit("Something wonky...")
-        #print(("I found "+str(len(names))+" simulated individuals."))
-        
-        #Read provided haplotype correspondences
-        if opts.read:
-            try:
-                inp=open(opts.read, "rt")
-            except Exception as e:
-                print(e)
-                sys.exit("Failed to open"+opts.read)
-            set_haplos=dict([l.split() for l in inp])
-            inp.close()
-            
-
-        #Open data files and read header
-        files = [None for _ in args]
-        founder_names = [] #List of working names of founder haplotypea from data
-                            #If haplotypes are not named uniquely they will be coerced into unique names
-        tagending=0 
-        coerced_names = {} #Old name -> [newname1, newname2, ...]
-        hap_name_set = set([]) #set of unique haplotype names
-        for i in range(len(files)):
-            if ".vcf" in args[i].lower():
-                raise Exception(f"{args[0]} was BGL but {args[i]} detected as VCF") 
-            elif ".bgl" in args[i].lower():
-                pass
-            else:
-                sys.exit(f"Failed to determine file format for file {args[i]}. Expected vcf or bgl.")
-
-            try:
-                files[i] = gzip.open(args[i], "rt")
-            except Exception as e:
-                print(e)
-                sys.exit("Failed to open and read file "+args[i])
-
-            #List of haplotype names in this file
-            fnames = get_fnames_vcf(files[i]) if file_mode == FileFormat.VCF else get_fnames_bgl(files[i])
-            #print(("File "+str(i+1)+" has "+str(len(fnames))+ " haplotypes."))
-            for j in range(len(fnames)):
-                if fnames[j] in hap_name_set: #Name is not unique
-                    if fnames[j] in coerced_names:
-                        coerced_names[fnames[j]].append(fnames[j]+"_"+str(tagending))
-                    else:
-                        coerced_names[fnames[j]]=[fnames[j]+"_"+str(tagending)]
-                    fnames[j] = fnames[j]+"_"+str(tagending)
-                    tagending=tagending+1
-                hap_name_set.add(fnames[j])
-            founder_names.extend(fnames)
-        #print(("I found "+str(len(founder_names))+" founder haplotypes total."))
-
-        # Limit founder names to maximum of 2x names
-        if len(founder_names) >= len(names) * 2:
-            founder_names = founder_names[:(len(names) * 2)]
-            #print(f"Only using {len(names) * 2} to simulate {len(names)} individuals")
-
-        snp_names = get_snp_names(files[0], file_mode)
-
-        if not len(snp_names) == len(cm_list):
-            sys.exit("Map file must contain the same snps as bgl files.")
-        nchunks = len(snp_names)/opts.chunk + 1
-        #print(("There will be "+str(nchunks)+" chunks."))
-        #founder_names contains full set of working haplotype names
-
-        #Read population dictionary
-        if opts.mode == "admix":
-            try:
-                inp = open(opts.pid, "rt")
-                #Format: Name PopID
-            except Exception as e:
-                print(e)
-                sys.exit("Failed to open "+opts.pid)
-            my_fns = set(founder_names)
-            pop_ids = {} #population id --> [list of founder names]
-            fids=set([])
-            for l in inp:
-                [n, p] = l.split()
-                p = int(p)
-                if not n in my_fns:
-                    continue
-                if p in pop_ids:
-                    pop_ids[p].append(n)
-                else:
-                    pop_ids[p] = [n]
-                my_fns.remove(n)
-                fids.add(n)
-                if n in coerced_names:
-                    for new_name in coerced_names[n]:
-                        pop_ids[p].append(new_name) 
-                        my_fns.remove(new_name)
-                        fids.add(new_name)
-            if not len(fgls_used - set(pop_ids.keys()))== 0 :
-                print((list(pop_ids.keys())))
-                print(fgls_used)
-                sys.exit("Some of the population ids in the simulated data have no associated founders.")
-            #print(("I found populaion information for " +str((len(fids))) + " ids."))
-            print((str(len(my_fns)) +" haplotypes have no population information and will be discarded."))
-            for population in list(pop_ids.keys()):
-                shuffle(pop_ids[population])
-
-        #Read ids to include from --founder-ids option
-        if opts.fids:
-            try:
-                inp = open(opts.fids, "rt")
-            except Exception as e:
-                print(e)
-                sys.exit("Failed to open "+ opts.fids)
-            fids = set([])
-            for l in inp:
-                l=l.split()
-                fids = fids.union(set(l))
-                for x in l:
-                    if x in coerced_names:
-                        fids=fids.union(set(coerced_names[x]))
-            inp.close()
-            print((str(len(fids))+" read from "+opts.fids))
-        elif opts.mode=="IBD":
-            fids=set(founder_names)
-        
-        #founder_names contains full set of working haplotype names
-        #fids is subset of working haplotype names that will be used
-        founder_range = list(range(len(founder_names))) 
-        my_fns = fids.copy()
-        for i in range(len(founder_names)):
-            if not founder_names[i] in fids:
-                founder_range.remove(i)
-            else:
-                my_fns.remove(founder_names[i])
-
-        if opts.read:
-            for fgl in list(set_haplos.keys()):
-                founder_range[int(fgl)-1]=founder_names.index(set_haplos[fgl])
-        elif opts.bind:
-            even_range = [founder_range[x] for x in range(0, len(founder_range), 2)]
-            even_index = dict([(founder_range[x], x) for x in range(0, len(founder_range), 2)])
-            shuffle(even_range)
-            newrange =[]
-            for k in range(len(even_range)):
-                newrange.append(even_range[k])
-                indx=even_index[even_range[k]]+1
-                newrange.append(founder_range[indx])
-            founder_range=newrange[:]
+            sys.exit(str(e))
+    populations = None
+    if opts.population:
+        if file_mode == FileFormat.BGL:
+            sys.exit("--population is only supported with VCF genotype files")
+        populations = parse_population_spec(opts.population, opts.population_file)
+    variant_qc = opts.extract or opts.frq or opts.maf > 0 or opts.geno < 1
+    if variant_qc and file_mode == FileFormat.BGL:
+        sys.exit("--extract, --frq, --maf and --geno are only supported with VCF genotype files")
+
+    #Batch mode: comma separated --simulation files, each with its own outputs
+    batch_s = opts.s.split(",")
+    batch_out = opts.out.split(",")
+    batch_write = opts.write.split(",") if opts.write else [""] * len(batch_s)
+    batch_read = opts.read.split(",") if opts.read else [""] * len(batch_s)
+    batch_bed = opts.bed.split(",") if opts.bed else [""] * len(batch_s)
+    if not len(batch_s) == len(batch_out) == len(batch_write) == len(batch_read) == len(batch_bed):
+        sys.exit("--out, --write-names, --read-names and --bed need one entry per --simulation file")
+
+    #Genome mode: the diagrams are read once and every chromosome goes into the same outputs
+    chroms = [opts.c]
+    if genome:
+        genome_diagrams = [read_genome_diagrams(path, opts.bptm) for path in batch_s]
+        chroms = list(genome_diagrams[0]) if opts.c == "all" else parse_chromosomes(opts.c)
+        if not chroms:
+            sys.exit("No chromosomes in "+batch_s[0])
+        for path, diagrams in zip(batch_s, genome_diagrams):
+            for chrom in chroms:
+                if chrom not in diagrams:
+                    sys.exit("No diagrams for chromosome "+chrom+" in "+path)
+
+    #Outputs of each pedigree by role, as stored in the cache
+    batch_files = []
+    for k in range(len(batch_s)):
+        files = {"out": batch_out[k]}
+        if file_mode == FileFormat.VCF and batch_out[k].endswith(".gz"):
+            files["out.tbi"] = batch_out[k]+".tbi"
+        if batch_write[k]:
+            files["names"] = batch_write[k]
+            if opts.mode == "admix":
+                files["names.admix"] = batch_write[k]+".admix"
+        if batch_bed[k]:
+            for ext in ("bed", "bim", "fam"):
+                files["bed."+ext] = batch_bed[k]+"."+ext
+        batch_files.append(files)
+
+    #Seeded pedigrees already simulated with the same inputs are copied from the cache
+    batch = list(range(len(batch_s)))
+    cache = ResultCache(opts.cache) if opts.cache and opts.seed else None
+    if cache is not None:
+        batch_keys = []
+        panel_files = [f for chrom in chroms for f in chromosome_files(args, chrom)] if genome else args
+        map_files = [opts.m.replace("{chr}", chrom) for chrom in chroms] if genome else [opts.m]
+        for k in range(len(batch_s)):
+            inputs = [batch_s[k]] + panel_files + (map_files if file_mode == FileFormat.BGL else [""]) + [opts.pid, opts.fids, batch_read[k], opts.extract, opts.frq]
+            options = [opts.seed, opts.c, opts.mode, opts.bptm, opts.bptm_map, opts.bind, opts.maf, opts.geno, opts.region,
+                       file_mode.name, batch_out[k].endswith(".gz")]
+            if genome:
+                options.append(chroms)
+            if populations is not None:
+                inputs.append(opts.population_file)
+                options.append(opts.population)
+            batch_keys.append(cache.key("sim_to_genotypes", CACHE_VERSION, inputs, options))
+        for k in range(len(batch_s)):
+            if cache.fetch(batch_keys[k], batch_files[k]):
+                print("Genotypes for "+batch_s[k]+" copied from the cache: "+batch_keys[k])
+                batch.remove(k)
+        if not batch:
+            print(f"\nDone adding genotypes for chromosome {opts.c}")
+            sys.exit()
+
+    outputs = []
+    beds = []
+    founder_states = [] #Genome mode: random state each pedigree picked its founders from
+    for chrom in chroms:
+        files = chromosome_files(args, chrom) if genome else args
+        map_file = opts.m.replace("{chr}", chrom) if genome else opts.m
+
+        #Read simulated chromosome diagrams for each pedigree in the batch
+        if genome:
+            pedigrees = [Pedigree(batch_s[k], chrom, opts.bptm, genome_diagrams[k][chrom]) for k in batch]
         else:
-            shuffle(founder_range)
-        founder_names = [founder_names[x] for x in founder_range]
-        if opts.write :
-            #write out
-            #fgl founder_name(working)
-            try:
-                write_out = open(opts.write, "wt")
-            except:
-                sys.exit("Failed to open "+opts.write)
-            for i in range(len(founder_range)):
-                write_out.write(" ".join([str(i+1), founder_names[i]])+"\n")
-            write_out.close()
-        if not len(my_fns) == 0:
-            print((str(len(my_fns))+" Ids not found\n"))
-        print((str(len(founder_names))+" founder haplotypes remain."))
-        #founder_names now contains only working names to use
-        #their file indices are in founder_range
-        #index in founder_range will be fgl
-        
-        #Recode ids in chromosome diagrams for admix mode
-        if opts.mode == "admix":
-            if opts.write:
-                #write out
-                #name p:newfgl1,newfgl2 p:newfgl1,newfgl2, ...
+            pedigrees = [Pedigree(batch_s[k], opts.c, opts.bptm) for k in batch]
+
+        #Read each data file in a single pass
+        #In IBD mode only the first 2x names haplotypes of the largest pedigree can be used as founders
+        #Sites that fail QC are dropped before any genotypes are dropped (cached per panel)
+        keep = keep_mask(files[0], opts.extract, opts.frq, opts.maf, opts.geno, region and region[1:], opts.threads) if variant_qc else None
+        panel = Panel(files, max_founders(pedigrees, opts.mode), opts.chunk, opts.bptm_map, map_file, keep, region, opts.stream, opts.threads, populations, opts.panel_server)
+        if populations is not None and opts.mode == "IBD":
+            needed = max(max(ped.fgls_used, default=0) for ped in pedigrees)
+            if len(panel.founder_names) < needed:
+                sys.exit("--population="+opts.population+" has "+str(len(panel.founder_names) // 2)+" founder samples in the genotype files, "+str(-(-needed // 2))+" are needed")
+
+        #Pick founders for each pedigree, in batch order. In genome mode every chromosome starts
+        #from the state the first one did, so each fgl is the same panel haplotype on every chromosome.
+        first = chrom == chroms[0]
+        for i, (k, ped) in enumerate(zip(batch, pedigrees)):
+            rng = founder_stream(opts.seed, batch_s[k])
+            if genome and first:
+                founder_states.append(rng.getstate())
+            elif genome:
+                if not panel.founder_names == first_founder_names:
+                    sys.exit("The genotype files for chromosome "+chrom+" do not have the same samples as for chromosome "+chroms[0])
+                if not ped.names == outputs[i].names:
+                    sys.exit("The diagrams for chromosome "+chrom+" in "+batch_s[k]+" do not have the same individuals as for chromosome "+chroms[0])
+                rng.setstate(founder_states[i])
+            ped.pick_founders(panel, opts.mode, opts.pid, opts.fids, batch_read[k], opts.bind, batch_write[k] if first else "", rng)
+        first_founder_names = panel.founder_names
+
+        #Open outputs with the first chromosome; each chunk then brings its panel's allele codes
+        if first:
+            for k, ped in zip(batch, pedigrees):
                 try:
-                    write_out = open(opts.write+".admix", "wt")
-                except:
-                    sys.exit("Failed to open "+opts.write+".admix")
-            for n in names:
-                if opts.write:
-                    write_out.write(n+" ") 
-                for population in list(pop_ids.keys()):
-                    try:
-                        myname1 = pop_ids[population].pop(0)
-                        myname2 = pop_ids[population].pop(0)
-                    except:
-                        sys.exit("Insufficient number of individuals for population "+str(population))
-                    new_fgl = str(founder_names.index(myname1)+1)
-                    if opts.write:
-                        write_out.write(str(population)+":"+new_fgl+",")
-                    for j in range(0, len(simu_data1[n]), 2):
-                        if simu_data1[n][j] == str(population):
-                            simu_data1[n][j] = new_fgl
-                    new_fgl = str(founder_names.index(myname2)+1)
-                    if opts.write:
-                        write_out.write(new_fgl+" ")
-                    for j in range(0, len(simu_data2[n]), 2):
-                        if simu_data2[n][j] == str(population):
-                            simu_data2[n][j] = new_fgl
-                if opts.write:
-                    write_out.write("\n")
-            if opts.write:
-                write_out.close()          
-        #Open output file and write header
-        try:
-            output = open(opts.out, "wt")
-            output.write("I rsid "+" ".join([n+" "+n for n in names])+"\n")
-        except: 
-            sys.exit("Error opening "+opts.out)
-        
-        founder_genomes = dict([(i , []) for i in range(1, len(founder_names)+1)]) #FGLs are integers
-        #fgl --> [genotypes]
-                    
-        counter = 0 #How many snps have I read so far?
-        chunk_start = 0
-        for snp in snp_names:
-            genos = []
-            for i in range(len(files)):
-                genos.extend(files[i].readline().split()[2:])
-            genos = [genos[x] for x in founder_range]
-            for i in range(1, len(genos)+1):
-                founder_genomes[i].append(genos[i-1])
-            counter = counter+1
-
-            if counter % opts.chunk == 0: #Time to print
-                #print("Writing chunk "+str(counter/opts.chunk -1 )+" of "+str(nchunks))
-                my_genos1 = {}; my_genos2 = {}
-                for n in names:
-                    my_genos1[n] = translate_simu(founder_genomes, cm_list[chunk_start:counter], simu_data1[n])
-                    my_genos2[n] = translate_simu(founder_genomes, cm_list[chunk_start:counter], simu_data2[n])
-                for i in range(opts.chunk):
-                    output.write(" ".join(["M", snp_names[chunk_start+i]]+[my_genos1[n][i]+" "+my_genos2[n][i] for n in names])+"\n")
-                founder_genomes = dict([(i , []) for i in range(1, len(founder_names)+1)]) #Reset fg hash at end of chunk
-                chunk_start = counter
-        my_genos1 = {}; my_genos2 = {} #Print the last chunk
-        for n in names:
-            my_genos1[n] = translate_simu(founder_genomes, cm_list[chunk_start:], simu_data1[n])
-            my_genos2[n] = translate_simu(founder_genomes, cm_list[chunk_start:], simu_data2[n])
-        for i in range(counter-chunk_start):
-            output.write(" ".join(["M", snp_names[chunk_start+i]]+[my_genos1[n][i]+" "+my_genos2[n][i] for n in names])+"\n")
-        for f in files:
-            f.close()
-        output.close()
-
-    elif file_mode == FileFormat.VCF:
-        # VCF doesn't need a map
-        # Positions are in col 2
-        try:
-            inp = gzip.open(args[0], "rt")
-        except Exception as e:
-            print(e)
-            sys.exit("Failed to open "+args[0] )
-        cm_list = []
-        for l in inp:
-            if l.startswith("#"):
-                # Skip all header lines
-                continue
-            cm_list.append(l.split(None, 2)[1])
-        if opts.bptm_map:
-            #print(("Converting map bp positions to cM: "+str(opts.bptm_map)+"=1cM"))
-            cm_list = [float(x)/opts.bptm_map for x in cm_list]
-        inp.close()
-        #print(("Last SNP position: "+str(cm_list[-1])))
-
-        #Read simulated chromosome diagrams 
-        try:
-            inp = open(opts.s, "rt")
-        except Exception as e:
-            print(e)
-            sys.exit("Failed to open "+opts.s )
-        simu_data1 = {} #Chroms for first haplotype, keyed by IID
-        simu_data2 = {} #For second haplotype
-        chrom_length="N"
-        fgls_used = set([])
-        for l in inp:
-            l = l.split()
-            if not l[6] == opts.c:
-                continue
-            n=l[1] #IID
-            chromid=l[5] #M or P
-            l=l[7:] #Chromosome diagram
-            fgls_used = fgls_used.union(set([int(l[x]) for x in range(0, len(l), 2)]))
-            if opts.bptm:
-                for i in range(1, len(l), 2):
-                    l[i] = float(l[i])/opts.bptm
-            if chrom_length == "N":
-                chrom_length = float(l[-1])
-            elif not chrom_length == float(l[-1]):
-                sys.exit("Chromosome lengths are not the same")
-            if chromid=="M":
-                simu_data1[n]= l[:]
-            elif chromid=="P":
-                simu_data2[n] = l[:]
-            else:
-                sys.exit("Error on "+l[0]+" chrmoid "+chromid)
-        inp.close()
-        #print(("Chromosome length: "+str(chrom_length)))
-        names = list(simu_data1.keys())
-        if not len(list(simu_data2.keys())) == len(names):
-            sys.exit("Something wonky...")
-        #print(("I found "+str(len(names))+" simulated individuals."))
-        
-        #Read provided haplotype correspondences
-        if opts.read:
-            try:
-                inp=open(opts.read, "rt")
-            except Exception as e:
-                print(e)
-                sys.exit("Failed to open"+opts.read)
-            set_haplos=dict([l.split() for l in inp])
-            inp.close()
-            
-
-        #Open data files and read header
-        files = [None for _ in args]
-        founder_names = [] #List of working names of founder haplotypea from data
-                            #If haplotypes are not named uniquely they will be coerced into unique names
-        tagending=0 
-        coerced_names = {} #Old name -> [newname1, newname2, ...]
-        hap_name_set = set([]) #set of unique haplotype names
-        for i in range(len(files)):
-            if ".vcf" in args[i].lower():
-                pass
-            elif ".bgl" in args[i].lower():
-                raise Exception(f"All input files must be the same format. {args[0]} was VCF but {args[i]} is BGL.")
-            else:
-                raise Exception(f"Failed to determine file format for file {args[i]}. Expected vcf or bgl.")
-
-            files[i] = gzip.open(args[i], "rt")
-
-            #List of haplotype names in this file
-            fnames = get_fnames_vcf(files[i])
-            #print(("File "+str(i+1)+" has "+str(len(fnames))+ " haplotypes."))
-            for j in range(len(fnames)):
-                if fnames[j] in hap_name_set: #Name is not unique
-                    if fnames[j] in coerced_names:
-                        coerced_names[fnames[j]].append(fnames[j]+"_"+str(tagending))
+                    if file_mode == FileFormat.VCF:
+                        outputs.append(VcfOutput(batch_out[k], panel.meta, ped.names, panel.allele_table, opts.threads))
                     else:
-                        coerced_names[fnames[j]]=[fnames[j]+"_"+str(tagending)]
-                    fnames[j] = fnames[j]+"_"+str(tagending)
-                    tagending=tagending+1
-                hap_name_set.add(fnames[j])
-            founder_names.extend(fnames)
-        #print(("I found "+str(len(founder_names))+" founder haplotypes total."))
-
-        # Limit founder names to maximum of 2x names
-        if len(founder_names) >= len(names) * 2:
-            founder_names = founder_names[:(len(names) * 2)]
-            #print(f"Only using {len(names) * 2} to simulate {len(names)} individuals")
-
-        snp_names = get_snp_names(files[0], file_mode)
-
-        if not len(snp_names) == len(cm_list):
-            raise Exception("Got different count of physical position vs cm position in VCF file.")
-        nchunks = len(snp_names)/opts.chunk + 1
-        #print(("There will be "+str(nchunks)+" chunks."))
-        #founder_names contains full set of working haplotype names
-
-        #Read population dictionary
-        if opts.mode == "admix":
-            try:
-                inp = open(opts.pid, "rt")
-                #Format: Name PopID
-            except Exception as e:
-                print(e)
-                sys.exit("Failed to open "+opts.pid)
-            my_fns = set(founder_names)
-            pop_ids = {} #population id --> [list of founder names]
-            fids=set([])
-            for l in inp:
-                [n, p] = l.split()
-                p = int(p)
-                if not n in my_fns:
-                    continue
-                if p in pop_ids:
-                    pop_ids[p].append(n)
-                else:
-                    pop_ids[p] = [n]
-                my_fns.remove(n)
-                fids.add(n)
-                if n in coerced_names:
-                    for new_name in coerced_names[n]:
-                        pop_ids[p].append(new_name) 
-                        my_fns.remove(new_name)
-                        fids.add(new_name)
-            inp.close()
-            if not len(fgls_used - set(pop_ids.keys()))== 0 :
-                print((list(pop_ids.keys())))
-                print(fgls_used)
-                sys.exit("Some of the population ids in the simulated data have no associated founders.")
-            #print(("I found populaion information for " +str((len(fids))) + " ids."))
-            print((str(len(my_fns)) +" haplotypes have no population information and will be discarded."))
-            for population in list(pop_ids.keys()):
-                shuffle(pop_ids[population])
-
-        #Read ids to include from --founder-ids option
-        if opts.fids:
-            try:
-                inp = open(opts.fids, "rt")
-            except Exception as e:
-                print(e)
-                sys.exit("Failed to open "+ opts.fids)
-            fids = set([])
-            for l in inp:
-                l=l.split()
-                fids = fids.union(set(l))
-                for x in l:
-                    if x in coerced_names:
-                        fids=fids.union(set(coerced_names[x]))
-            inp.close()
-            #print((str(len(fids))+" read from "+opts.fids))
-        elif opts.mode=="IBD":
-            fids=set(founder_names)
-        
-        #founder_names contains full set of working haplotype names
-        #fids is subset of working haplotype names that will be used
-        founder_range = list(range(len(founder_names))) 
-        my_fns = fids.copy()
-        for i in range(len(founder_names)):
-            if not founder_names[i] in fids:
-                founder_range.remove(i)
-            else:
-                my_fns.remove(founder_names[i])
-
-        if opts.read:
-            for fgl in list(set_haplos.keys()):
-                founder_range[int(fgl)-1]=founder_names.index(set_haplos[fgl])
-        elif opts.bind:
-            even_range = [founder_range[x] for x in range(0, len(founder_range), 2)]
-            even_index = dict([(founder_range[x], x) for x in range(0, len(founder_range), 2)])
-            shuffle(even_range)
-            newrange =[]
-            for k in range(len(even_range)):
-                newrange.append(even_range[k])
-                indx=even_index[even_range[k]]+1
-                newrange.append(founder_range[indx])
-            founder_range=newrange[:]
-        else:
-            shuffle(founder_range)
-        founder_names = [founder_names[x] for x in founder_range]
-        if opts.write :
-            #write out
-            #fgl founder_name(working)
-            try:
-                write_out = open(opts.write, "wt")
-            except:
-                sys.exit("Failed to open "+opts.write)
-            for i in range(len(founder_range)):
-                write_out.write(" ".join([str(i+1), founder_names[i]])+"\n")
-            write_out.close()
-        if not len(my_fns) == 0:
-            print((str(len(my_fns))+" Ids not found\n"))
-        #print((str(len(founder_names))+" founder haplotypes remain."))
-        #founder_names now contains only working names to use
-        #their file indices are in founder_range
-        #index in founder_range will be fgl
-        
-        #Recode ids in chromosome diagrams for admix mode
-        if opts.mode == "admix":
-            if opts.write:
-                #write out
-                #name p:newfgl1,newfgl2 p:newfgl1,newfgl2, ...
-                try:
-                    write_out = open(opts.write+".admix", "wt")
-                except:
-                    sys.exit("Failed to open "+opts.write+".admix")
-            for n in names:
-                if opts.write:
-                    write_out.write(n+" ") 
-                for population in list(pop_ids.keys()):
+                        outputs.append(BglOutput(batch_out[k], ped.names, panel.allele_table))
+                except Exception as e:
+                    print(e)
+                    sys.exit("Error opening and writing header to "+batch_out[k])
+                beds.append(None)
+                if batch_bed[k]:
                     try:
-                        myname1 = pop_ids[population].pop(0)
-                        myname2 = pop_ids[population].pop(0)
-                    except:
-                        sys.exit("Insufficient number of individuals for population "+str(population))
-                    new_fgl = str(founder_names.index(myname1)+1)
-                    if opts.write:
-                        write_out.write(str(population)+":"+new_fgl+",")
-                    for j in range(0, len(simu_data1[n]), 2):
-                        if simu_data1[n][j] == str(population):
-                            simu_data1[n][j] = new_fgl
-                    new_fgl = str(founder_names.index(myname2)+1)
-                    if opts.write:
-                        write_out.write(new_fgl+" ")
-                    for j in range(0, len(simu_data2[n]), 2):
-                        if simu_data2[n][j] == str(population):
-                            simu_data2[n][j] = new_fgl
-                if opts.write:
-                    write_out.write("\n")
-            if opts.write:
-                write_out.close()          
-        #Open output file and write header FOR VCF
-        try:
-            output = open(opts.out, "wt")
-            files[0].seek(0)
-            for line in files[0]:
-                if line.startswith("##"):
-                    output.write(line)
-                else:
-                    break
-
-            output.write("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t"+"\t".join(names)+"\n")
-        except: 
-            raise Exception("Error opening and writing header to "+opts.out)
-        
-        founder_genomes = dict([(i , []) for i in range(1, len(founder_names)+1)]) #FGLs are integers
-        #fgl --> [genotypes]
-                    
-        counter = 0 #How many snps have I read so far?
-        chunk_start = 0
-        for snp in snp_names:
-            genos = []
-            for i in range(len(files)):
-                #genos.extend(re.split(r'[\t\|]', next(files[i]).rstrip(), (len(names) * 2) + 9)[9:])
-                genos.extend(re.split(r'[\t\|]', next(files[i]).rstrip(), maxsplit=(len(names) * 2) + 9)[9:])
-            genos = [genos[x] for x in founder_range]
-            for i in range(1, len(names)+1):
-                founder_genomes[i].append(genos[i-1])
-            counter = counter+1
-
-            if counter % opts.chunk == 0: #Time to print
-                #print("Writing chunk "+str(counter/opts.chunk -1 )+" of "+str(nchunks))
-                my_genos1 = {}; my_genos2 = {}
-                for n in names:
-                    my_genos1[n] = translate_simu(founder_genomes, cm_list[chunk_start:counter], simu_data1[n])
-                    my_genos2[n] = translate_simu(founder_genomes, cm_list[chunk_start:counter], simu_data2[n])
-                for i in range(opts.chunk):
-                    output.write("\t".join([snp_names[chunk_start+i]]+[my_genos1[n][i]+"|"+my_genos2[n][i] for n in names])+"\n")
-                founder_genomes = dict([(i , []) for i in range(1, len(founder_names)+1)]) #Reset fg hash at end of chunk
-                chunk_start = counter
-        my_genos1 = {}; my_genos2 = {} #Print the last chunk
-        for n in names:
-            my_genos1[n] = translate_simu(founder_genomes, cm_list[chunk_start:], simu_data1[n])
-            my_genos2[n] = translate_simu(founder_genomes, cm_list[chunk_start:], simu_data2[n])
-        for i in range(counter-chunk_start):
-            output.write("\t".join([snp_names[chunk_start+i]]+[my_genos1[n][i]+"|"+my_genos2[n][i] for n in names])+"\n")
-        for f in files:
-            f.close()
+                        beds[-1] = BedWriter(batch_bed[k], panel.allele_table)
+                        write_fam(batch_bed[k]+".fam", ped.names, ped.fam_info)
+                    except Exception as e:
+                        print(e)
+                        sys.exit("Error opening "+batch_bed[k]+".bed")
+
+        #Chunks are read, dropped and written on three threads, so reading and compressing overlap dropping
+        def write_chunk(chunk):
+            snp_names, genotypes, allele_table = chunk
+            for output, bed, simu_genos in zip(outputs, beds, genotypes):
+                output.allele_table = allele_table
+                output.write(snp_names, simu_genos)
+                if bed is not None:
+                    bed.set_allele_table(allele_table)
+                    bed.write(snp_names, simu_genos)
+        writer = WriterThread(write_chunk)
+        for snp_names, cm, genotypes in drop_pedigrees(panel, pedigrees, opts.workers):
+            #A copy of the codes so far: when streaming, the reader thread adds to panel.allele_table while earlier chunks are written
+            writer.put((snp_names, genotypes, tuple(panel.allele_table)))
+        writer.close()
+        panel.close()
+        print(f"\nDone adding genotypes for chromosome {chrom}")
+        panel = keep = pedigrees = None #Freed before the next chromosome's panel is read
+    for output, bed in zip(outputs, beds):
         output.close()
-        print(f"\nDone adding genotypes for chromosome {opts.c}")
+        if bed is not None:
+            bed.close()
+    if cache is not None:
+        for k in batch:
+            cache.store(batch_keys[k], batch_files[k])
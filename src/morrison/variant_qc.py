@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+#Variant keep-masks applied by sim_to_genotypes.py before genotypes are dropped
+#The site list, allele frequency, missingness and duplicate ID filters run on the simulated
+#genotypes later only depend on the reference panel, so they can be worked out once per panel
+#Masks are cached in ref.vcf.gz.qc/ keyed by the panel, the filter files and the thresholds
+
+import hashlib
+import json
+import os
+import re
+
+import numpy as np
+
+from bgzf import open_vcf
+from collections import Counter
+
+QC_VERSION = 3 #Bump when the filters or the cached layout change
+QC_SUFFIX = ".qc"
+
+def file_key(path):
+    """Identifies a file by name, size and mtime for cache keys"""
+    if not path:
+        return None
+    st = os.stat(path)
+    return [os.path.abspath(path), st.st_size, st.st_mtime]
+
+def read_extract(path):
+    """Variant IDs from a .bim file (second column), as used by plink --extract"""
+    ids = set()
+    with open(path, "rt") as inp:
+        for line in inp:
+            l = line.split(None, 2)
+            if len(l) > 1:
+                ids.add(l[1])
+    return ids
+
+def read_frq(path, chrom):
+    """SNP -> MAF for one chromosome from a plink .frq file (CHR SNP A1 A2 MAF NCHROBS)"""
+    chrom = chrom.removeprefix("chr")
+    maf = {}
+    with open(path, "rt") as inp:
+        inp.readline()
+        for line in inp:
+            l = line.split()
+            if len(l) > 4 and l[0].removeprefix("chr") == chrom and l[4] != "NA":
+                maf[l[1]] = float(l[4])
+    return maf
+
+MULTI_DIGIT = re.compile(rb"[0-9][0-9]")
+GT_SEPARATORS = re.compile(rb"[|/]")
+
+def allele_counts(format_field, samples):
+    """(alleles, missing, REF) allele counts of the GT subfield of a record's tab separated sample columns
+
+    Samples may be haploid or polyploid, and allele indices above 9 and other
+    FORMAT fields are parsed. Records without GT have no alleles.
+    """
+    samples = samples.rstrip(b"\r\n")
+    if not samples:
+        return 0, 0, 0
+    if format_field == b"GT" and not MULTI_DIGIT.search(samples):
+        #GT only with single digit alleles, as in the 1000 Genomes panels: counted without splitting
+        n_alleles = samples.count(b"\t") + samples.count(b"|") + samples.count(b"/") + 1
+        return n_alleles, samples.count(b"."), samples.count(b"0")
+    keys = format_field.split(b":")
+    if b"GT" not in keys:
+        return 0, 0, 0
+    gt = keys.index(b"GT")
+    alleles = []
+    for sample in samples.split(b"\t"):
+        fields = sample.split(b":")
+        alleles.extend(GT_SEPARATORS.split(fields[gt]) if gt < len(fields) else [b"."])
+    return len(alleles), sum(a == b"." for a in alleles), sum(a == b"0" for a in alleles)
+
+def build_keep_mask(panel, extract="", frq="", maf=0.0, geno=1.0, threads=1):
+    """Boolean mask over the variants of panel (a .vcf.gz) of the sites that pass QC
+
+    A site is kept when its ID is in the extract .bim (if given), its minor allele
+    frequency is at least maf and at most a fraction geno of its alleles are missing,
+    counting the alleles of the GT field and taking every non-REF allele as alternate.
+    Records without an ID are matched as chrom:pos, as with --set-missing-var-ids @:#.
+    MAF is taken from the panel itself, which is what founders are drawn from; when a
+    .frq file is given a site also passes if its frequency there is high enough, so
+    sites are only dropped when both agree. IDs kept more than once are dropped, as the
+    duplicate SNP list does downstream. Returns (mask, POS of every variant).
+    threads decompress a BGZF panel.
+    """
+    ids = read_extract(extract) if extract else None
+    keep = []
+    names = []
+    positions = []
+    frq_maf = None
+    with open_vcf(panel, threads) as inp:
+        for line in inp:
+            if line.startswith(b"#"):
+                continue
+            parts = line.split(b"\t", 9)
+            name = parts[2].decode()
+            if name == ".":
+                name = parts[0].decode()+":"+parts[1].decode()
+            if frq and frq_maf is None:
+                frq_maf = read_frq(frq, parts[0].decode())
+            names.append(name)
+            positions.append(int(parts[1]))
+            if ids is not None and name not in ids:
+                keep.append(False)
+                continue
+            n_alleles, missing, n_ref = allele_counts(parts[8], parts[9]) if len(parts) == 10 else (0, 0, 0)
+            called = n_alleles - missing
+            if n_alleles == 0 or missing > geno * n_alleles or called == 0:
+                keep.append(False)
+                continue
+            af = (called - n_ref) / called
+            site_maf = min(af, 1 - af)
+            if site_maf < maf and not (frq_maf is not None and frq_maf.get(name, 0) >= maf):
+                keep.append(False)
+                continue
+            keep.append(True)
+    keep = np.array(keep, dtype=bool)
+    counts = Counter(n for n, k in zip(names, keep.tolist()) if k)
+    dups = np.array([counts[n] > 1 for n in names], dtype=bool)
+    return keep & ~dups, np.array(positions, dtype=np.int64)
+
+def keep_mask(panel, extract="", frq="", maf=0.0, geno=1.0, region=None, threads=1):
+    """build_keep_mask, cached next to the panel
+
+    region (start, end), 1-based and inclusive, returns the part of the mask for
+    the variants with POS in that range, as read by sim_to_genotypes.py --region.
+    """
+    key = json.dumps([QC_VERSION, file_key(panel), file_key(extract), file_key(frq), maf, geno])
+    cache = os.path.join(panel+QC_SUFFIX, "keep-"+hashlib.sha1(key.encode()).hexdigest()[:16]+".npz")
+    if os.path.exists(cache):
+        with np.load(cache) as cached:
+            mask, positions = cached["keep"], cached["pos"]
+    else:
+        mask, positions = build_keep_mask(panel, extract, frq, maf, geno, threads)
+        try:
+            os.makedirs(panel+QC_SUFFIX, exist_ok=True)
+            #Write then rename so jobs sharing a panel never read a partial mask
+            tmp = cache+"."+str(os.getpid())+".npz"
+            np.savez(tmp, keep=mask, pos=positions)
+            os.replace(tmp, cache)
+        except OSError as e:
+            print("Could not cache the variant mask: "+str(e))
+    if region is not None:
+        #Panel records are sorted by position, so a region is a contiguous run of them
+        lo = np.searchsorted(positions, region[0], side="left")
+        hi = np.searchsorted(positions, region[1], side="right")
+        mask = mask[lo:hi]
+    return mask